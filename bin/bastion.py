@@ -51,7 +51,7 @@ import vault
 
 import alter_path
 from lib import aws
-from lib.ssh import SSHConnection, vault_tunnel
+from lib.ssh import SSHConnection, vault_tunnel, run_all, FLEET_CONCURRENCY
 from lib.vault import Vault
 
 if __name__ == "__main__":
@@ -89,6 +89,13 @@ if __name__ == "__main__":
                         metavar = "<file>",
                         default = os.environ.get("SSH_KEY"),
                         help = "SSH private key to use when connecting to AWS instances (default: SSH_KEY)")
+    parser.add_argument("--concurrency", "-c",
+                        default=FLEET_CONCURRENCY,
+                        type=int,
+                        help = "Number of machines ssh-all runs the command on at once (default: {})".format(FLEET_CONCURRENCY))
+    parser.add_argument("--timeout", "-t",
+                        type=int,
+                        help = "Seconds to wait for the ssh-all command to finish on each machine")
     parser.add_argument("--bastion","-b",  help="Hostname of the EC2 bastion server to create SSH Tunnels on")
     parser.add_argument("internal", help="Hostname of the EC2 internal server to create the SSH Tunnels to")
     parser.add_argument("command",
@@ -144,12 +151,16 @@ if __name__ == "__main__":
     elif args.command in ("ssh-tunnel",):
         ssh.external_tunnel(*args.arguments)
     elif args.command in ("ssh-all",):
+        command = args.arguments[0] if len(args.arguments) > 0 else input("command: ")
         addrs = aws.machine_lookup_all(session, args.internal, public_ip=False)
+        targets = [(addr, args.port, args.user) for addr in addrs]
+        rets = run_all(args.ssh_key, targets, command, bastion, args.concurrency, args.timeout)
+
+        print()
         for addr in addrs:
-            print("{} at {}".format(args.internal, addr))
-            ssh = SSHConnection(args.ssh_key, addr, bastion)
-            ssh.cmd(*args.arguments)
-            print()
+            ret = rets[addr]
+            print("{} at {}: {}".format(args.internal, addr, "timed out" if ret is None else ret))
+        sys.exit(0 if all(ret == 0 for ret in rets.values()) else 1)
     elif args.command in vault.COMMANDS:
         with vault_tunnel(args.ssh_key, bastion):
             vault.COMMANDS[args.command](Vault(args.internal, private), *args.arguments)
@@ -21,11 +21,20 @@ import sys
 import os
 import importlib
 import glob
+import time
+import functools
+import threading
+import traceback
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from botocore.exceptions import ClientError
 
 import alter_path
 from lib import exceptions
 from lib import aws
 from lib import utils
+from lib import cloudformation
 from lib.cloudformation import CloudFormationConfiguration
 from lib.stepfunctions import heaviside
 
@@ -47,6 +56,210 @@ def call_config(session, domain, config, func_name):
     else:
         print("Configuration '{}' doesn't implement function '{}'".format(config, func_name))
 
+@contextmanager
+def timed_lookups():
+    """Record the calls to, and time spent in, each of the public aws.*_lookup
+    functions while the context is active.
+
+    Only the outermost lookup of each thread is recorded, so that the time of
+    lookups that call other lookups is not counted twice.
+
+    Returns:
+        (dict) : Dictionary of lookup name to {'calls': int, 'time': float},
+                 filled in as the lookups are called
+    """
+    stats = {}
+    local = threading.local()
+
+    def timed(name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(local, 'active', False):
+                return func(*args, **kwargs)
+
+            local.active = True
+            start = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                local.active = False
+                stat = stats.setdefault(name, {'calls': 0, 'time': 0.0})
+                stat['calls'] += 1
+                stat['time'] += time.monotonic() - start
+        return wrapper
+
+    names = [name for name in dir(aws)
+             if (name.endswith('_lookup') or name.endswith('_lookup_all'))
+             and not name.startswith('_') and name != 'cached_lookup']
+    originals = {name: getattr(aws, name) for name in names}
+    for name, func in originals.items():
+        setattr(aws, name, timed(name, func))
+    try:
+        yield stats
+    finally:
+        for name, func in originals.items():
+            setattr(aws, name, func)
+
+def profile_config(session, domain, config):
+    """Build the config's template and report the template's composition, the
+    headroom against the CloudFormation limits, and the time spent in each of
+    the AWS lookups made while building the template.
+    """
+    module = importlib.import_module("configs." + config)
+    if 'create_config' not in module.__dict__:
+        print("Configuration '{}' doesn't implement function 'create_config'".format(config))
+        return False
+
+    with timed_lookups() as lookups:
+        start = time.monotonic()
+        cf_config = module.create_config(session, domain)
+        elapsed = time.monotonic() - start
+
+    sizes = cf_config.resource_sizes()
+    totals = lambda t: sum(size for key, size in sizes[t])
+
+    fmt = "{:<45}{:>7}{:>10}"
+    print(fmt.format("Resource Type", "Count", "Bytes"))
+    for type_ in sorted(sizes, key=totals, reverse=True):
+        print(fmt.format(str(type_), len(sizes[type_]), totals(type_)))
+    print()
+
+    fmt = "{:<45}{:>10}  {}"
+    print(fmt.format("Resource", "Bytes", "Type"))
+    resources = [(key, size, type_) for type_ in sizes for key, size in sizes[type_]]
+    for key, size, type_ in sorted(resources, key=lambda r: r[1], reverse=True):
+        print(fmt.format(key, size, type_))
+    print()
+
+    limit = lambda used, max_: "{:>8} of {:>8} ({:.0%} used, {} remaining)".format(used, max_, used / max_, max_ - used)
+    size = cf_config.template_size()
+    print("Resources:        " + limit(len(cf_config.resources), cloudformation.TEMPLATE_RESOURCE_LIMIT))
+    print("Parameters:       " + limit(len(cf_config.parameters), cloudformation.TEMPLATE_PARAMETER_LIMIT))
+    print("Template bytes:   " + limit(size, cloudformation.TEMPLATE_BODY_LIMIT) + " TemplateBody")
+    print("                  " + limit(size, cloudformation.TEMPLATE_URL_LIMIT) + " TemplateURL")
+    print()
+
+    fmt = "{:<35}{:>7}{:>10}"
+    print("create_config took {:.2f}s".format(elapsed))
+    print(fmt.format("Lookup", "Calls", "Seconds"))
+    for name in sorted(lookups, key=lambda n: lookups[n]['time'], reverse=True):
+        print(fmt.format(name, lookups[name]['calls'], "{:.2f}".format(lookups[name]['time'])))
+    print()
+
+    fmt = "{:<35}{:>7}{:>7}{:>10}"
+    print(fmt.format("Cached Lookup", "Calls", "Hits", "Seconds"))
+    stats = aws.lookup_cache(session).stats
+    for name in sorted(stats, key=lambda n: stats[n]['time'], reverse=True):
+        print(fmt.format(name, stats[name]['calls'], stats[name]['hits'], "{:.2f}".format(stats[name]['time'])))
+
+    return True
+
+def config_dependencies(configs):
+    """Import each of the configs and build the dependency graph used by apply-all.
+
+    Only configs that define DEPENDENCIES are included.
+
+    Args:
+        configs (list) : List of config names
+
+    Returns:
+        (dict) : Dictionary of config name to list of configs it depends on
+    """
+    graph = {}
+    for config in configs:
+        module = importlib.import_module("configs." + config)
+        if hasattr(module, 'DEPENDENCIES'):
+            graph[config] = list(module.DEPENDENCIES)
+
+    for config, dependencies in graph.items():
+        for dependency in dependencies:
+            if dependency not in graph:
+                raise Exception("Config '{}' depends on unknown config '{}'".format(config, dependency))
+
+    return graph
+
+def stack_status(session, domain, config):
+    """Get the status of the config's stack or None if the stack doesn't exist"""
+    stack_name = CloudFormationConfiguration(config, domain).stack_name
+    client = aws.get_client(session, 'cloudformation')
+    try:
+        response = client.describe_stacks(StackName=stack_name)
+        return response['Stacks'][0]['StackStatus']
+    except ClientError:
+        return None
+
+def apply_all(session, domain, graph):
+    """Create all of the stacks in the dependency graph.
+
+    Stacks are created as soon as all of the stacks they depend on exist, so
+    independent stacks are created at the same time. Stacks that already
+    exist are skipped, so apply-all can be run again after fixing a failure.
+    If a stack fails, the stacks that depend on it are not created.
+
+    Args:
+        session (Session) : Boto3 session used to create the stacks
+        domain (string) : Domain in which to create the stacks
+        graph (dict) : Dictionary of config name to list of configs it depends on
+
+    Returns:
+        (bool) : If all of the stacks exist
+    """
+    # Resolve the keypair up front, as it may prompt the user. The
+    # selection is remembered for the session and shared with all of the configs
+    aws.keypair_lookup(session)
+
+    def create(config):
+        with output.label(config):
+            try:
+                if stack_status(session, domain, config) is not None:
+                    print("Stack already exists, skipping")
+                    return 'exists'
+
+                call_config(session, domain, config, 'create')
+
+                status = stack_status(session, domain, config)
+                if status != 'CREATE_COMPLETE':
+                    print("Stack status is '{}'".format(status))
+                    return 'failed'
+                return 'created'
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+                return 'failed'
+
+    results = {}
+    pending = dict(graph)
+    running = {}
+    with utils.prefixed_output() as output, ThreadPoolExecutor(max_workers=len(graph)) as pool:
+        while pending or running:
+            progress = False
+            for config, dependencies in sorted(pending.items()):
+                if any(results.get(d) in ('failed', 'skipped') for d in dependencies):
+                    results[config] = 'skipped'
+                    del pending[config]
+                    progress = True
+                elif all(d in results for d in dependencies):
+                    print("Starting {}".format(config))
+                    running[pool.submit(create, config)] = config
+                    del pending[config]
+                    progress = True
+
+            if len(running) == 0:
+                if not progress:
+                    raise Exception("Circular dependency between configs: {}".format(", ".join(pending)))
+                continue # Recheck the configs that depend on newly skipped configs
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                config = running.pop(future)
+                results[config] = future.result()
+                print("Finished {}: {}".format(config, results[config]))
+
+    print()
+    for config in sorted(results):
+        print("{:15} {}".format(config, results[config]))
+
+    return all(result in ('created', 'exists') for result in results.values())
+
 if __name__ == '__main__':
     os.chdir(os.path.join(cur_dir, "..", "cloud_formation"))
 
@@ -58,7 +271,7 @@ if __name__ == '__main__':
     config_names = [x.split('/')[1].split('.')[0] for x in glob.glob("configs/*.py") if "__init__" not in x]
     config_help = create_help("config_name supports the following:", config_names)
 
-    actions = ["create", "update", "delete", "post-init", "pre-init", "generate"]
+    actions = ["create", "update", "delete", "post-init", "pre-init", "generate", "apply-all", "profile"]
     actions_help = create_help("action supports the following:", actions)
 
     scenarios = ["development", "production", "ha-development"]
@@ -90,14 +303,18 @@ if __name__ == '__main__':
                         help = "Action to execute")
     parser.add_argument("domain_name", help="Domain in which to execute the configuration (example: subnet.vpc.boss)")
     parser.add_argument("config_name",
+                        nargs = "?",
                         choices = config_names,
                         metavar = "config_name",
-                        help="Configuration to act upon (imported from configs/)")
+                        help="Configuration to act upon (imported from configs/, not used by apply-all)")
     parser.add_argument("--internal",
                         action = "store_true",
                         help="Attemps to execute cloudformation script without any credentials. Meant to use from internal aws instances")
     args = parser.parse_args()
 
+    if args.config_name is None and args.action != "apply-all":
+        parser.error("the following arguments are required: config_name")
+
     if args.internal:
         session = aws.use_iam_role()
 
@@ -113,6 +330,13 @@ if __name__ == '__main__':
 
         session = aws.create_session(args.aws_credentials)
 
+    if args.action == "apply-all":
+        graph = config_dependencies(config_names)
+        sys.exit(0 if apply_all(session, args.domain_name, graph) else 1)
+
+    if args.action == "profile":
+        sys.exit(0 if profile_config(session, args.domain_name, args.config_name) else 1)
+
     try:
         func = args.action.replace('-','_')
         ret = call_config(session, args.domain_name, args.config_name, func)
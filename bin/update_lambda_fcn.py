@@ -122,14 +122,14 @@ def load_lambdas_on_s3(session, domain, bucket):
 
     print("Copying local modules to lambda-build-server")
 
-    #copy the zip file to lambda_build_server
+    # Sync the zip file to lambda_build_server, so only the parts of the
+    # previous zip that changed are sent
     lambda_build_server = aws.get_lambda_server(session)
     lambda_build_server_key = aws.get_lambda_server_key(session)
     lambda_build_server_key = utils.keypair_to_file(lambda_build_server_key)
     ssh = SSHConnection(lambda_build_server_key, (lambda_build_server, 22, 'ec2-user'))
     target_file = "sitezips/{}.zip".format(domain)
-    ret = ssh.scp(zipname, target_file, upload=True)
-    print("scp return code: " + str(ret))
+    ssh.sync(zipname, target_file, upload=True)
 
     os.remove(zipname)
 
@@ -29,7 +29,7 @@ import json
 from pprint import pprint
 
 import alter_path
-from lib.vault import Vault
+from lib.vault import Vault, write_export, read_export, format_changes
 from lib.utils import open_
 
 NEW_TOKEN = "new_token"
@@ -217,30 +217,50 @@ def vault_delete(vault, path = None):
 def vault_export(vault, output='-', path="secret/"):
     """A generic method for exporting data from Vault
 
-    Note: output data is Json encoded
+    Note: output data is Json lines encoded, one line per Vault path,
+          written as each path is read
 
     Args:
         vault (Vault) : Vault connection to use
         output (string) : Output path to save the data ('-' for stdout)
         path (string) : Vault path to export data from
     """
-    rtn = vault.export(path)
-
     with open_(output, 'w') as fh:
-        json.dump(rtn, fh, indent=3, sort_keys=True)
+        write_export(vault.export_iter(path), fh)
 
 def vault_import(vault, input_='-'):
     """A generic method for importing data into Vault
 
-    Note: input data should be Json encoded
+    Note: input data should be Json lines encoded (as written by vault-export)
+          or a single Json object
+
+    Args:
+        input_ (string) : Input path to read data from ('-' for stdin)
+    """
+    with open_(input_) as fh:
+        exported = dict(read_export(fh))
+
+    changes = vault.import_(exported)
+    print("Wrote {} of {} paths".format(len(changes), len(exported)))
+    for line in format_changes(changes):
+        print(line)
+
+def vault_diff(vault, input_='-'):
+    """A generic method for comparing data to import with the data in Vault
+
+    Prints the paths and keys that vault-import would change, without the
+    values or writing any data.
 
     Args:
         input_ (string) : Input path to read data from ('-' for stdin)
     """
     with open_(input_) as fh:
-        exported = json.load(fh)
+        exported = dict(read_export(fh))
 
-    vault.import_(exported)
+    changes = vault.import_(exported, dry_run=True)
+    print("{} of {} paths would be written".format(len(changes), len(exported)))
+    for line in format_changes(changes):
+        print(line)
 
 COMMANDS = {
     "vault-init": vault_init,
@@ -257,6 +277,7 @@ COMMANDS = {
     "vault-delete":vault_delete,
     "vault-export": vault_export,
     "vault-import": vault_import,
+    "vault-diff": vault_diff,
 }
 
 if __name__ == '__main__':
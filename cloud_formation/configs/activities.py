@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import json
+import zipfile
 from lib.cloudformation import CloudFormationConfiguration, Ref, Arn, get_scenario, Arg
 from lib.userdata import UserData
 from lib.names import AWSNames
@@ -20,6 +22,9 @@ from lib import aws
 from lib import constants as const
 from lib import stepfunctions as sfn
 
+# Configs that need to be created before this config (used by apply-all)
+DEPENDENCIES = ['api', 'cachedb']
+
 keypair = None
 
 
@@ -98,12 +103,16 @@ def create_config(session, domain):
                                min=1,
                                max=1)
 
+    # Code is uploaded to S3 by pre_init(), as it is larger than the 4k
+    # limit for inline lambda code
     config.add_lambda("IngestLambda",
                       names.ingest_lambda,
                       aws.role_arn_lookup(session, 'IngestQueueUpload'),
-                      const.INGEST_LAMBDA,
-                      handler="index.handler",
-                      timeout=60 * 5)
+                      s3=(aws.get_lambda_s3_bucket(session),
+                          generate_ingest_lambda_key(domain),
+                          "index.handler"),
+                      timeout=60 * 5,
+                      runtime="python3.6")
 
     config.add_lambda_permission("IngestLambdaExecute", Ref("IngestLambda"))
 
@@ -118,6 +127,8 @@ def generate(session, domain):
 
 def create(session, domain):
     """Create the configuration, launch it, and initialize Vault"""
+    pre_init(session, domain)
+
     config = create_config(session, domain)
 
     success = config.create(session)
@@ -125,6 +136,31 @@ def create(session, domain):
         post_init(session, domain)
 
 
+def pre_init(session, domain):
+    """Package the ingest lambda and upload the .zip to the lambda S3 bucket"""
+    print("Uploading ingest lambda to S3")
+    zip_file = io.BytesIO()
+    with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.write(const.INGEST_LAMBDA, 'index.py')
+
+    s3 = aws.get_client(session, 's3')
+    s3.put_object(Bucket=aws.get_lambda_s3_bucket(session),
+                  Key=generate_ingest_lambda_key(domain),
+                  Body=zip_file.getvalue())
+
+
+def generate_ingest_lambda_key(domain):
+    """Generate the S3 key name for the ingest lambda's zip file.
+
+    Args:
+        domain (str): Use the domain as part of the key.
+
+    Returns:
+        (str)
+    """
+    return 'ingest_queue_upload.' + domain + '.zip'
+
+
 def post_init(session, domain):
     names = AWSNames(domain)
 
@@ -40,6 +40,9 @@ import sys
 from urllib.request import Request, urlopen
 from urllib.parse import urlencode
 
+# Configs that need to be created before this config (used by apply-all)
+DEPENDENCIES = ['core', 'redis']
+
 def create_config(session, domain, keypair=None, db_config={}):
     """
     Create the CloudFormationConfiguration object.
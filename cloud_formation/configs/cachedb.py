@@ -38,6 +38,9 @@ from lib import constants as const
 from update_lambda_fcn import load_lambdas_on_s3
 import boto3
 
+# Configs that need to be created before this config (used by apply-all)
+DEPENDENCIES = ['api']
+
 
 def create_config(session, domain, keypair=None, user_data=None):
     """
@@ -270,11 +273,11 @@ def add_tile_bucket_trigger(session, domain):
     lambda_name = names.multi_lambda
     bucket_name = names.tile_bucket
 
-    lam = session.client('lambda')
+    lam = aws.get_client(session, 'lambda')
     resp = lam.get_function_configuration(FunctionName=lambda_name)
     lambda_arn = resp['FunctionArn']
 
-    s3 = session.resource('s3')
+    s3 = aws.get_resource(session, 's3')
     bucket = s3.Bucket(bucket_name)
 
     notification = bucket.Notification()
@@ -30,6 +30,9 @@ from lib import constants as const
 
 import json
 
+# Configs that need to be created before this config (used by apply-all)
+DEPENDENCIES = ['api']
+
 def create_config(session, domain):
     """Create the CloudFormationConfiguration object.
     :arg session used to perform lookups
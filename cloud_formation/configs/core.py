@@ -39,6 +39,9 @@ import json
 import time
 from concurrent.futures import ThreadPoolExecutor
 
+# Configs that need to be created before this config (used by apply-all)
+DEPENDENCIES = []
+
 keypair = None
 
 def create_asg_elb(config, key, hostname, ami, keypair, user_data, size, isubnets, esubnets, listeners, check, sgs=[], role = None, public=True, depends_on=None):
@@ -32,6 +32,9 @@ import subprocess
 
 from update_lambda_fcn import load_lambdas_on_s3
 
+# Configs that need to be created before this config (used by apply-all)
+DEPENDENCIES = []
+
 # Location of repo with the lambda autoscaler.
 LAMBDA_ROOT_FOLDER = os.path.join(
     os.path.dirname(__file__), '../lambda/dynamodb-lambda-autoscale')
@@ -253,7 +256,7 @@ def upload_to_s3(session, domain, zip_file, bucket):
     """
     print('Uploading to S3.')
     key = generate_lambda_key(domain)
-    s3 = session.client('s3')
+    s3 = aws.get_client(session, 's3')
     s3.create_bucket(Bucket=bucket)
     s3.put_object(Bucket=bucket, Key=key, Body=open(zip_file, 'rb'))
 
@@ -30,6 +30,9 @@ from lib import aws
 from lib import constants as const
 from lib.cloudformation import get_scenario
 
+# Configs that need to be created before this config (used by apply-all)
+DEPENDENCIES = ['core']
+
 
 def create_config(session, domain, keypair=None):
     """
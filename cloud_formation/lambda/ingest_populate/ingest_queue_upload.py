@@ -1,13 +1,41 @@
 import boto3
 import json
 import time
+import random
 import hashlib
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError, ReadTimeoutError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 class FailedToSendMessages(Exception):
     pass
 
-SQS_BATCH_SIZE = 10
-SQS_RETRY_TIMEOUT = 15
+# SQS send_message_batch limits
+SQS_MAX_BATCH_ENTRIES = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+
+SQS_SEND_THREADS = 8 # Number of batches being sent at once
+SQS_RETRIES = 5
+SQS_RETRY_DELAY = 0.5 # seconds, doubled for each retry
+SQS_RETRY_MAX_DELAY = 15 # seconds
+
+# Jobs are split into shards of about this many messages, each of which is
+# populated by a separate invocation of this lambda
+SHARD_MESSAGES = 100000
+MAX_SHARDS = 20
+SHARD_RETRIES = 3 # Number of times a failed shard is invoked again
+LAMBDA_TIMEOUT = 60 * 5 # seconds, set by configs/activities.py
+
+# Stop sending messages when there is less than this much time left before
+# the lambda times out, leaving time for the batches being sent to finish
+RESUME_MARGIN = 60 # seconds
+
+# Time kept by the lambda invoking the shards to save their progress, and
+# given to each shard to start up and return its results
+SHARD_MARGIN = 30 # seconds
+
+# Version of the compact message format, see decode_message()
+COMPACT_MESSAGE_VERSION = 2
 
 def handler(args, context):
     """Populate the ingest upload SQS Queue with tile information
@@ -40,118 +68,548 @@ def handler(args, context):
             'z_stop': 0
             'z_tile_size': 16,
             'final_z_stop': 0, The full extent of the Z dimension
+
+            'shards': 1, Optional number of shards to split the job into.
+                         If not given, it is based on the number of messages
+            'compact_messages': False, Optional, if the messages should use
+                                       the compact format (see decode_message())
+            'time_limit': None, Optional number of seconds to send messages
+                                for before stopping, set for each shard by
+                                populate_shards()
         }
 
+        If the lambda is about to time out it stops and returns, and should
+        be called again with the returned dictionary to resume.
+
     Returns:
-        int: Number of messages put into the queue
+        dict: The args with the following keys added / updated
+            'finished': If all of the messages have been put into the queue
+            'sent': Number of messages put into the queue
+            'cursor': Index of the next message to enqueue (see decode_cursor())
+            'pending_shards': List of args for shards that are not finished
+            'shard_errors': List of shards that enqueued the wrong number of messages
+            'send_error': Error from the first batch that could not be sent
+
+    Raises:
+        FailedToSendMessages: If the previous call recorded a send error or
+                              shard errors, or a shard failed more than
+                              SHARD_RETRIES times.
+                              Nothing is sent before raising, so retrying
+                              doesn't enqueue duplicate messages
     """
-    print("Starting to populate upload queue")
+    started = time.monotonic()
+    time_limit = args.get('time_limit')
+    def stop():
+        if time_limit is not None and time.monotonic() - started >= time_limit:
+            return True
+        return context.get_remaining_time_in_millis() < RESUME_MARGIN * 1000
+
+    shards = args.get('pending_shards')
+    if shards is None:
+        count = args.get('shards')
+        if count is None:
+            count = min(MAX_SHARDS, count_messages(args) // SHARD_MESSAGES + 1)
+        shards = split_shards(args, count)
+
+    # Once sharded, the job is resumed using the shards, even if only one is left
+    if len(shards) > 1 or 'pending_shards' in args:
+        errors = list(args.get('shard_errors', []))
+        errors += [shard['error'] for shard in shards if shard.get('failures', 0) > SHARD_RETRIES]
+        if len(errors) > 0:
+            raise FailedToSendMessages(errors)
+
+        # Stop waiting on the shards while there is still time to save their progress
+        timeout = context.get_remaining_time_in_millis() / 1000 - SHARD_MARGIN
+        if timeout <= RESUME_MARGIN + SHARD_MARGIN:
+            print("Not enough time left to invoke the shards, stopping")
+            args = dict(args)
+            args['pending_shards'] = shards
+            args['finished'] = False
+            return args
+
+        print("Populating upload queue using {} shards".format(len(shards)))
+        sent, pending, errors = populate_shards(context.function_name, shards, timeout)
+
+        args = dict(args)
+        args['sent'] = args.get('sent', 0) + sent
+        args['pending_shards'] = pending
+        args['shard_errors'] = errors
+        # Call again to raise the errors, now that the progress has been saved
+        args['finished'] = len(pending) == 0 and len(errors) == 0
+        return args
+
+    if 'send_error' in args:
+        raise FailedToSendMessages(args['send_error'])
+
+    cursor = args.get('cursor', 0)
+    print("Starting to populate upload queue at message {}".format(cursor))
+
+    config = Config(max_pool_connections=SQS_SEND_THREADS)
+    client = boto3.client('sqs', config=config)
+
+    msgs = create_messages(args, cursor)
+    sent, enqueued, error = send_messages(client, args['upload_queue'], msgs, stop=stop)
+
+    args = dict(args)
+    args['sent'] = args.get('sent', 0) + sent
+    args['cursor'] = cursor + enqueued
+    if error is not None:
+        # Call again to raise the error, now that the progress has been saved
+        print("Failed to send messages, stopping at message {}".format(args['cursor']))
+        args['send_error'] = error
+        args['finished'] = False
+        return args
+
+    args['finished'] = args['cursor'] >= count_messages(args)
+    if not args['finished']:
+        print("Stopping before timeout, resume at message {}".format(args['cursor']))
+    return args
+
+def count_messages(args):
+    """Count the number of messages create_messages() will create
 
-    queue = boto3.resource('sqs').Queue(args['upload_queue'])
+    Args:
+        args (dict): Same arguments as populate_upload_queue()
+
+    Returns:
+        int: Number of messages
+    """
+    tile_size = lambda v: args[v + "_tile_size"]
+    range_ = lambda v: range(args[v + '_start'], args[v + '_stop'], tile_size(v))
+
+    tiles = sum(max(0, min(tile_size('z'), args['final_z_stop'] - z)) for z in range_('z'))
+    return len(range_('t')) * len(range_('y')) * len(range_('x')) * tiles
+
+def decode_cursor(args, cursor):
+    """Convert a message index into the tile coordinates of the message
+
+    Messages are ordered by t, z chunk, y, x, and then z tile, the same
+    order used by create_messages()
+
+    Args:
+        args (dict): Same arguments as populate_upload_queue()
+        cursor (int): Index of the message
+
+    Returns:
+        tuple|None: Tuple of (t, z, y, x, tile) start values or None if the
+                    cursor is past the last message
+    """
+    tile_size = lambda v: args[v + "_tile_size"]
+    range_ = lambda v: range(args[v + '_start'], args[v + '_stop'], tile_size(v))
+    num_of_tiles = lambda z: max(0, min(tile_size('z'), args['final_z_stop'] - z))
+
+    ts, zs, ys, xs = range_('t'), range_('z'), range_('y'), range_('x')
+    total = count_messages(args)
+    if cursor >= total:
+        return None
+
+    t_idx, cursor = divmod(cursor, total // len(ts))
+    for z in zs:
+        size = num_of_tiles(z) * len(ys) * len(xs)
+        if cursor < size:
+            break
+        cursor -= size
 
-    msgs = create_messages(args)
+    y_idx, cursor = divmod(cursor, num_of_tiles(z) * len(xs))
+    x_idx, tile_idx = divmod(cursor, num_of_tiles(z))
+    return (ts[t_idx], z, ys[y_idx], xs[x_idx], z + tile_idx)
+
+def encode_cursor(args, t, z, y, x, tile):
+    """Convert the tile coordinates of a message into the message's index
+
+    The inverse of decode_cursor()
+
+    Args:
+        args (dict): Same arguments as populate_upload_queue()
+        t, z, y, x (int): Start values of the chunk
+        tile (int): Z value of the tile
+
+    Returns:
+        int: Index of the message
+    """
+    tile_size = lambda v: args[v + "_tile_size"]
+    range_ = lambda v: range(args[v + '_start'], args[v + '_stop'], tile_size(v))
+    num_of_tiles = lambda z: max(0, min(tile_size('z'), args['final_z_stop'] - z))
+
+    ts, zs, ys, xs = range_('t'), range_('z'), range_('y'), range_('x')
+
+    cursor = ts.index(t) * (count_messages(args) // len(ts))
+    cursor += sum(num_of_tiles(z_) for z_ in zs[:zs.index(z)]) * len(ys) * len(xs)
+    cursor += (ys.index(y) * len(xs) + xs.index(x)) * num_of_tiles(z)
+    return cursor + tile - z
+
+def split_shards(args, count):
+    """Split the job into up to count shards
+
+    The job is split on chunk boundaries along the z or t dimension,
+    whichever has the most chunks.
+
+    Args:
+        args (dict): Same arguments as populate_upload_queue()
+        count (int): Number of shards
+
+    Returns:
+        list: List of argument dictionaries, one for each shard
+    """
+    tile_size = lambda v: args[v + "_tile_size"]
+    range_ = lambda v: range(args[v + '_start'], args[v + '_stop'], tile_size(v))
+
+    dim = 'z' if len(range_('z')) >= len(range_('t')) else 't'
+    starts = list(range_(dim))
+    size = max(1, -(-len(starts) // count)) # ceiling division
+
+    shards = []
+    for i in range(0, len(starts), size):
+        shard = dict(args)
+        shard['shards'] = 1
+        shard[dim + '_start'] = starts[i]
+        if i + size < len(starts):
+            shard[dim + '_stop'] = starts[i + size]
+        shards.append(shard)
+    return shards
+
+def populate_shards(function_name, shards, timeout=LAMBDA_TIMEOUT - SHARD_MARGIN):
+    """Invoke this lambda for each shard and verify the number of messages
+    each shard put into the queue
+
+    Each shard is given a time_limit that leaves it RESUME_MARGIN to finish
+    its last batches and SHARD_MARGIN to start and return, so it returns
+    before the timeout and can be resumed from its cursor.
+
+    Errors are returned instead of raised, so that the progress of the
+    other shards is kept. A shard that failed is returned as pending with
+    its previous cursor, so any messages it sent before failing are sent
+    again when it is retried. A shard that didn't return before the timeout
+    may still be running, and is handled the same way as it is unknown
+    how many messages it sent.
+
+    Args:
+        function_name (str): Name of this lambda
+        shards (list): List of argument dictionaries, one for each shard
+        timeout (int): Number of seconds to wait for the shards to return
+
+    Returns:
+        tuple: Tuple of (number of messages put into the queue,
+                         list of args for the shards that are not finished,
+                         list of shards that enqueued the wrong number of messages)
+    """
+    # Don't let boto3 retry, as a retried shard would enqueue duplicate messages
+    config = Config(read_timeout=timeout,
+                    max_pool_connections=len(shards),
+                    retries={'max_attempts': 0})
+    client = boto3.client('lambda', config=config)
+    time_limit = timeout - RESUME_MARGIN - SHARD_MARGIN
+
+    def invoke(shard):
+        try:
+            payload = dict(shard, time_limit=time_limit)
+            resp = client.invoke(FunctionName=function_name,
+                                 Payload=json.dumps(payload).encode())
+            result = json.loads(resp['Payload'].read().decode())
+            if 'FunctionError' in resp:
+                raise FailedToSendMessages(result)
+            return result, None
+        except ReadTimeoutError:
+            return None, "No result after {} seconds, shard may still be running".format(timeout)
+        except Exception as ex:
+            return None, "{}: {}".format(type(ex).__name__, ex)
+
+    with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+        results = list(pool.map(invoke, shards))
+
+    # Each message before a shard's cursor was sent exactly once, and a
+    # finished shard's cursor is at the end of the shard
     sent = 0
+    pending = []
+    errors = []
+    for shard, (result, error) in zip(shards, results):
+        name = "Shard t {}-{} z {}-{}".format(shard['t_start'], shard['t_stop'],
+                                              shard['z_start'], shard['z_stop'])
+        if error is not None:
+            print("{}: failed: {}".format(name, error))
+            shard = dict(shard)
+            shard['failures'] = shard.get('failures', 0) + 1
+            shard['error'] = "{}: {}".format(name, error)
+            pending.append(shard)
+            continue
+
+        expected = count_messages(shard) if result['finished'] else result['cursor']
+        print("{}: {} of {} messages".format(name, result['sent'], expected))
+        if 'send_error' in result:
+            errors.append("{}: {}".format(name, result['send_error']))
+        elif result['sent'] != expected or result['cursor'] != expected:
+            errors.append("{}: enqueued {} of {} messages".format(name, result['sent'], expected))
+
+        sent += result['sent'] - shard.get('sent', 0)
+        if not result['finished']:
+            result.pop('failures', None)
+            result.pop('error', None)
+            pending.append(result)
+
+    return sent, pending, errors
+
+def send_messages(client, queue_url, msgs, threads=SQS_SEND_THREADS, stop=None):
+    """Send the messages to the queue, with up to the given number of batches
+    being sent at once
+
+    If a batch cannot be sent no more batches are started. Batches already
+    being sent are still sent, but only the messages before the failed batch
+    are counted as enqueued, so that resuming after them doesn't skip any.
 
-    while True:
-        batch = []
-        for i in range(SQS_BATCH_SIZE):
+    Args:
+        client: Boto3 SQS client
+        queue_url (str): URL of the queue
+        msgs (iterator): Iterator of message bodies
+        threads (int): Number of concurrent send_message_batch calls
+        stop (None|callable): Function called before each batch is sent,
+                              if it returns True no more batches are sent
+
+    Returns:
+        tuple: Tuple of (number of messages put into the queue,
+                         number of messages taken from msgs before the
+                         first batch that failed,
+                         error from the first batch that failed or None)
+    """
+    sent = 0
+    sizes = [] # Number of messages in each batch, in the order they were taken
+    failures = {} # Index of each batch that failed to the error
+    pending = {} # Future to the index of its batch
+
+    def collect(futures):
+        nonlocal sent
+        for future in futures:
+            index = pending.pop(future)
             try:
-                batch.append({
-                    'Id': str(i),
-                    'MessageBody': next(msgs),
-                    'DelaySeconds': 0
-                })
-            except StopIteration:
+                sent += future.result()
+            except (FailedToSendMessages, ClientError, BotoCoreError) as ex:
+                print("Batch {} failed: {}".format(index, ex))
+                failures[index] = "{}: {}".format(type(ex).__name__, ex)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        # Only create a few batches ahead of the senders, so that memory
+        # use doesn't depend on the number of messages
+        for batch in pack_batches(msgs):
+            if stop is not None and stop():
                 break
 
-        if len(batch) == 0:
-            break
+            if len(pending) >= threads * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
 
-        retry = 3
-        while retry > 0:
-            resp = queue.send_messages(Entries=batch)
-            sent += len(resp['Successful'])
-
-            if 'Failed' in resp and len(resp['Failed']) > 0:
-                print("Batch failed to enqueue messages")
-                print("Retries left: {}".format(retry))
-                print("Boto3 send_messages response: {}".format(resp))
-                time.sleep(SQS_RETRY_TIMEOUT)
-
-                ids = [f['Id'] for f in resp['Failed']]
-                batch = [b for b in batch if b['Id'] in ids]
-                retry -= 1
-                if retry == 0:
-                    print("Exhausted retry count, stopping")
-                    raise FailedToSendMessages(batch) # SFN will relaunch the activity
-                continue
-            else:
+            if len(failures) > 0:
                 break
 
-    return sent
+            pending[pool.submit(send_batch, client, queue_url, batch)] = len(sizes)
+            sizes.append(len(batch))
+
+        collect(list(pending))
+
+    if len(failures) == 0:
+        return sent, sum(sizes), None
+
+    first = min(failures)
+    return sent, sum(sizes[:first]), failures[first]
+
+def pack_batches(msgs):
+    """Group messages into send_message_batch entries, limited by both the
+    number of entries and the total size of the messages
+
+    Args:
+        msgs (iterator): Iterator of message bodies
+
+    Returns:
+        list: List of lists of send_message_batch entries
+    """
+    batch = []
+    size = 0
+    for msg in msgs:
+        length = len(msg.encode('utf-8'))
+        if len(batch) == SQS_MAX_BATCH_ENTRIES or size + length > SQS_MAX_BATCH_BYTES:
+            yield batch
+            batch = []
+            size = 0
+
+        batch.append({
+            'Id': str(len(batch)),
+            'MessageBody': msg,
+            'DelaySeconds': 0
+        })
+        size += length
+
+    if len(batch) > 0:
+        yield batch
+
+def send_batch(client, queue_url, batch):
+    """Send a batch of messages, retrying any entries that failed with a
+    jittered exponential backoff
+
+    Args:
+        client: Boto3 SQS client
+        queue_url (str): URL of the queue
+        batch (list): List of send_message_batch entries
+
+    Returns:
+        int: Number of messages put into the queue
+
+    Raises:
+        FailedToSendMessages: If the retries are exhausted
+    """
+    sent = 0
+    for retry in range(SQS_RETRIES + 1):
+        if retry > 0:
+            delay = min(SQS_RETRY_MAX_DELAY, SQS_RETRY_DELAY * 2 ** retry)
+            time.sleep(random.uniform(0, delay))
+
+        resp = client.send_message_batch(QueueUrl=queue_url, Entries=batch)
+        sent += len(resp.get('Successful', []))
+
+        failed = resp.get('Failed', [])
+        if len(failed) == 0:
+            return sent
+
+        print("Batch failed to enqueue {} messages".format(len(failed)))
+        print("Retries left: {}".format(SQS_RETRIES - retry))
+        print("Boto3 send_message_batch failures: {}".format(failed))
+
+        ids = [f['Id'] for f in failed]
+        batch = [b for b in batch if b['Id'] in ids]
 
-def create_messages(args):
+    print("Exhausted retry count, stopping")
+    raise FailedToSendMessages(batch) # SFN will relaunch the activity
+
+def message_header(args):
+    """Get the values that are the same for every message in the job
+
+    Args:
+        args (dict): Same arguments as populate_upload_queue()
+
+    Returns:
+        dict: Dictionary of job_id, upload_queue_arn, and ingest_queue_arn
+    """
+    return {
+        'job_id': args['job_id'],
+        'upload_queue_arn': args['upload_queue'],
+        'ingest_queue_arn': args['ingest_queue'],
+    }
+
+def decode_message(body, header=None):
+    """Decode a message created by create_messages()
+
+    The original format is a Json object containing the message_header()
+    values, chunk_key, and tile_key. The compact format is a Json object
+    containing the version ('v'), job_id ('j'), chunk_key ('c'), and
+    tile_key ('t'), and the rest of the job's header values are supplied
+    by the consumer, which already knows the job's queues.
+
+    Args:
+        body (str): Message body
+        header (None|dict): Result of message_header() for the job, required
+                            to decode compact messages
+
+    Returns:
+        dict: Dictionary of job_id, upload_queue_arn, ingest_queue_arn,
+              chunk_key, and tile_key
+
+    Raises:
+        ValueError: If the message version is unknown or the header doesn't
+                    match the message
+    """
+    msg = json.loads(body)
+    version = msg.get('v', 1)
+    if version == 1:
+        return msg
+
+    if version != COMPACT_MESSAGE_VERSION:
+        raise ValueError("Unknown message version {}".format(version))
+    if header is None or header['job_id'] != msg['j']:
+        raise ValueError("Message header for job {} required".format(msg['j']))
+
+    msg = {'chunk_key': msg['c'], 'tile_key': msg['t']}
+    msg.update(header)
+    return msg
+
+def create_messages(args, cursor=0):
     """Create all of the tile messages to be enqueued
 
+    Messages are created a chunk at a time. All of the values that are the
+    same for every message in the job (or every tile in a chunk) are
+    formatted once, leaving just the md5 hash and string formatting for
+    each tile.
+
     Args:
         args (dict): Same arguments as populate_upload_queue()
+        cursor (int): Index of the first message to create
 
     Returns:
         list: List of strings containing Json data
     """
+    for batch in create_message_batches(args, cursor):
+        for msg in batch:
+            yield msg
+
+def create_message_batches(args, cursor=0):
+    """Create all of the tile messages to be enqueued, one list per chunk
+
+    Args:
+        args (dict): Same arguments as populate_upload_queue()
+        cursor (int): Index of the first message to create
 
+    Returns:
+        list: List of lists of strings containing Json data
+    """
     tile_size = lambda v: args[v + "_tile_size"]
     range_ = lambda v: range(args[v + '_start'], args[v + '_stop'], tile_size(v))
 
     # DP NOTE: generic version of
     # BossBackend.encode_chunk_key and BossBackend.encode.tile_key
     # from ingest-client/ingestclient/core/backend.py
-    def hashed_key(*args):
-        base = '&'.join(map(str,args))
-
-        md5 = hashlib.md5()
-        md5.update(base.encode())
-        digest = md5.hexdigest()
-
-        return '&'.join([digest, base])
+    # The key is the md5 of the '&' joined values followed by the values
+    def hashed_key(base):
+        return hashlib.md5(base.encode()).hexdigest() + '&' + base
+
+    # Keys only contain hex digits, numbers, and '&' so they don't need
+    # to be escaped
+    if args.get('compact_messages', False):
+        msg = json.dumps({'v': COMPACT_MESSAGE_VERSION, 'j': args['job_id']},
+                         separators=(',', ':'))
+        msg = msg[:-1].replace('{', '{{').replace('}', '}}')
+        msg += ',"c":"{}","t":"{}"}}'
+    else:
+        msg = json.dumps(message_header(args))
+        msg = msg[:-1].replace('{', '{{').replace('}', '}}')
+        msg += ', "chunk_key": "{}", "tile_key": "{}"}}'
+
+    project = '&'.join(map(str, list(args['project_info'][:3]) + [args['resolution']]))
+
+    xs = [(x, x // tile_size('x')) for x in range_('x')]
+    ys = [(y, y // tile_size('y')) for y in range_('y')]
+
+    start = decode_cursor(args, cursor) if cursor else None
+    if cursor and start is None:
+        return
 
     for t in range_('t'):
         for z in range_('z'):
-            for y in range_('y'):
-                for x in range_('x'):
-                    chunk_x = int(x/tile_size('x'))
-                    chunk_y = int(y/tile_size('y'))
-                    chunk_z = int(z/tile_size('z'))
-
-                    num_of_tiles = min(tile_size('z'), args['final_z_stop'] - z)
-
-                    chunk_key = hashed_key(num_of_tiles,
-                                           args['project_info'][0],
-                                           args['project_info'][1],
-                                           args['project_info'][2],
-                                           args['resolution'],
-                                           chunk_x,
-                                           chunk_y,
-                                           chunk_z,
-                                           t)
-
-                    for tile in range(z, z + num_of_tiles):
-                        tile_key = hashed_key(args['project_info'][0],
-                                              args['project_info'][1],
-                                              args['project_info'][2],
-                                              args['resolution'],
-                                              chunk_x,
-                                              chunk_y,
-                                              tile,
-                                              t)
-
-                        msg = {
-                            'job_id': args['job_id'],
-                            'upload_queue_arn': args['upload_queue'],
-                            'ingest_queue_arn': args['ingest_queue'],
-                            'chunk_key': chunk_key,
-                            'tile_key': tile_key,
-                        }
-
-                        yield json.dumps(msg)
+            if start is not None and (t, z) < start[:2]:
+                continue
 
+            chunk_z = z // tile_size('z')
+            num_of_tiles = min(tile_size('z'), args['final_z_stop'] - z)
+
+            chunk_fmt = '{}&{}&{{}}&{{}}&{}&{}'.format(num_of_tiles, project, chunk_z, t)
+            tile_fmt = project + '&{}&{}&{}&' + str(t)
+
+            for y, chunk_y in ys:
+                for x, chunk_x in xs:
+                    tiles = range(z, z + num_of_tiles)
+                    if start is not None:
+                        if (t, z, y, x) < start[:4]:
+                            continue
+                        # Resume partway through the first chunk
+                        tiles = range(start[4], z + num_of_tiles)
+                        start = None
+
+                    chunk_key = hashed_key(chunk_fmt.format(chunk_x, chunk_y))
+                    yield [msg.format(chunk_key,
+                                      hashed_key(tile_fmt.format(chunk_x, chunk_y, tile)))
+                           for tile in tiles]
@@ -27,9 +27,14 @@ Author:
 import os
 import time
 import json
-import re
 import sys
+import copy
+import functools
+import threading
+import weakref
+import jmespath
 from boto3.session import Session
+from botocore.config import Config
 
 from . import constants as const
 from . import hosts
@@ -57,6 +62,395 @@ def use_iam_role():
     session = Session(region_name='us-east-1')
     return session 
 
+# Size of the HTTP connection pool of each shared client, allowing multiple
+# threads to use the same client without waiting for a free connection
+CLIENT_POOL_CONNECTIONS = 25
+
+_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+def _pooled(session, key, create):
+    with _clients_lock:
+        pool = _clients.get(session)
+        if pool is None:
+            pool = {}
+            _clients[session] = pool
+
+        # DP NOTE: Creation is done while holding the lock, as Boto3 sessions
+        #          are not thread safe
+        if key not in pool:
+            pool[key] = create()
+        return pool[key]
+
+def get_client(session, service, region=None):
+    """Get the shared Boto3 client for the given session, service, and region.
+
+    Creating a client requires loading the service model, so clients are
+    created once and reused. Reusing the client also reuses its pool of
+    HTTP keep-alive connections to AWS.
+
+    Boto3 clients are thread safe, so the same client is returned to all threads.
+
+    Args:
+        session (Session) : Boto3 session used to create the client
+        service (string) : Name of the AWS service
+        region (None|string) : AWS region of the client. If None, the session's
+                               region is used
+
+    Returns:
+        (Client) : Boto3 client
+    """
+    config = Config(max_pool_connections = CLIENT_POOL_CONNECTIONS)
+    create = lambda: session.client(service, region_name = region, config = config)
+    return _pooled(session, ('client', service, region), create)
+
+def get_resource(session, service, region=None):
+    """Get the shared Boto3 resource for the given session, service, and region.
+
+    Boto3 resources are not thread safe, so each thread receives its own resource.
+
+    Args:
+        session (Session) : Boto3 session used to create the resource
+        service (string) : Name of the AWS service
+        region (None|string) : AWS region of the resource. If None, the session's
+                               region is used
+
+    Returns:
+        (ServiceResource) : Boto3 resource
+    """
+    config = Config(max_pool_connections = CLIENT_POOL_CONNECTIONS)
+    create = lambda: session.resource(service, region_name = region, config = config)
+    return _pooled(session, ('resource', service, region, threading.get_ident()), create)
+
+# Number of seconds a cached lookup result is considered valid
+LOOKUP_TTL = 5 * 60
+
+class LookupCache(object):
+    """Thread safe cache of AWS lookup results for a single Boto3 session.
+
+    Entries are keyed by the lookup function name and the arguments it was
+    called with and expire after ttl seconds.
+
+    The number of calls, cache hits, and the total time spent in each lookup
+    function are recorded in stats.
+    """
+    def __init__(self, ttl = LOOKUP_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, hit, elapsed):
+        """Record a call to a lookup function.
+
+        Args:
+            name (string) : Name of the lookup function
+            hit (bool) : If the result came from the cache
+            elapsed (float) : Number of seconds the call took
+        """
+        with self.lock:
+            stats = self.stats.setdefault(name, {'calls': 0, 'hits': 0, 'time': 0.0})
+            stats['calls'] += 1
+            stats['hits'] += int(hit)
+            stats['time'] += elapsed
+
+    def get(self, key):
+        """Get a cached value.
+
+        Args:
+            key (tuple) : Cache key
+
+        Returns:
+            (tuple) : Tuple of (bool, object) with whether the key was found
+                      and the cached value
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return (False, None)
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return (False, None)
+
+            return (True, value)
+
+    def put(self, key, value):
+        """Store a value in the cache.
+
+        Args:
+            key (tuple) : Cache key
+            value (object) : Value to cache
+        """
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, *names):
+        """Remove cached values.
+
+        Args:
+            names (list[string]) : Names of the lookup functions to remove cached
+                                   values for. If no names are given all cached
+                                   values are removed
+        """
+        with self.lock:
+            if len(names) == 0:
+                self.entries.clear()
+            else:
+                for key in list(self.entries.keys()):
+                    if key[0] in names:
+                        del self.entries[key]
+
+_lookup_caches = weakref.WeakKeyDictionary()
+_lookup_caches_lock = threading.Lock()
+
+def lookup_cache(session):
+    """Get the LookupCache bound to the given session, creating it if needed.
+
+    Args:
+        session (Session) : Boto3 session the cache is bound to
+
+    Returns:
+        (LookupCache) : Lookup cache for the session
+    """
+    with _lookup_caches_lock:
+        cache = _lookup_caches.get(session)
+        if cache is None:
+            cache = LookupCache()
+            _lookup_caches[session] = cache
+        return cache
+
+def invalidate_lookups(session, *names):
+    """Remove cached lookup results for the given session.
+
+    Should be called after an action that changes AWS resources that may have
+    already been looked up.
+
+    Args:
+        session (Session|None) : Boto3 session the cache is bound to
+                                 If session is None nothing is done
+        names (list[string]) : Names of the lookup functions to invalidate
+                               If no names are given all lookups are invalidated
+    """
+    if session is None:
+        return
+
+    lookup_cache(session).invalidate(*names)
+
+# Lookups of the resources that CloudFormation stacks create, replace, and delete
+STACK_LOOKUPS = ('inventory_lookup', 'rds_lookup', 'vpc_id_lookup', 'subnet_id_lookup',
+                 'sg_lookup_all', 'sg_lookup', 'rt_lookup', 'peering_lookup',
+                 'cloudfront_public_lookup', 'elb_public_lookup', 'lb_lookup',
+                 'sqs_lookup_url', 'instance_profile_arn_lookup',
+                 '_topic_index', '_role_index', '_lambda_index')
+
+def cached_lookup(func):
+    """Decorator that memoizes the results of a lookup function in the
+    LookupCache bound to the session passed as the first argument.
+
+    Only results that located something (are not None / False / empty) are
+    cached, so that looking up a resource that a stack is in the process of
+    creating will still query AWS. Each caller receives a copy of the cached
+    value, so it is safe for callers to modify the result.
+
+    If the session is None or the arguments cannot be hashed the lookup
+    function is called without caching.
+    """
+    @functools.wraps(func)
+    def wrapper(session, *args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            session = None # Cannot cache, just do the lookup
+
+        if session is None:
+            return func(session, *args, **kwargs)
+
+        start = time.monotonic()
+        cache = lookup_cache(session)
+        hit, value = cache.get(key)
+        if not hit:
+            value = func(session, *args, **kwargs)
+            if value:
+                cache.put(key, value)
+        value = copy.deepcopy(value)
+        cache.record(func.__name__, hit, time.monotonic() - start)
+        return value
+    return wrapper
+
+def paginate(client, operation, key, **kwargs):
+    """Lazily iterate over all of the items returned by a list / describe call.
+
+    If the operation supports pagination a botocore paginator is used and
+    pages are only requested as the items from the previous page are consumed,
+    so a caller that stops iterating once it locates a match doesn't request
+    the remaining pages. If the operation doesn't support pagination a single
+    request is made.
+
+    Args:
+        client (Client) : Boto3 client to make the calls with
+        operation (string) : Name of the client method
+        key (string) : JMESPath expression selecting the list of items in each
+                       response (example: 'Reservations[].Instances[]')
+        kwargs : Arguments for the operation
+
+    Returns:
+        (generator) : Generator yielding each item
+    """
+    expression = jmespath.compile(key)
+    if client.can_paginate(operation):
+        pages = client.get_paginator(operation).paginate(**kwargs)
+    else:
+        pages = [getattr(client, operation)(**kwargs)]
+
+    for page in pages:
+        items = expression.search(page)
+        for item in items or []:
+            yield item
+
+def first(items):
+    """Get the first item from an iterable or None if it is empty"""
+    return next(iter(items), None)
+
+class InstanceInventory(object):
+    """Snapshot of EC2 instances, indexed by Name tag, instance id, availability
+    zone, and instance state.
+
+    The snapshot is read only, so copies (made by cached_lookup) share the
+    same data.
+    """
+    def __init__(self, instances):
+        """InstanceInventory constructor
+
+        Args:
+            instances (list) : List of instance dictionaries, as returned by
+                               EC2 describe_instances
+        """
+        self.by_id = {}
+        self.by_name = {}
+        self.by_az = {}
+        self.by_state = {}
+
+        for instance in sorted(instances, key = lambda i: i['InstanceId']):
+            tag = _find(instance.get('Tags', []), lambda x: x['Key'] == 'Name')
+            name = None if tag is None else tag['Value']
+            az = instance.get('Placement', {}).get('AvailabilityZone')
+            state = instance['State']['Name']
+
+            self.by_id[instance['InstanceId']] = instance
+            self.by_name.setdefault(name, []).append(instance)
+            self.by_az.setdefault(az, []).append(instance)
+            self.by_state.setdefault(state, []).append(instance)
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __len__(self):
+        # An empty snapshot is not cached by cached_lookup, as the VPC may
+        # not have been populated yet
+        return len(self.by_id)
+
+    @staticmethod
+    def _filter(instances, state):
+        if state is None:
+            return list(instances)
+        return [i for i in instances if i['State']['Name'] == state]
+
+    def named(self, hostname, state = None):
+        """Get the instances with the given Name tag.
+
+        Args:
+            hostname (string) : Name tag value
+            state (None|string) : Only return instances in the given state
+
+        Returns:
+            (list) : List of instance dictionaries, sorted by InstanceId
+        """
+        return self._filter(self.by_name.get(hostname, []), state)
+
+    def in_az(self, az, state = None):
+        """Get the instances in the given availability zone.
+
+        Args:
+            az (string) : Availability zone name
+            state (None|string) : Only return instances in the given state
+
+        Returns:
+            (list) : List of instance dictionaries, sorted by InstanceId
+        """
+        return self._filter(self.by_az.get(az, []), state)
+
+@cached_lookup
+def inventory_lookup(session, vpc_id = None):
+    """Take a snapshot of all of the EC2 instances in a VPC.
+
+    One (paginated) describe_instances pass is made and the results are
+    indexed so that all instance lookups can be answered from memory.
+
+    Args:
+        session (Session) : Boto3 session used to lookup information in AWS
+        vpc_id (None|string) : VPC ID of the VPC to snapshot
+                               If None, all instances in the region are included
+
+    Returns:
+        (InstanceInventory) : Snapshot of the instances
+    """
+    filters = []
+    if vpc_id is not None:
+        filters.append({"Name": "vpc-id", "Values": [vpc_id]})
+
+    client = get_client(session, 'ec2')
+    instances = paginate(client, 'describe_instances', 'Reservations[].Instances[]', Filters=filters)
+
+    return InstanceInventory(instances)
+
+def hostname_inventory(session, hostname):
+    """Get the snapshot of EC2 instances for the VPC the given hostname is in.
+
+    The VPC domain is the last two parts of the hostname (<vpc>.<tld>). If
+    the VPC cannot be located a snapshot of the whole region is used.
+
+    Args:
+        session (Session) : Boto3 session used to lookup information in AWS
+        hostname (string) : Hostname of an EC2 instance
+
+    Returns:
+        (InstanceInventory) : Snapshot of the instances
+    """
+    vpc_domain = '.'.join(hostname.split('.')[-2:])
+    vpc_id = vpc_id_lookup(session, vpc_domain)
+    return inventory_lookup(session, vpc_id)
+
+def hostname_instances(session, hostname, state = None):
+    """Get the EC2 instances with the given hostname.
+
+    The instances are taken from the snapshot of the hostname's VPC. If the
+    snapshot doesn't contain a matching instance (the instance was launched
+    after the snapshot was taken or the hostname doesn't name its VPC) the
+    instances are requested directly.
+
+    Args:
+        session (Session) : Boto3 session used to lookup information in AWS
+        hostname (string) : Hostname of the EC2 instances
+        state (None|string) : Only return instances in the given state
+
+    Returns:
+        (list) : List of instance dictionaries, sorted by InstanceId
+    """
+    instances = hostname_inventory(session, hostname).named(hostname, state)
+    if len(instances) > 0:
+        return instances
+
+    filters = [{"Name": "tag:Name", "Values": [hostname]}]
+    if state is not None:
+        filters.append({"Name": "instance-state-name", "Values": [state]})
+
+    client = get_client(session, 'ec2')
+    instances = paginate(client, 'describe_instances', 'Reservations[].Instances[]', Filters=filters)
+    return sorted(instances, key = lambda i: i['InstanceId'])
+
 def machine_lookup_all(session, hostname, public_ip = True):
     """Lookup all of the IP addresses for a given AWS instance name.
 
@@ -72,19 +466,14 @@ def machine_lookup_all(session, hostname, public_ip = True):
     Returns:
         (list) : List of IP addresses
     """
-    client = session.client('ec2')
-    response = client.describe_instances(Filters=[{"Name":"tag:Name", "Values":[hostname]},
-                                                  {"Name":"instance-state-name", "Values":["running"]}])
+    instances = hostname_instances(session, hostname, 'running')
 
     addresses = []
-    items = response['Reservations']
-    if len(items) > 0:
-        for i in items:
-            item = i['Instances'][0]
-            if 'PublicIpAddress' in item and public_ip:
-                addresses.append(item['PublicIpAddress'])
-            elif 'PrivateIpAddress' in item and not public_ip:
-                addresses.append(item['PrivateIpAddress'])
+    for item in instances:
+        if 'PublicIpAddress' in item and public_ip:
+            addresses.append(item['PublicIpAddress'])
+        elif 'PrivateIpAddress' in item and not public_ip:
+            addresses.append(item['PrivateIpAddress'])
     return addresses
 
 def machine_lookup(session, hostname, public_ip = True):
@@ -114,22 +503,16 @@ def machine_lookup(session, hostname, public_ip = True):
     except:
         idx = 0
 
-    client = session.client('ec2')
-    response = client.describe_instances(Filters=[{"Name":"tag:Name", "Values":[hostname]},
-                                                  {"Name":"instance-state-name", "Values":["running"]}])
-
-    item = response['Reservations']
+    item = hostname_instances(session, hostname, 'running')
     if len(item) == 0:
         print("Could not find IP address for '{}'".format(hostname))
         return None
     else:
-        item.sort(key = lambda i: i['Instances'][0]["InstanceId"])
-
         if len(item) <= idx:
             print("Could not find IP address for '{}' index '{}'".format(hostname, idx))
             return None
         else:
-            item = item[idx]['Instances'][0]
+            item = item[idx]
             if 'PublicIpAddress' in item and public_ip:
                 return item['PublicIpAddress']
             elif 'PrivateIpAddress' in item and not public_ip:
@@ -138,6 +521,7 @@ def machine_lookup(session, hostname, public_ip = True):
                 print("Could not find IP address for '{}'".format(hostname))
                 return None
 
+@cached_lookup
 def rds_lookup(session, hostname):
     """Lookup the public DNS for a given AWS RDS instance name.
 
@@ -151,7 +535,7 @@ def rds_lookup(session, hostname):
         (string|None) : Public DNS or None if one could not be located.
     """
 
-    client = session.client('rds')
+    client = get_client(session, 'rds')
     response = client.describe_db_instances(DBInstanceIdentifier=hostname)
 
     item = response['DBInstances']
@@ -182,21 +566,19 @@ def asg_restart(session, hostname, timeout, callback=None):
     """Terminate all of the instances for an ASG, with the given timeout between
     each termination.
     """
-    client = session.client('ec2')
-    resource = session.resource('ec2')
-    response = client.describe_instances(Filters=[{"Name":"tag:Name", "Values":[hostname]},
-                                                  {"Name":"instance-state-name", "Values":["running"]}])
-
-    for reservation in response['Reservations']:
-        for instance in reservation['Instances']:
-            id = instance['InstanceId']
-            print("Terminating {} instance {}".format(hostname, id))
-            resource.Instance(id).terminate()
-            print("Sleeping for {} minutes".format(timeout/60.0))
-            time.sleep(timeout)
-
-            if callback is not None:
-                callback()
+    resource = get_resource(session, 'ec2')
+    instances = hostname_instances(session, hostname, 'running')
+
+    for instance in instances:
+        id = instance['InstanceId']
+        print("Terminating {} instance {}".format(hostname, id))
+        resource.Instance(id).terminate()
+        invalidate_lookups(session, 'inventory_lookup')
+        print("Sleeping for {} minutes".format(timeout/60.0))
+        time.sleep(timeout)
+
+        if callback is not None:
+            callback()
 
 def asg_name_lookup(session, hostname):
     """Lookup the Group name for the ASG creating the EC2 instances with the given hostname
@@ -212,18 +594,21 @@ def asg_name_lookup(session, hostname):
     if session is None:
         return None
 
-    client = session.client('autoscaling')
-    response = client.describe_auto_scaling_groups()
-    if len(response['AutoScalingGroups']) == 0:
-        return None
-    else:
-        # DP NOTE: Unfortunatly describe_auto_scaling_groups() doesn't allow filtering results
-        for g in response['AutoScalingGroups']:
-            t = _find(g['Tags'], lambda x: x['Key'] == 'Name')
-            if t and t['Value'] == hostname:
-                return g['AutoScalingGroupName']
-        return None
+    # Instances launched by an ASG are tagged with the ASG's name
+    for instance in hostname_inventory(session, hostname).named(hostname):
+        t = _find(instance.get('Tags', []), lambda x: x['Key'] == 'aws:autoscaling:groupName')
+        if t:
+            return t['Value']
+
+    client = get_client(session, 'autoscaling')
+    # DP NOTE: Unfortunatly describe_auto_scaling_groups() doesn't allow filtering results
+    for g in paginate(client, 'describe_auto_scaling_groups', 'AutoScalingGroups'):
+        t = _find(g['Tags'], lambda x: x['Key'] == 'Name')
+        if t and t['Value'] == hostname:
+            return g['AutoScalingGroupName']
+    return None
 
+@cached_lookup
 def vpc_id_lookup(session, vpc_domain):
     """Lookup the Id for the VPC with the given domain name.
 
@@ -238,14 +623,16 @@ def vpc_id_lookup(session, vpc_domain):
     if session is None:
         return None
 
-    client = session.client('ec2')
-    response = client.describe_vpcs(Filters=[{"Name": "tag:Name", "Values": [vpc_domain]}])
-    if len(response['Vpcs']) == 0:
+    client = get_client(session, 'ec2')
+    vpc = first(paginate(client, 'describe_vpcs', 'Vpcs',
+                         Filters=[{"Name": "tag:Name", "Values": [vpc_domain]}]))
+    if vpc is None:
         return None
     else:
-        return response['Vpcs'][0]['VpcId']
+        return vpc['VpcId']
 
 
+@cached_lookup
 def subnet_id_lookup(session, subnet_domain):
     """Lookup the Id for the Subnet with the given domain name.
 
@@ -260,13 +647,15 @@ def subnet_id_lookup(session, subnet_domain):
     if session is None:
         return None
 
-    client = session.client('ec2')
-    response = client.describe_subnets(Filters=[{"Name": "tag:Name", "Values": [subnet_domain]}])
-    if len(response['Subnets']) == 0:
+    client = get_client(session, 'ec2')
+    subnet = first(paginate(client, 'describe_subnets', 'Subnets',
+                            Filters=[{"Name": "tag:Name", "Values": [subnet_domain]}]))
+    if subnet is None:
         return None
     else:
-        return response['Subnets'][0]['SubnetId']
+        return subnet['SubnetId']
 
+@cached_lookup
 def azs_lookup(session, lambda_compatible_only=False):
     """Lookup all of the Availablity Zones for the connected region.
 
@@ -280,7 +669,7 @@ def azs_lookup(session, lambda_compatible_only=False):
     if session is None:
         return []
 
-    client = session.client('ec2')
+    client = get_client(session, 'ec2')
     response = client.describe_availability_zones()
     # SH Removing Hack as subnet A is already in Production and causes issues trying to delete
     #    We will strip out subnets A and C when creating the lambdas.
@@ -329,17 +718,38 @@ def ami_lookup(session, ami_name, version = None):
     else:
         ami_search = ami_name
 
-    client = session.client('ec2')
-    response = client.describe_images(Filters=[{"Name": "name", "Values": [ami_search]}])
-    if len(response['Images']) == 0:
+    image = _image_lookup(session, ami_search)
+    if image is None:
         if specific:
             print("Could not locate AMI '{}', trying to find the latest '{}' AMI".format(ami_search, ami_name))
             return ami_lookup(session, ami_name, version = "latest")
         else:
             return None
     else:
-        response['Images'].sort(key=lambda x: x["CreationDate"], reverse=True)
-        image = response['Images'][0]
+        return image
+
+@cached_lookup
+def _image_lookup(session, ami_search):
+    """Lookup the Id for the newest AMI matching the given name search.
+
+    Separate from ami_lookup() so that the cached result doesn't depend on the
+    AMI_VERSION environmental variable.
+
+    Args:
+        session (Session) : Boto3 session used to lookup information in AWS
+        ami_search (string) : Name of AMI to lookup, may contain wildcards
+
+    Returns:
+        (tuple|None) : Tuple of strings (AMI ID, Commit hash of AMI build) or None
+                       if AMI could not be located
+    """
+    client = get_client(session, 'ec2')
+    images = paginate(client, 'describe_images', 'Images',
+                      Filters=[{"Name": "name", "Values": [ami_search]}])
+    image = max(images, key=lambda x: x["CreationDate"], default=None)
+    if image is None:
+        return None
+    else:
         ami = image['ImageId']
         tag = _find(image.get('Tags', []), lambda x: x["Key"] == "Commit")
         commit = None if tag is None else tag["Value"]
@@ -357,6 +767,7 @@ class NoneDict(dict):
         else:
             return super().__getitem__(key)
 
+@cached_lookup
 def sg_lookup_all(session, vpc_id):
     """Lookup the Ids for all of the VPC Security Groups.
 
@@ -373,21 +784,20 @@ def sg_lookup_all(session, vpc_id):
     if session is None:
         return NoneDict()
 
-    client = session.client('ec2')
-    response = client.describe_security_groups(Filters=[{"Name": "vpc-id", "Values": [vpc_id]}])
+    client = get_client(session, 'ec2')
+    response = paginate(client, 'describe_security_groups', 'SecurityGroups',
+                        Filters=[{"Name": "vpc-id", "Values": [vpc_id]}])
 
-    if len(response['SecurityGroups']) == 0:
-        return NoneDict()
-    else:
-        sgs = NoneDict()
-        for sg in response['SecurityGroups']:
-            key = _find(sg.get('Tags', []), lambda x: x["Key"] == "Name")
-            if key:
-                key = key['Value']
-            sgs[key] = sg['GroupId']
+    sgs = NoneDict()
+    for sg in response:
+        key = _find(sg.get('Tags', []), lambda x: x["Key"] == "Name")
+        if key:
+            key = key['Value']
+        sgs[key] = sg['GroupId']
 
-        return sgs
+    return sgs
 
+@cached_lookup
 def sg_lookup(session, vpc_id, group_name):
     """Lookup the Id for the VPC Security Group with the given name.
 
@@ -403,15 +813,17 @@ def sg_lookup(session, vpc_id, group_name):
     if session is None:
         return None
 
-    client = session.client('ec2')
-    response = client.describe_security_groups(Filters=[{"Name": "vpc-id", "Values": [vpc_id]},
-                                                        {"Name": "tag:Name", "Values": [group_name]}])
+    client = get_client(session, 'ec2')
+    sg = first(paginate(client, 'describe_security_groups', 'SecurityGroups',
+                        Filters=[{"Name": "vpc-id", "Values": [vpc_id]},
+                                 {"Name": "tag:Name", "Values": [group_name]}]))
 
-    if len(response['SecurityGroups']) == 0:
+    if sg is None:
         return None
     else:
-        return response['SecurityGroups'][0]['GroupId']
+        return sg['GroupId']
 
+@cached_lookup
 def rt_lookup(session, vpc_id, rt_name):
     """Lookup the Id for the VPC Route Table with the given name.
 
@@ -427,14 +839,15 @@ def rt_lookup(session, vpc_id, rt_name):
     if session is None:
         return None
 
-    client = session.client('ec2')
-    response = client.describe_route_tables(Filters=[{"Name": "vpc-id", "Values": [vpc_id]},
-                                                     {"Name": "tag:Name", "Values": [rt_name]}])
+    client = get_client(session, 'ec2')
+    rt = first(paginate(client, 'describe_route_tables', 'RouteTables',
+                        Filters=[{"Name": "vpc-id", "Values": [vpc_id]},
+                                 {"Name": "tag:Name", "Values": [rt_name]}]))
 
-    if len(response['RouteTables']) == 0:
+    if rt is None:
         return None
     else:
-        return response['RouteTables'][0]['RouteTableId']
+        return rt['RouteTableId']
 
 
 def rt_name_default(session, vpc_id, new_rt_name):
@@ -455,11 +868,12 @@ def rt_name_default(session, vpc_id, new_rt_name):
     Returns:
         None
     """
-    client = session.client('ec2')
-    response = client.describe_route_tables(Filters=[{"Name": "vpc-id", "Values": [vpc_id]}])
+    client = get_client(session, 'ec2')
+    response = paginate(client, 'describe_route_tables', 'RouteTables',
+                        Filters=[{"Name": "vpc-id", "Values": [vpc_id]}])
 
     rt_id = None
-    for rt in response['RouteTables']:
+    for rt in response:
         nt = _find(rt['Tags'], lambda x: x['Key'] == 'Name')
         if nt is None or nt['Value'] == '':
             rt_id = rt['RouteTableId']
@@ -468,11 +882,13 @@ def rt_name_default(session, vpc_id, new_rt_name):
         print("Could not locate unnamed default route table")
         return
 
-    resource = session.resource('ec2')
+    resource = get_resource(session, 'ec2')
     rt = resource.RouteTable(rt_id)
     response = rt.create_tags(Tags=[{"Key": "Name", "Value": new_rt_name}])
+    invalidate_lookups(session, 'rt_lookup')
 
 
+@cached_lookup
 def peering_lookup(session, from_id, to_id, owner_id=None):
     """Lookup the Id for the Peering Connection between the two VPCs.
 
@@ -497,24 +913,28 @@ def peering_lookup(session, from_id, to_id, owner_id=None):
     if owner_id is None:
         owner_id = get_account_id_from_session(session)
 
-    client = session.client('ec2')
-    response = client.describe_vpc_peering_connections(Filters=[{"Name": "requester-vpc-info.vpc-id",
-                                                                 "Values": [from_id]},
-                                                                {"Name": "requester-vpc-info.owner-id",
-                                                                 "Values": [owner_id]},
-                                                                {"Name": "accepter-vpc-info.vpc-id",
-                                                                 "Values": [to_id]},
-                                                                {"Name": "accepter-vpc-info.owner-id",
-                                                                 "Values": [owner_id]},
-                                                                {"Name": "status-code", "Values": ["active"]},
-                                                                ])
-
-    if len(response['VpcPeeringConnections']) == 0:
+    client = get_client(session, 'ec2')
+    peering = first(paginate(client, 'describe_vpc_peering_connections', 'VpcPeeringConnections',
+                             Filters=[{"Name": "requester-vpc-info.vpc-id",
+                                       "Values": [from_id]},
+                                      {"Name": "requester-vpc-info.owner-id",
+                                       "Values": [owner_id]},
+                                      {"Name": "accepter-vpc-info.vpc-id",
+                                       "Values": [to_id]},
+                                      {"Name": "accepter-vpc-info.owner-id",
+                                       "Values": [owner_id]},
+                                      {"Name": "status-code", "Values": ["active"]},
+                                      ]))
+
+    if peering is None:
         return None
     else:
-        return response['VpcPeeringConnections'][0]['VpcPeeringConnectionId']
+        return peering['VpcPeeringConnectionId']
 
 
+_keypairs = weakref.WeakKeyDictionary()
+_keypairs_lock = threading.Lock()
+
 def keypair_lookup(session):
     """Lookup the names of valid Key Pair.
 
@@ -522,6 +942,10 @@ def keypair_lookup(session):
     keypair name is returned. Else all of the keypairs are printed to stdout and
     the user is prompted to select which keypair to use.
 
+    The selected keypair is remembered for the life of the session, it is not
+    affected by LOOKUP_TTL or invalidate_lookups(), so the user is prompted
+    at most once. Other threads wait while the user is being prompted.
+
     Args:
         session (Session|None) : Boto3 session used to lookup information in AWS
                                  If session is None no lookup is performed
@@ -532,7 +956,16 @@ def keypair_lookup(session):
     if session is None:
         return None
 
-    client = session.client('ec2')
+    with _keypairs_lock:
+        keypair = _keypairs.get(session)
+        if keypair is None:
+            keypair = _keypair_select(session)
+            if keypair is not None:
+                _keypairs[session] = keypair
+        return keypair
+
+def _keypair_select(session):
+    client = get_client(session, 'ec2')
     response = client.describe_key_pairs()
 
     # If SSH_KEY exists and points to a valid Key Pair, use it
@@ -564,6 +997,8 @@ def keypair_lookup(session):
 def instanceid_lookup(session, hostname):
     """Look up instance id by hostname (instance name).
 
+    Running instances are preferred over instances in other states.
+
     Args:
         session (Session|None) : Boto3 session used to lookup information in AWS
                                  If session is None no lookup is performed
@@ -575,27 +1010,129 @@ def instanceid_lookup(session, hostname):
     if session is None:
         return None
 
-    client = session.client('ec2')
-    response = client.describe_instances(
-        Filters=[{"Name": "tag:Name", "Values": [hostname]}])
-
-    item = response['Reservations']
+    item = hostname_instances(session, hostname, 'running') or hostname_instances(session, hostname)
     if len(item) == 0:
         return None
     else:
-        item = item[0]['Instances']
-        if len(item) == 0:
-            return None
-        else:
-            item = item[0]
-            if 'InstanceId' in item:
-                return item['InstanceId']
-            return None
+        return item[0]['InstanceId']
+
+
+class ArnIndex(object):
+    """Index of resource name to ARN, built from a single listing of the resources.
+
+    The index is read only, so copies (made by cached_lookup) share the
+    same data.
+    """
+    def __init__(self, items):
+        """ArnIndex constructor
+
+        Args:
+            items (iterable) : Iterable of (name, arn) tuples
+                               If a name is repeated the first ARN is kept
+        """
+        self.arns = {}
+        for name, arn in items:
+            self.arns.setdefault(name, arn)
+
+    def __deepcopy__(self, memo):
+        return self
 
+    def __len__(self):
+        return len(self.arns)
+
+    def __bool__(self):
+        # An empty index is still a valid lookup result to cache
+        return True
+
+    def get(self, name):
+        """Get the ARN for the given name or None if the name is not indexed"""
+        return self.arns.get(name)
+
+class CertificateIndex(ArnIndex):
+    """Index of ACM certificate domain name to certificate ARN.
+
+    Exact domain names are kept in a dictionary and wildcard domains
+    (like "*.thebossdev.io") are kept in a trie of the reversed domain labels,
+    so resolving a domain name takes at most one step per label.
+    """
+    WILDCARD = '*'
+
+    def __init__(self, certs):
+        """CertificateIndex constructor
+
+        Args:
+            certs (iterable) : Iterable of (domain name, arn) tuples
+                               If a domain is repeated the first ARN is kept
+        """
+        self.arns = {}
+        self.wildcards = {}
+        for domain, arn in certs:
+            labels = domain.split('.')
+            if labels[0] == self.WILDCARD:
+                node = self.wildcards
+                for label in reversed(labels[1:]):
+                    node = node.setdefault(label, {})
+                node.setdefault(self.WILDCARD, arn)
+            else:
+                self.arns.setdefault(domain, arn)
+
+    def get(self, domain_name):
+        """Get the ARN of the certificate that covers the given domain name
+
+        An exact match is preferred, otherwise the most specific wildcard
+        certificate is used. A wildcard covers one or more labels, so
+        "*.thebossdev.io" covers "api.thebossdev.io" but not "thebossdev.io".
+
+        Args:
+            domain_name (string) : Domain name to resolve
+
+        Returns:
+            (string|None) : Certificate ARN or None if no certificate covers the domain
+        """
+        if domain_name in self.arns:
+            return self.arns[domain_name]
+
+        arn = None
+        node = self.wildcards
+        # The first label is never part of a wildcard's suffix
+        for label in reversed(domain_name.split('.')[1:]):
+            node = node.get(label)
+            if node is None:
+                break
+            arn = node.get(self.WILDCARD, arn)
+        return arn
+
+@cached_lookup
+def _certificate_index(session):
+    client = get_client(session, 'acm')
+    certs = paginate(client, 'list_certificates', 'CertificateSummaryList[].[DomainName, CertificateArn]')
+    return CertificateIndex(certs)
+
+@cached_lookup
+def _topic_index(session):
+    client = get_client(session, 'sns')
+    arns = paginate(client, 'list_topics', 'Topics[].TopicArn')
+    return ArnIndex((arn.split(':').pop(), arn) for arn in arns)
+
+@cached_lookup
+def _role_index(session):
+    client = get_client(session, 'iam')
+    roles = paginate(client, 'list_roles', 'Roles[].[RoleName, Arn]')
+    return ArnIndex(roles)
+
+@cached_lookup
+def _lambda_index(session):
+    client = get_client(session, 'lambda')
+    functions = paginate(client, 'list_functions', 'Functions[].[FunctionName, FunctionArn]')
+    return ArnIndex(functions)
 
 def cert_arn_lookup(session, domain_name):
     """Looks up the ARN for a SSL Certificate
 
+    The certificates are listed once per session and indexed, see CertificateIndex.
+    If no indexed certificate covers the domain name the certificates are
+    listed again, in case the certificate was issued after the listing.
+
     Args:
         session (Session|None) : Boto3 session used to lookup information in AWS
                                  If session is None no lookup is performed
@@ -607,16 +1144,12 @@ def cert_arn_lookup(session, domain_name):
     if session is None:
         return None
 
-    client = session.client('acm')
-    response = client.list_certificates()
-    for certs in response['CertificateSummaryList']:
-        if certs['DomainName'] == domain_name:
-            return certs['CertificateArn']
-        if certs['DomainName'].startswith('*'):    # if it is a wildcard domain like "*.thebossdev.io"
-            cert_name = certs['DomainName'][1:] + '$'
-            if re.search(cert_name, domain_name) != None:
-                return certs['CertificateArn']
-    return None
+    arn = _certificate_index(session).get(domain_name)
+    if arn is not None:
+        return arn
+
+    invalidate_lookups(session, '_certificate_index')
+    return _certificate_index(session).get(domain_name)
 
 
 def instance_public_lookup(session, hostname):
@@ -634,25 +1167,17 @@ def instance_public_lookup(session, hostname):
     if session is None:
         return None
 
-    client = session.client('ec2')
-    response = client.describe_instances(
-        Filters=[{"Name": "tag:Name", "Values": [hostname]},
-                 {"Name": "instance-state-name", "Values": ["running"]}])
-
-    item = response['Reservations']
+    item = hostname_instances(session, hostname, 'running')
     if len(item) == 0:
         return None
     else:
-        item = item[0]['Instances']
-        if len(item) == 0:
-            return None
-        else:
-            item = item[0]
-            if 'PublicDnsName' in item:
-                return item['PublicDnsName']
-            return None
+        item = item[0]
+        if 'PublicDnsName' in item:
+            return item['PublicDnsName']
+        return None
 
 
+@cached_lookup
 def cloudfront_public_lookup(session, hostname):
     """
     Lookup cloudfront public domain name which has hostname as the origin.
@@ -667,11 +1192,8 @@ def cloudfront_public_lookup(session, hostname):
     if session is None:
         return None
 
-    client = session.client('cloudfront')
-    response = client.list_distributions(
-        MaxItems='100'
-    )
-    items = response["DistributionList"]["Items"]
+    client = get_client(session, 'cloudfront')
+    items = paginate(client, 'list_distributions', 'DistributionList.Items')
     for item in items:
         cloud_front_domain_name = item["DomainName"]
         if item["Aliases"]["Quantity"] > 0:
@@ -680,6 +1202,7 @@ def cloudfront_public_lookup(session, hostname):
     return None
 
 
+@cached_lookup
 def elb_public_lookup(session, hostname):
     """Lookup the Public DNS name for a ELB
 
@@ -695,12 +1218,12 @@ def elb_public_lookup(session, hostname):
     if session is None:
         return None
 
-    client = session.client('elb')
-    responses = client.describe_load_balancers()
+    client = get_client(session, 'elb')
+    responses = paginate(client, 'describe_load_balancers', 'LoadBalancerDescriptions')
 
     hostname_ = hostname.replace(".", "-")
 
-    for response in responses["LoadBalancerDescriptions"]:
+    for response in responses:
         if response["LoadBalancerName"].startswith(hostname_):
             return response["DNSName"]
     return None
@@ -708,6 +1231,7 @@ def elb_public_lookup(session, hostname):
 
 # Should be something more like elb_check / elb_name_check, because
 # _lookup is normally used to return the ID of something
+@cached_lookup
 def lb_lookup(session, lb_name):
     """Look up ELB Id by name
 
@@ -724,11 +1248,11 @@ def lb_lookup(session, lb_name):
 
     lb_name = lb_name.replace('.', '-')
 
-    client = session.client('elb')
-    response = client.describe_load_balancers()
+    client = get_client(session, 'elb')
+    response = paginate(client, 'describe_load_balancers', 'LoadBalancerDescriptions')
 
-    for i in range(len(response['LoadBalancerDescriptions'])):
-        if (response['LoadBalancerDescriptions'][i]['LoadBalancerName']) == lb_name:
+    for lb in response:
+        if lb['LoadBalancerName'] == lb_name:
             return True
     return False
 
@@ -736,6 +1260,9 @@ def lb_lookup(session, lb_name):
 def sns_topic_lookup(session, topic_name):
     """Lookup up SNS topic ARN given a topic name
 
+    The topics are listed once per session and indexed by name, a topic that
+    is not in the index (created after the listing) is requested directly.
+
     Args:
         session (Session|None) : Boto3 session used to lookup information in AWS
                                  If session is None no lookup is performed
@@ -747,14 +1274,19 @@ def sns_topic_lookup(session, topic_name):
     if session is None:
         return None
 
-    client = session.client('sns')
-    response = client.list_topics()
-    topics_list = response['Topics']
-    for topic in topics_list:
-        arn_topic_name = topic["TopicArn"].split(':').pop()
-        if arn_topic_name == topic_name:
-            return topic["TopicArn"]
-    return None
+    arn = _topic_index(session).get(topic_name)
+    if arn is not None:
+        return arn
+
+    arn = "arn:aws:sns:{}:{}:{}".format(session.region_name,
+                                        get_account_id_from_session(session),
+                                        topic_name)
+    client = get_client(session, 'sns')
+    try:
+        client.get_topic_attributes(TopicArn=arn)
+        return arn
+    except client.exceptions.NotFoundException:
+        return None
 
 
 def sqs_delete_all(session, domain):
@@ -767,12 +1299,16 @@ def sqs_delete_all(session, domain):
     Raises:
         (boto3.ClientError): If queue not found.
     """
-    client = session.client('sqs')
-    resp = client.list_queues(QueueNamePrefix=domain.replace('.','-'))
+    client = get_client(session, 'sqs')
+    # Collect the URLs first so deletes don't affect the pagination
+    urls = list(paginate(client, 'list_queues', 'QueueUrls',
+                         QueueNamePrefix=domain.replace('.','-')))
 
-    for url in resp.get('QueueUrls', []):
+    for url in urls:
         client.delete_queue(QueueUrl=url)
+    invalidate_lookups(session, 'sqs_lookup_url')
 
+@cached_lookup
 def sqs_lookup_url(session, queue_name):
     """Lookup up SQS url given a name.
 
@@ -786,7 +1322,7 @@ def sqs_lookup_url(session, queue_name):
     Raises:
         (boto3.ClientError): If queue not found.
     """
-    client = session.client('sqs')
+    client = get_client(session, 'sqs')
     resp = client.get_queue_url(QueueName=queue_name)
     return resp['QueueUrl']
 
@@ -807,7 +1343,7 @@ def request_cert(session, domain_name, validation_domain):
     if session is None:
         return None
 
-    client = session.client('acm')
+    client = get_client(session, 'acm')
     validation_options = [
         {
             'DomainName': domain_name,
@@ -816,6 +1352,7 @@ def request_cert(session, domain_name, validation_domain):
     ]
     response = client.request_certificate(DomainName=domain_name,
                                           DomainValidationOptions=validation_options)
+    invalidate_lookups(session, '_certificate_index')
     return response
 
 def get_hosted_zone(session):
@@ -836,6 +1373,7 @@ def get_hosted_zone(session):
     else:
         return None
 
+@cached_lookup
 def get_hosted_zone_id(session, hosted_zone):
     """Look up Hosted Zone ID by DNS Name
 
@@ -850,7 +1388,7 @@ def get_hosted_zone_id(session, hosted_zone):
     if session is None:
         return None
 
-    client = session.client('route53')
+    client = get_client(session, 'route53')
     response = client.list_hosted_zones_by_name(
         DNSName=hosted_zone,
         MaxItems='1'
@@ -880,7 +1418,7 @@ def set_domain_to_dns_name(session, domain_name, dns_resource, hosted_zone):
     if session is None:
         return None
 
-    client = session.client('route53')
+    client = get_client(session, 'route53')
     hosted_zone_id = get_hosted_zone_id(session, hosted_zone)
 
     if hosted_zone_id is None:
@@ -929,7 +1467,7 @@ def get_dns_resource_for_domain_name(session, domain_name, dns_resource, hosted_
     if session is None:
         return None
 
-    client = session.client('route53')
+    client = get_client(session, 'route53')
     hosted_zone_id = get_hosted_zone_id(session, hosted_zone)
 
     if hosted_zone_id is None:
@@ -972,22 +1510,25 @@ def route53_delete_records(session, hosted_zone, cname):
     if session is None:
         return None
 
-    client = session.client('route53')
+    client = get_client(session, 'route53')
     hosted_zone_id = get_hosted_zone_id(session, hosted_zone)
 
     if hosted_zone_id is None:
         print("Could not locate Route53 Hosted Zone '{}'".format(hosted_zone))
         return None
 
-    response = client.list_resource_record_sets(
-        HostedZoneId=hosted_zone_id,
-        StartRecordName=cname,
-        StartRecordType='CNAME'
-    )
+    response = paginate(client, 'list_resource_record_sets', 'ResourceRecordSets',
+                        HostedZoneId=hosted_zone_id,
+                        StartRecordName=cname,
+                        StartRecordType='CNAME')
 
     changes = []
-    for record in response['ResourceRecordSets']:
+    for record in response:
         if not record['Name'].startswith(cname):
+            if len(changes) > 0:
+                # Records are returned in order, so the matching records
+                # have already been found and the remaining pages are skipped
+                break
             continue
         changes.append({
             'Action': 'DELETE',
@@ -1023,10 +1564,16 @@ def sns_unsubscribe_all(session, topic, region="us-east-1", account=None):
 
     topic = "arn:aws:sns:{}:{}:{}".format(region, account, topic.replace(".", "-"))
 
-    client = session.client('sns')
-    response = client.list_subscriptions()
+    client = get_client(session, 'sns')
+    # Collect the subscriptions first so unsubscribing doesn't affect the pagination
+    try:
+        response = list(paginate(client, 'list_subscriptions_by_topic', 'Subscriptions',
+                                 TopicArn=topic))
+    except client.exceptions.NotFoundException:
+        # The topic doesn't exist, so there is nothing to unsubscribe
+        return None
 
-    for res in response['Subscriptions']:
+    for res in response:
         if res['TopicArn'] == topic:
             client.unsubscribe(SubscriptionArn=res['SubscriptionArn'])
 
@@ -1046,8 +1593,9 @@ def sns_create_topic(session, topic):
     if session is None:
         return None
 
-    client = session.client("sns")
+    client = get_client(session, 'sns')
     response = client.create_topic(Name=topic)
+    invalidate_lookups(session, '_topic_index')
     print(response)
     if response is None:
         return None
@@ -1065,28 +1613,35 @@ def policy_delete_all(session, domain, path="/"):
     Raises:
         (boto3.ClientError): If queue not found.
     """
-    client = session.client('iam')
-    resp = client.list_policies(Scope='Local', PathPrefix=path)
-
+    client = get_client(session, 'iam')
+    # Collect the policies first so deletes don't affect the pagination
     prefix = domain.replace('.', '-')
-    for policy in resp.get('Policies', []):
-        if policy['PolicyName'].startswith(prefix):
-            ARN = policy['Arn']
-            if policy['AttachmentCount'] > 0:
-                # cannot delete a policy if it is still in use
-                attached = client.list_entities_for_policy(PolicyArn=ARN)
-                for group in attached.get('PolicyGroups', []):
-                    client.detach_group_policy(GroupName=group['GroupName'], PolicyArn=ARN)
-                for user in attached.get('PolicyUsers', []):
-                    client.detach_user_policy(UserName=user['UserName'], PolicyArn=ARN)
-                for role in attached.get('PolicyRoles', []):
-                    client.detach_role_policy(RoleName=role['RoleName'], PolicyArn=ARN)
-            client.delete_policy(PolicyArn=ARN)
+    policies = [policy for policy in paginate(client, 'list_policies', 'Policies',
+                                              Scope='Local', PathPrefix=path)
+                if policy['PolicyName'].startswith(prefix)]
+
+    for policy in policies:
+        ARN = policy['Arn']
+        if policy['AttachmentCount'] > 0:
+            # cannot delete a policy if it is still in use
+            # Collect each type of entity first so detaching doesn't affect the pagination
+            entities = lambda type_: list(paginate(client, 'list_entities_for_policy',
+                                                   'Policy{}s'.format(type_),
+                                                   PolicyArn=ARN, EntityFilter=type_))
+            for group in entities('Group'):
+                client.detach_group_policy(GroupName=group['GroupName'], PolicyArn=ARN)
+            for user in entities('User'):
+                client.detach_user_policy(UserName=user['UserName'], PolicyArn=ARN)
+            for role in entities('Role'):
+                client.detach_role_policy(RoleName=role['RoleName'], PolicyArn=ARN)
+        client.delete_policy(PolicyArn=ARN)
 
 def role_arn_lookup(session, role_name):
     """
     Returns the arn associated the the role name.
     Using this method avoids hardcoding the aws account into the arn name.
+    The roles are listed once per session and indexed by name, a role that
+    is not in the index (created after the listing) is requested directly.
     Args:
         session:
         role_name:
@@ -1097,13 +1652,18 @@ def role_arn_lookup(session, role_name):
     if session is None:
         return None
 
-    client = session.client('iam')
+    arn = _role_index(session).get(role_name)
+    if arn is not None:
+        return arn
+
+    client = get_client(session, 'iam')
     response = client.get_role(RoleName=role_name)
     if response is None:
         return None
     else:
         return response['Role']['Arn']
 
+@cached_lookup
 def instance_profile_arn_lookup(session, instance_profile_name):
     """
     Returns the arn associated the the role name.
@@ -1118,7 +1678,7 @@ def instance_profile_arn_lookup(session, instance_profile_name):
     if session is None:
         return None
 
-    client = session.client('iam')
+    client = get_client(session, 'iam')
     response = client.get_instance_profile(InstanceProfileName=instance_profile_name)
     if response is None:
         return None
@@ -1139,7 +1699,7 @@ def s3_bucket_exists(session, name):
     Returns:
         (bool): True if bucket exists.
     """
-    client = session.client('s3')
+    client = get_client(session, 's3')
     resp = client.list_buckets()
     for bucket in resp['Buckets']:
         if bucket['Name'] == name:
@@ -1147,6 +1707,7 @@ def s3_bucket_exists(session, name):
 
     return False
 
+@cached_lookup
 def get_account_id_from_session(session):
     """
     gets the account id from the session using the iam client.  This method will work even
@@ -1160,7 +1721,7 @@ def get_account_id_from_session(session):
     if session is None:
         return None
 
-    return session.client('iam').list_users(MaxItems=1)["Users"][0]["Arn"].split(':')[4]
+    return get_client(session, 'iam').list_users(MaxItems=1)["Users"][0]["Arn"].split(':')[4]
 
 # DP TODO: refactor all lambda server functions into some common entity so it is easy to handle multiple accounts
 def get_lambda_s3_bucket(session):
@@ -1218,6 +1779,8 @@ def get_lambda_server_key(session):
 def lambda_arn_lookup(session, lambda_name):
     """
     Returns the arn for a lambda given a lambda function name.
+    The functions are listed once per session and indexed by name, a function
+    that is not in the index (created after the listing) is requested directly.
     Args:
         session (Session): boto3.session.Session object
         lambda_name (str): name of the lambda function
@@ -1228,7 +1791,11 @@ def lambda_arn_lookup(session, lambda_name):
     if session is None:
         return None
 
-    client = session.client("lambda")
+    arn = _lambda_index(session).get(lambda_name)
+    if arn is not None:
+        return arn
+
+    client = get_client(session, 'lambda')
     response = client.get_function(FunctionName=lambda_name)
     if response is None:
         return None
@@ -22,6 +22,7 @@ Author:
 import os
 import time
 import json
+import hashlib
 from botocore.exceptions import ClientError
 
 from . import hosts
@@ -73,6 +74,141 @@ def bool_str(val):
     """
     return "true" if val else "false"
 
+# Minimum and maximum number of seconds between status checks while waiting
+# for a stack or change set
+POLL_MIN_DELAY = 2
+POLL_MAX_DELAY = 30
+
+def backoff(minimum=POLL_MIN_DELAY, maximum=POLL_MAX_DELAY):
+    """Generator of delays that start at minimum and double up to maximum
+
+    Args:
+        minimum (int) : First delay, in seconds
+        maximum (int) : Maximum delay, in seconds
+
+    Returns:
+        (generator) : Generator yielding each delay, in seconds
+    """
+    delay = minimum
+    while True:
+        yield delay
+        delay = min(delay * 2, maximum)
+
+def stack_missing(ex):
+    """Check if a ClientError was raised because the stack doesn't exist
+
+    Args:
+        ex (ClientError) : Error raised by a CloudFormation client call
+
+    Returns:
+        (bool) : If the error is a ValidationError for a missing stack
+    """
+    error = ex.response.get('Error', {})
+    return error.get('Code') == 'ValidationError' and \
+           'does not exist' in error.get('Message', '')
+
+class StackWaiter(object):
+    """Wait for a stack operation to finish by tailing the stack's events.
+
+    Each check only requests the events that were added since the last seen
+    event. While new events are arriving the stack is checked every
+    POLL_MIN_DELAY seconds, backing off to POLL_MAX_DELAY seconds while the
+    stack is quiet. Each event is printed as it arrives and resources that
+    failed are collected in failures.
+    """
+    STACK_TYPE = 'AWS::CloudFormation::Stack'
+
+    def __init__(self, client, stack_name):
+        """StackWaiter constructor
+
+        Args:
+            client (Client) : Boto3 CloudFormation client
+            stack_name (str) : Name of the stack to wait on
+        """
+        self.client = client
+        self.stack_name = stack_name
+        self.last_event_id = None
+        self.failures = []
+
+    def mark(self):
+        """Skip all of the existing events, so only the events from the next
+        stack operation are reported.
+
+        Call before starting an operation on an existing stack.
+        """
+        try:
+            event = aws.first(self.events())
+        except ClientError as ex:
+            if stack_missing(ex):
+                return
+            raise
+        if event is not None:
+            self.last_event_id = event['EventId']
+
+    def events(self):
+        """Get the stack's events, newest first"""
+        return aws.paginate(self.client, 'describe_stack_events', 'StackEvents',
+                            StackName = self.stack_name)
+
+    def new_events(self):
+        """Get the events since the last seen event, oldest first"""
+        events = []
+        for event in self.events():
+            if event['EventId'] == self.last_event_id:
+                break
+            events.append(event)
+
+        events.reverse()
+        if len(events) > 0:
+            self.last_event_id = events[-1]['EventId']
+        return events
+
+    def report(self, event):
+        print("{:%H:%M:%S}  {:<45}{:<45}{}".format(event['Timestamp'],
+                                                  event['ResourceStatus'],
+                                                  event['ResourceType'],
+                                                  event['LogicalResourceId']))
+        if event['ResourceStatus'].endswith('FAILED'):
+            reason = event.get('ResourceStatusReason', '')
+            print("          {}".format(reason))
+            self.failures.append((event['LogicalResourceId'], event['ResourceType'], reason))
+
+    def wait(self, action, process):
+        """Wait for the stack to leave the given status.
+
+        Args:
+            action (str) : Name of the operation being waited on, for display
+            process (str) : Stack status while the operation is in progress
+
+        Returns:
+            (str) : The new stack status
+        """
+        print("Waiting for {}".format(action))
+        status = process
+        delays = backoff()
+        while True:
+            events = self.new_events()
+            for event in events:
+                self.report(event)
+                if event['ResourceType'] == self.STACK_TYPE and \
+                   event['LogicalResourceId'] == self.stack_name:
+                    status = event['ResourceStatus']
+
+            if status != process:
+                break
+
+            if len(events) > 0:
+                delays = backoff() # Stack is active, check again soon
+            time.sleep(next(delays))
+
+        failures = [f for f in self.failures if f[0] != self.stack_name]
+        if len(failures) > 0:
+            print("Failed resources:")
+            for key, type_, reason in failures:
+                print("  {} ({}): {}".format(key, type_, reason))
+
+        return status
+
 def Arn(key):
     """Get the Arn attribute of the given template resource"""
     return { 'Fn::GetAtt': [key, 'Arn']}
@@ -376,6 +512,18 @@ class Arg:
 # In all other cases, it is up to the developer of new methods to decide if they
 # want to implement the function's arguments are CF template arguments or hardcoded
 # values.
+# Stack tag containing CloudFormationConfiguration.template_hash()
+TEMPLATE_HASH_TAG = "TemplateHash"
+
+# Maximum size (in bytes) of a template passed directly to CloudFormation
+TEMPLATE_BODY_LIMIT = 51200
+# Maximum size (in bytes) of a template uploaded to S3 and passed by URL
+TEMPLATE_URL_LIMIT = 460800
+# Maximum number of resources in a template
+TEMPLATE_RESOURCE_LIMIT = 200
+# Maximum number of parameters in a template
+TEMPLATE_PARAMETER_LIMIT = 60
+
 class CloudFormationConfiguration:
     """Configuration class that helps with building CloudFormation templates
     and launching them.
@@ -408,20 +556,111 @@ class CloudFormationConfiguration:
         if self.vpc_subnet is None:
             raise Exception("'{}' is not a valid stack domain".format(domain))
 
+    def _template(self, description=""):
+        return {"AWSTemplateFormatVersion" : "2010-09-09",
+                "Description" : description,
+                "Parameters": self.parameters,
+                "Resources": self.resources}
+
     def _create_template(self, description="", indent=None):
         """Create the JSON CloudFormation template from the resources that have
         be added to the object.
 
+        If indent is None the most compact JSON encoding is used, as
+        CloudFormation limits the size of the template.
+
         Args:
             description (str) : Template description
+            indent (None|int) : JSON indent level
 
         Returns:
             (str) : The JSON formatted CloudFormation template
         """
-        return json.dumps({"AWSTemplateFormatVersion" : "2010-09-09",
-                           "Description" : description,
-                           "Parameters": self.parameters,
-                           "Resources": self.resources}, indent=indent)
+        separators = (',', ':') if indent is None else None
+        return json.dumps(self._template(description), indent=indent, separators=separators)
+
+    def template_size(self):
+        """Get the size (in bytes) of the template passed to CloudFormation"""
+        return len(self._create_template().encode('utf-8'))
+
+    def resource_sizes(self):
+        """Get the size each resource adds to the template.
+
+        Returns:
+            (dict) : Dictionary of resource type to a list of (key, size in bytes)
+                     tuples for each resource of that type
+        """
+        sizes = {}
+        for key, resource in self.resources.items():
+            size = len(json.dumps({key: resource}, separators=(',', ':'))) - 2 # {}
+            sizes.setdefault(resource.get("Type"), []).append((key, size))
+        return sizes
+
+    def template_hash(self, template=None):
+        """Hash the template and arguments this object represents.
+
+        The hash is saved as the TEMPLATE_HASH_TAG tag when the stack is created
+        or updated, so that an update can be skipped if nothing changed.
+
+        Args:
+            template (None|str) : Template from _create_template(), if already created
+
+        Returns:
+            (str) : Hex digest of the template and arguments
+        """
+        if template is None:
+            template = self._create_template()
+        data = template + json.dumps(self.arguments, sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _template_source(self, session, template, template_hash):
+        """Get the template argument for create_stack / update_stack / create_change_set
+
+        Templates larger than TEMPLATE_BODY_LIMIT are uploaded to the S3 bucket
+        used for lambda code and passed to CloudFormation using the S3 URL.
+
+        Args:
+            session (Session) : Boto3 session used to upload the template
+            template (str) : Template from _create_template()
+            template_hash (str) : Hash from template_hash()
+
+        Returns:
+            (dict) : Dictionary with either the TemplateBody or TemplateURL key
+        """
+        size = len(template.encode('utf-8'))
+        if size <= TEMPLATE_BODY_LIMIT:
+            return {'TemplateBody': template}
+
+        if size > TEMPLATE_URL_LIMIT:
+            raise Exception("Template for '{}' is {} bytes, larger than the {} byte limit"
+                                .format(self.stack_name, size, TEMPLATE_URL_LIMIT))
+
+        bucket = aws.get_lambda_s3_bucket(session)
+        key = "cloudformation/{}/{}.template".format(self.stack_name, template_hash)
+        print("Template is {} bytes, uploading to s3://{}/{}".format(size, bucket, key))
+
+        s3 = aws.get_client(session, 's3')
+        s3.put_object(Bucket=bucket, Key=key, Body=template.encode('utf-8'))
+        return {'TemplateURL': "https://{}.s3.amazonaws.com/{}".format(bucket, key)}
+
+    def _tags(self, commit, template_hash):
+        return [
+            {"Key": "Commit", "Value": commit},
+            {"Key": TEMPLATE_HASH_TAG, "Value": template_hash},
+        ]
+
+    def _is_current(self, client, template_hash):
+        """Check if the stack was last created / updated with the given template
+        hash and is in a complete state"""
+        try:
+            response = client.describe_stacks(StackName = self.stack_name)
+        except ClientError:
+            return False
+
+        stack = response['Stacks'][0]
+        tags = {tag['Key']: tag['Value'] for tag in stack.get('Tags', [])}
+        return tags.get(TEMPLATE_HASH_TAG) == template_hash and \
+               stack['StackStatus'] in ('CREATE_COMPLETE', 'UPDATE_COMPLETE')
 
     def generate(self):
         """Generate the CloudFormation template and arguments files """
@@ -429,26 +668,11 @@ class CloudFormationConfiguration:
         folder = os.path.realpath(os.path.join(cur_dir, '..', 'cloud_formation', 'templates'))
 
         with open(os.path.join(folder, self.stack_name + ".template"), "w") as fh:
-            fh.write(self._create_template(indent=4))
+            json.dump(self._template(), fh, indent=4)
 
         with open(os.path.join(folder, self.stack_name + ".arguments"), "w") as fh:
             json.dump(self.arguments, fh, indent=4)
 
-    def _poll(self, client, name, action, process):
-        get_status = lambda r: r['Stacks'][0]['StackStatus']
-        response = client.describe_stacks(StackName=name)
-        if len(response['Stacks']) == 0:
-            return None
-        else:
-            print("Waiting for {} ".format(action), end="", flush=True)
-            while get_status(response) == process:
-                time.sleep(5)
-                print(".", end="", flush=True)
-                response = client.describe_stacks(StackName=name)
-            print(" done")
-
-            return get_status(response)
-
     def create(self, session, wait = True):
         """Launch the template this object represents in CloudFormation.
 
@@ -465,16 +689,17 @@ class CloudFormationConfiguration:
             if argument["ParameterValue"] is None:
                 raise Exception("Could not determine argument '{}'".format(argument["ParameterKey"]))
 
-        client = session.client('cloudformation')
+        client = aws.get_client(session, 'cloudformation')
+
+        template = self._create_template()
+        template_hash = self.template_hash(template)
 
         try:
             response = client.create_stack(
                 StackName = self.stack_name,
-                TemplateBody = self._create_template(),
                 Parameters = self.arguments,
-                Tags = [
-                    {"Key": "Commit", "Value": utils.get_commit()}
-                ]
+                Tags = self._tags(utils.get_commit(), template_hash),
+                **self._template_source(session, template, template_hash)
             )
         except client.exceptions.AlreadyExistsException:
             print('{} already exists, aborting.'.format(self.stack_name))
@@ -482,16 +707,17 @@ class CloudFormationConfiguration:
 
         rtn = None
         if wait:
-            status = self._poll(client, self.stack_name, 'create', 'CREATE_IN_PROGRESS')
+            status = StackWaiter(client, self.stack_name).wait('create', 'CREATE_IN_PROGRESS')
 
-            if status is None:
-                print("Problem launching stack")
-            elif status == 'CREATE_COMPLETE':
+            if status == 'CREATE_COMPLETE':
                 print("Created stack '{}'".format(self.stack_name))
                 rtn = True
             else:
                 print("Status of stack '{}' is '{}'".format(self.stack_name, status))
                 rtn = False
+
+        # New instances are not in the previous inventory snapshots
+        aws.invalidate_lookups(session, 'inventory_lookup')
         return rtn
 
     def update(self, session, wait = True):
@@ -504,41 +730,50 @@ class CloudFormationConfiguration:
 
         Returns:
             (bool|None) : If wait is True, the result of launching the stack,
-                          else None
+                          else None. None is also returned if the update was
+                          canceled or skipped because the stack is up to date
         """
         for argument in self.arguments:
             if argument["ParameterValue"] is None:
                 raise Exception("Could not determine argument '{}'".format(argument["ParameterKey"]))
 
-        client = session.client('cloudformation')
+        client = aws.get_client(session, 'cloudformation')
+
+        template = self._create_template()
+        template_hash = self.template_hash(template)
+        if self._is_current(client, template_hash):
+            print("Stack '{}' is up to date, skipping update".format(self.stack_name))
+            return None
+
+        template_source = self._template_source(session, template, template_hash)
+
+        waiter = StackWaiter(client, self.stack_name)
 
         disable_preview = str(os.environ.get("DISABLE_PREVIEW"))
         disable_preview = disable_preview.lower() in ('yes', 'true', 'y', 't')
         if disable_preview:
+            waiter.mark()
             response = client.update_stack(
                 StackName = self.stack_name,
-                TemplateBody = self._create_template(),
                 Parameters = self.arguments,
-                Tags = [
-                    {"Key": "Commit", "Value": utils.get_commit()}
-                ]
+                Tags = self._tags(utils.get_commit(), template_hash),
+                **template_source
             )
         else:
             commit = utils.get_commit()
             response = client.create_change_set(
                 ChangeSetName = 'h' + commit,
                 StackName = self.stack_name,
-                TemplateBody = self._create_template(),
                 Parameters = self.arguments,
-                Tags = [
-                    {"Key": "Commit", "Value": commit}
-                ]
+                Tags = self._tags(commit, template_hash),
+                **template_source
             )
 
             try:
                 response = {'Status': 'CREATE_PENDING'}
+                delays = backoff()
                 while response['Status'] in ('CREATE_PENDING', 'CREATE_IN_PROGRESS'):
-                    time.sleep(5)
+                    time.sleep(next(delays))
                     response = client.describe_change_set(
                         ChangeSetName = 'h' + commit,
                         StackName = self.stack_name
@@ -575,6 +810,7 @@ class CloudFormationConfiguration:
                 if len(resp) == 0 or resp[0] not in ('y', 'Y'):
                     raise Exception()
                 else:
+                    waiter.mark()
                     response = client.execute_change_set(
                         ChangeSetName = 'h' + commit,
                         StackName = self.stack_name
@@ -589,20 +825,21 @@ class CloudFormationConfiguration:
 
         rtn = None
         if wait:
-            status = self._poll(client, self.stack_name, 'update', 'UPDATE_IN_PROGRESS')
+            status = waiter.wait('update', 'UPDATE_IN_PROGRESS')
 
-            if status is None:
-                print("Problem launching stack")
-            elif status == 'UPDATE_COMPLETE':
+            if status == 'UPDATE_COMPLETE':
                 print("Updated stack '{}'".format(self.stack_name))
                 rtn = True
             elif status == 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS':
-                status = self._poll(client, self.stack_name, 'update cleanup', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS')
+                status = waiter.wait('update cleanup', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS')
                 print("Updated stack '{}'".format(self.stack_name))
                 rtn = True
             else:
                 print("Status of stack '{}' is '{}'".format(self.stack_name, status))
                 rtn = False
+
+        # Resources in the stack may have been replaced, so previous lookups may be stale
+        aws.invalidate_lookups(session, *aws.STACK_LOOKUPS)
         return rtn
 
     def delete(self, session, wait = True):
@@ -622,26 +859,31 @@ class CloudFormationConfiguration:
                           else None
         """
 
-        client = session.client("cloudformation")
+        client = aws.get_client(session, 'cloudformation')
+        waiter = StackWaiter(client, self.stack_name)
+        waiter.mark()
         client.delete_stack(StackName = self.stack_name)
 
         rtn = None
         if wait:
             try:
-                status = self._poll(client, self.stack_name, 'delete', 'DELETE_IN_PROGRESS')
+                status = waiter.wait('delete', 'DELETE_IN_PROGRESS')
 
-                if status is None:
-                    print("Problem deleting stack")
-                elif status == 'DELETE_COMPLETE':
+                if status == 'DELETE_COMPLETE':
                     print("Deleted stack '{}'".format(self.stack_name))
                     rtn = True
                 else:
                     print("Status of stack '{}' is '{}'".format(self.stack_name, status))
                     rtn = False
-            except ClientError:
+            except ClientError as ex:
+                if not stack_missing(ex):
+                    raise
                 # Stack doesn't exist anymore
-                print(" done")
+                print("Deleted stack '{}'".format(self.stack_name))
                 rtn = True
+
+        # Resources in the stack were deleted, so previous lookups may be stale
+        aws.invalidate_lookups(session, *aws.STACK_LOOKUPS)
         return rtn
 
     def add_arg(self, arg):
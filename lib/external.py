@@ -20,7 +20,7 @@ from . import exceptions
 from . import aws
 from .utils import keypair_to_file
 from .ssh import SSHConnection, vault_tunnel
-from .vault import Vault
+from .vault import Vault, unseal_all, cluster_status, format_status
 
 
 def gen_timeout(total, step):
@@ -81,17 +81,30 @@ class ExternalCalls:
                 and then unseal any other servers.
                 """
                 self.vaults[0].initialize()
-                for vault in self.vaults[1:]:
-                    vault.unseal()
+                unseal_all(self.vaults[1:])
 
             @staticmethod
             def unseal():
-                """Unseal all of the vault servers.
+                """Unseal all of the vault servers at once and print their status.
 
                 Lookup all vault IPs for the VPC and unseal each server.
+
+                Returns:
+                    (list) : List of each server's vault.Vault.seal_status()
+                """
+                statuses = unseal_all(self.vaults)
+                for line in format_status(statuses):
+                    print(line)
+                return statuses
+
+            @staticmethod
+            def status():
+                """Get the seal status of all of the vault servers at once.
+
+                Returns:
+                    (list) : List of each server's vault.Vault.seal_status()
                 """
-                for vault in self.vaults:
-                    vault.unseal()
+                return cluster_status(self.vaults)
 
             @staticmethod
             def read(path):
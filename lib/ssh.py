@@ -18,26 +18,78 @@ import os
 import signal
 import sys
 import time
-import random
+import socket
+import atexit
+import shutil
+import hashlib
+import tempfile
+import threading
 
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from .exceptions import SSHError, SSHTunnelError
+from .utils import prefixed_output
 
 # Needed to prevent ssh from asking about the fingerprint from new machines
 SSH_OPTIONS = "-o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -q"
-TUNNEL_SLEEP = 10 # seconds
+TUNNEL_TIMEOUT = 60 # seconds to wait for a tunnel to be established
+CONTROL_TIMEOUT = 60 # seconds to wait for a master connection to be established
+
+FLEET_CONCURRENCY = 10 # number of machines run_all() runs a command on at once
+SYNC_PARALLEL = 4 # number of transfers sync() runs at once
+
+# Delay between readiness checks, doubled after each check
+PROBE_MIN_DELAY = 0.05 # seconds
+PROBE_MAX_DELAY = 2 # seconds
 
 def locate_port():
-    """Locate a local port to attach a SSH tunnel to.
+    """Locate a free local port to attach a SSH tunnel to.
 
-    Instead of trying to figure out if a port is in use, assume that it will
-    not be in use.
+    The OS picks an unused ephemeral port, which should still be free when
+    the tunnel binds it a moment later.
 
     Returns:
         (int) : Local port to use
     """
-    return random.randint(10000,60000)
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+def probe_delays(timeout):
+    """Generate the delays between readiness checks, backing off exponentially
+    until the timeout is reached.
+
+    Args:
+        timeout (int) : Total number of seconds to check for
+
+    Returns:
+        (generator) : Generator of seconds to sleep between checks
+    """
+    deadline = time.monotonic() + timeout
+    delay = PROBE_MIN_DELAY
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        yield min(delay, remaining)
+        delay = min(delay * 2, PROBE_MAX_DELAY)
+
+def port_open(port, host="localhost"):
+    """Check if a TCP connection can be made to the given port
+
+    Args:
+        port (int) : Port to connect to
+        host (string) : Host to connect to
+
+    Returns:
+        (bool) : If the connection was made
+    """
+    try:
+        socket.create_connection((host, port), timeout=PROBE_MAX_DELAY).close()
+        return True
+    except OSError:
+        return False
 
 def become_tty_fg():
     """Force a subprocess call to become the foreground process.
@@ -61,141 +113,285 @@ def check_ssh(ret):
     if ret == 255:
         raise SSHError("Error establishing a SSH connection")
 
-class ProcWrapper(list):
-    """Wrapper that holds multiple Popen objects and can call
-    terminate and wait on all contained objects.
+class SSHMaster(object):
+    """An OpenSSH ControlMaster connection to a host
+
+    Commands, file copies, and tunnels to or through the host are multiplexed
+    over the master connection, so that only the first one has to wait for
+    a SSH connection to be established and authenticated.
+
+    Use get_master() to get the shared connection for a host.
     """
-    def prepend(self, item):
-        self.insert(0, item)
-    def terminate(self):
-        [item.terminate() for item in self]
-    def wait(self):
-        [item.wait() for item in self]
+    def __init__(self, key, host, port=22, user="ec2-user", proxy=None):
+        """SSHMaster constructor
+
+        Args:
+            key (string) : Path to a SSH private key, protected as required by SSH
+            host (string) : Hostname / IP of the machine to connect to
+            port (int) : SSH port on the host
+            user (string) : User account on the host to connect as
+            proxy (None|SSHMaster) : Master connection to connect to the host through
+        """
+        self.key = key
+        self.host = host
+        self.port = port
+        self.user = user
+        self.proxy = proxy
 
-def create_tunnel(key, local_port, remote_ip, remote_port, bastion_ip, bastion_user="ec2-user", bastion_port=22):
-    """Create a SSH tunnel.
+        name = "{}@{}:{} {}".format(user, host, port, proxy.control_path if proxy else "")
+        self.control_path = os.path.join(control_dir(), hashlib.md5(name.encode()).hexdigest()[:16])
 
-    Creates a SSH tunnel from localhost:local_port to remote_ip:remote_port through bastion_ip.
+        self.proc = None
+        self.forwards = {} # (local port, remote ip, remote port): number of users
+        self.lock = threading.Lock()
 
-    Args:
-        key (string) : Path to a SSH private key, protected as required by SSH
-        local_port : Port on the local machine to attach the local end of the tunnel to
-        remote_ip : IP of the machine the tunnel remote end should point at
-        remote_port : Port of on the remote_ip that the tunnel should point at
-        bastion_ip : IP of the machine to form the SSH tunnel through
-        bastion_user : The user account of the bastion_ip machine to use when creating the tunnel
-        bastion_port : Port on the bastion_ip to connect to when creating the tunnel
+    @property
+    def destination(self):
+        return "{}@{}".format(self.user, self.host)
 
-    Returns:
-        (Popen) : Popen process object of the SSH tunnel
-    """
-    fwd_cmd_fmt = "ssh -i {} {} -N -L {}:{}:{} -p {} {}@{}"
-    fwd_cmd = fwd_cmd_fmt.format(key,
-                                 SSH_OPTIONS,
-                                 local_port,
-                                 remote_ip,
-                                 remote_port,
-                                 bastion_port,
-                                 bastion_user,
-                                 bastion_ip)
-
-    proc = subprocess.Popen(shlex.split(fwd_cmd))
+    def options(self):
+        """Get the arguments, besides the port and destination, needed by
+        ssh / scp to use the master connection
 
-    try:
-        r = proc.wait(TUNNEL_SLEEP)
-        if r == 255:
-            raise SSHError("Error establishing a SSH tunnel")
-        else:
-            raise SSHTunnelError("SSH tunnel exited with error code {}".format(ret))
-    except subprocess.TimeoutExpired:
-        pass # process is still running, tunnel is up
+        Returns:
+            (list) : List of command line arguments
+        """
+        opts = ["-i", self.key] + shlex.split(SSH_OPTIONS)
+        opts += ["-o", "ControlPath=" + self.control_path]
+        if self.proxy:
+            proxy = ["ssh"] + self.proxy.options()
+            proxy += ["-p", str(self.proxy.port), "-W", "%h:%p", self.proxy.destination]
+            opts += ["-o", "ProxyCommand=" + " ".join(shlex.quote(arg) for arg in proxy)]
+        return opts
+
+    def is_running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        """Start the master connection, if it is not already running
+
+        Instead of waiting a fixed amount of time, wait for the master to
+        create its control socket, which happens once the connection has
+        been authenticated.
+
+        Raises:
+            SSHError : If the connection could not be established
+        """
+        with self.lock:
+            if self.is_running():
+                return
 
-    return proc
+            if self.proxy:
+                self.proxy.start()
 
-def create_tunnel_aplnis(key, local_port, remote_ip, remote_port, bastion_ip, bastion_user="ec2-user"):
-    """Create a SSH tunnel, possibly though an extra bastion defined by environmental variables.
+            if os.path.exists(self.control_path):
+                os.remove(self.control_path) # left by a master that exited
 
-    Read environmental variables to either directly connect to the given
-    bastion_ip or use the given (second) bastion server as the first machine to
-    connect to and route other tunnels through.
+            cmd = ["ssh"] + self.options()
+            cmd += ["-p", str(self.port), "-M", "-N", "-o", "ControlPersist=no", self.destination]
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL)
+            self.forwards = {}
 
-    This was added to support using a single machine given access through the
-    corporate firewall and tunnel all SSH connections through it.
+            for delay in probe_delays(CONTROL_TIMEOUT):
+                if self.proc.poll() is not None:
+                    self.proc = None
+                    raise SSHError("Error establishing a SSH connection to {}".format(self.host))
 
-    Args:
-        key (string) : Path to a SSH private key, protected as required by SSH
-        local_port : Port on the local machine to attach the local end of the tunnel to
-        remote_ip : IP of the machine the tunnel remote end should point at
-        remote_port : Port of on the remote_ip that the tunnel should point at
-        bastion_ip : IP of the machine to form the SSH tunnel through
-        bastion_user : The user account of the bastion_ip machine to use when creating the tunnel
+                if os.path.exists(self.control_path):
+                    return
+
+                time.sleep(delay)
+
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+            raise SSHError("Timeout establishing a SSH connection to {}".format(self.host))
+
+    def close(self):
+        """Close the master connection, and any commands or tunnels using it"""
+        with self.lock:
+            if self.proc is not None:
+                self.proc.terminate()
+                self.proc.wait()
+                self.proc = None
+            self.forwards = {}
+
+    def _control(self, command, *args):
+        cmd = ["ssh", "-q", "-o", "ControlPath=" + self.control_path, "-O", command]
+        cmd += list(args) + [self.destination]
+        return subprocess.call(cmd, stdout=subprocess.DEVNULL)
+
+    def forward(self, local_port, remote_ip, remote_port):
+        """Forward a local port through the master connection
+
+        Forwards are shared, so if the same forward is requested multiple
+        times it is only removed once cancel() has been called for each request.
+
+        A new forward is ready once its local port accepts connections. This
+        only checks the listener the master opens on the local machine, not
+        that remote_ip:remote_port can be reached through the master.
+
+        Args:
+            local_port : Port on the local machine to attach the local end of the tunnel to
+            remote_ip : IP of the machine the tunnel remote end should point at
+                        (relative to the host of the master connection)
+            remote_port : Port of on the remote_ip that the tunnel should point at
+
+        Raises:
+            SSHTunnelError : If the port could not be forwarded, or the local
+                             port did not accept connections within TUNNEL_TIMEOUT
+        """
+        self.start()
+
+        forward = (local_port, remote_ip, remote_port)
+        with self.lock:
+            if self.forwards.get(forward, 0) == 0:
+                # The master reports a forward that could not be setup (like
+                # ExitOnForwardFailure) without exiting, as other users share it
+                ret = self._control("forward", "-L", "{}:{}:{}".format(*forward))
+                if ret != 0:
+                    raise SSHTunnelError("Could not forward localhost:{} to {}:{}".format(*forward))
+
+                # Wait for the local listener instead of a fixed amount of time.
+                # The remote end is only connected to when a client connects
+                for delay in probe_delays(TUNNEL_TIMEOUT):
+                    if not self.is_running():
+                        raise SSHTunnelError("SSH connection to {} exited".format(self.host))
+                    if port_open(local_port):
+                        break
+                    time.sleep(delay)
+                else:
+                    self._control("cancel", "-L", "{}:{}:{}".format(*forward))
+                    raise SSHTunnelError("Timeout waiting for SSH tunnel on port {}".format(local_port))
+            self.forwards[forward] = self.forwards.get(forward, 0) + 1
+
+    def cancel(self, local_port, remote_ip, remote_port):
+        """Remove a forward created by forward()"""
+        forward = (local_port, remote_ip, remote_port)
+        with self.lock:
+            count = self.forwards.get(forward, 0) - 1
+            if count > 0:
+                self.forwards[forward] = count
+            elif count == 0:
+                del self.forwards[forward]
+                if self.is_running():
+                    self._control("cancel", "-L", "{}:{}:{}".format(*forward))
+
+    def command(self, command=None):
+        """Get the ssh command line to execute a command using the master connection
+
+        Args:
+            command (None|string) : Command to execute or None for an interactive shell
+
+        Returns:
+            (list) : Command line arguments
+        """
+        cmd = ["ssh"] + self.options() + ["-p", str(self.port), self.destination]
+        if command is not None:
+            cmd.append(command)
+        return cmd
+
+    def copy(self, source, destination, *args):
+        """Get the scp command line to copy a file using the master connection
+
+        Args:
+            source (string) : Source path, prefixed by remote() if on the host
+            destination (string) : Destination path, prefixed by remote() if on the host
+            args : Additional scp arguments
+
+        Returns:
+            (list) : Command line arguments
+        """
+        return ["scp"] + self.options() + ["-P", str(self.port)] + list(args) + [source, destination]
+
+    def rsync(self, sources, destination, *args):
+        """Get the rsync command line to sync files using the master connection
+
+        Args:
+            sources (list) : Source paths, prefixed by remote() if on the host
+            destination (string) : Destination path, prefixed by remote() if on the host
+            args : Additional rsync arguments
+
+        Returns:
+            (list) : Command line arguments
+        """
+        shell = ["ssh"] + self.options() + ["-p", str(self.port)]
+        shell = " ".join(shlex.quote(arg) for arg in shell)
+        return ["rsync", "--archive", "--compress", "--partial", "-e", shell] + list(args) + sources + [destination]
+
+    def remote(self, path):
+        """Get the scp argument for a path on the host"""
+        return "{}:{}".format(self.destination, path)
+
+_masters = {}
+_masters_lock = threading.Lock()
+_control_dir = None
+
+def control_dir():
+    """Get the directory for the master connection control sockets, removed on exit
 
     Returns:
-        (Popen) : Popen process object of the SSH tunnel
-        (ProcWrapper) : ProcWrapper that contains multiple Popen objects, one for each tunnel
+        (string) : Path of the directory
     """
-    apl_bastion_ip = os.environ.get("BASTION_IP")
-    apl_bastion_key = os.environ.get("BASTION_KEY")
-    apl_bastion_user = os.environ.get("BASTION_USER")
+    global _control_dir
+    with _masters_lock:
+        if _control_dir is None:
+            # Kept short, as control socket paths are limited to ~100 characters
+            _control_dir = tempfile.mkdtemp(prefix="ssh-")
+        return _control_dir
 
-    if apl_bastion_ip is None or apl_bastion_key is None or apl_bastion_user is None:
-        # traffic
-        # localhost -> bastion -> remote
-        print("Bastion information not defined, connecting directly")
-        proc = create_tunnel(key, local_port, remote_ip, remote_port, bastion_ip, bastion_user)
-        return proc
-    else:
-        # traffic
-        # localhost -> apl_bastion -> bastion -> remote
-        #print("Using Bastion host at {}".format(apl_bastion_ip))
-        wrapper = ProcWrapper()
-        port = locate_port()
+def get_master(key, host, port=22, user="ec2-user", proxy=None):
+    """Get the shared master connection for the given host
 
-        # Used http://superuser.com/questions/96489/ssh-tunnel-via-multiple-hops mssh.pl
-        # to figure out the multiple tunnels
+    The connection is not started until it is used
 
-        # Open up a SSH tunnel to bastion_ip:22 through apl_bastion_ip
-        # (to allow the second tunnel to be created)
-        proc = create_tunnel(apl_bastion_key, port, bastion_ip, 22, apl_bastion_ip, apl_bastion_user)
-        wrapper.prepend(proc)
+    Args:
+        key (string) : Path to a SSH private key, protected as required by SSH
+        host (string) : Hostname / IP of the machine to connect to
+        port (int) : SSH port on the host
+        user (string) : User account on the host to connect as
+        proxy (None|SSHMaster) : Master connection to connect to the host through
 
-        try:
-            # Create our normal tunnel, but connect to localhost:port to use the
-            # first tunnel that we create
-            proc = create_tunnel(key, local_port, remote_ip, remote_port, "localhost", bastion_user, port)
-            wrapper.prepend(proc)
-            return wrapper
-        except:
-            # close the initial tunnel
-            wrapper.terminate()
-            wrapper.wait()
-            raise # raise initial exception
-
-def create_tunnel_bastion(local_port, remote_ip, remote_port):
-    """Create a SSH tunnel through the bastion machine defined by environmental variables.
-
-    If no bastion machine is defined an exception is raised
+    Returns:
+        (SSHMaster) : Master connection
+    """
+    id = (key, host, port, user, proxy)
+    master = _masters.get(id)
+    if master is None:
+        master = SSHMaster(key, host, port, user, proxy)
+        with _masters_lock:
+            master = _masters.setdefault(id, master)
+    return master
 
-    Args:
-        local_port : Port on the local machine to attach the local end of the tunnel to
-        remote_ip : IP of the machine the tunnel remote end should point at
-        remote_port : Port of on the remote_ip that the tunnel should point at
+def aplnis_master():
+    """Get the master connection for the extra bastion defined by environmental variables
 
     Returns:
-        (Popen) : Popen process object of the SSH tunnel
+        (None|SSHMaster) : Master connection or None if the bastion is not defined
     """
     apl_bastion_ip = os.environ.get("BASTION_IP")
     apl_bastion_key = os.environ.get("BASTION_KEY")
     apl_bastion_user = os.environ.get("BASTION_USER")
 
     if apl_bastion_ip is None or apl_bastion_key is None or apl_bastion_user is None:
-        print("Bastion information not defined, connecting directly")
         return None
-    else:
-        # traffic
-        # localhost -> apl_bastion -> remote
-        proc = create_tunnel(apl_bastion_key, local_port, remote_ip, remote_port, apl_bastion_ip, apl_bastion_user)
-        return proc
+    return get_master(apl_bastion_key, apl_bastion_ip, 22, apl_bastion_user)
+
+@atexit.register
+def close_masters():
+    """Close all of the master connections, proxied connections first"""
+    global _control_dir
+    with _masters_lock:
+        masters = list(_masters.values())
+        _masters.clear()
+
+    for master in reversed(masters):
+        master.close()
+
+    with _masters_lock:
+        if _control_dir is not None:
+            shutil.rmtree(_control_dir, ignore_errors=True)
+            _control_dir = None
 
 def unpack(obj, *args):
     if type(obj) == tuple:
@@ -209,96 +405,154 @@ class SSHConnection(object):
         self.key = key
         self.remote_ip, self.remote_port, self.remote_user = unpack(target, 22, "ubuntu")
         self.bastion_ip, self.bastion_port, self.bastion_user = unpack(bastion, 22, "ec2-user")
-        self.local_port = local_port if local_port else random.randint(10000,60000)
+        self.local_port = local_port if local_port else locate_port()
+
+    def _proxy(self):
+        """Get the master connection that tunnels are created through, based
+        on constructor arguments / environment variables.
+
+        There are 4 different configurations
+        1) No tunnels are needed / requested
+        2) Through the bastion defined by environment variables
+        3) Through the bastion passed to the constructor
+        4) Through the bastion passed to the constructor, which is connected
+           to through the bastion defined by environment variables
+
+        Returns:
+            (None|SSHMaster) : Master connection or None if no tunnels are needed
+        """
+        proxy = aplnis_master()
+        if self.bastion_ip:
+            proxy = get_master(self.key,
+                               self.bastion_ip,
+                               self.bastion_port,
+                               self.bastion_user,
+                               proxy)
+        return proxy
+
+    def _master(self):
+        """Get the master connection to the remote machine, which is started
+
+        Returns:
+            (SSHMaster) : Master connection
+        """
+        master = get_master(self.key,
+                            self.remote_ip,
+                            self.remote_port,
+                            self.remote_user,
+                            self._proxy())
+        master.start()
+        return master
 
     @contextmanager
     def _connect(self):
-        """Create the needed SSH tunnel(s) based on constructor arguments / environment
+        """Create the needed SSH tunnel based on constructor arguments / environment
         variables.
 
-        There are 4 different tunnel configurations
-        1) No tunnels are needed / requested
-        2) One tunnel though the bastion defined by environment variables
-        3) One tunnel though the bastion passed to the constructor
-        4) Two tunnels one through the bastion defined by environment variables
-           and on throught he bastion passed to the constructor
-
         Returns:
             (hostname/ip, port) : Tuple of hostname/ip and port to connect to
                                   Needed so the calling method(s) know if they
                                   connect to localhost or remote_ip (depending
                                   on if a tunnel(s) was created
         """
-        if self.bastion_ip:
-            proc = create_tunnel_aplnis(self.key,
-                                        self.local_port, 
-                                        self.remote_ip,
-                                        self.remote_port, 
-                                        self.bastion_ip, 
-                                        self.bastion_user)
-        else:
-            proc = create_tunnel_bastion(self.local_port,
-                                         self.remote_ip,
-                                         self.remote_port)
-
-        if proc:
-            args = ("localhost", self.local_port)
-        else:
-            args = (self.remote_ip, self.remote_port)
+        proxy = self._proxy()
+        if proxy is None:
+            print("Bastion information not defined, connecting directly")
+            yield (self.remote_ip, self.remote_port)
+            return
 
+        proxy.forward(self.local_port, self.remote_ip, self.remote_port)
         try:
-            yield args
+            yield ("localhost", self.local_port)
         finally:
-            if proc:
-                proc.terminate()
-                proc.wait()
+            proxy.cancel(self.local_port, self.remote_ip, self.remote_port)
 
     def shell(self):
-        """Create SSH tunnel(s) through bastion machine(s) and start a foreground
-        SSH process.
+        """Start a foreground SSH process on the remote machine, through bastion
+        machine(s).
 
-        Create an SSH tunnel from the local machine to bastion that gets
-        forwarded to remote. Launch a second SSH connection (using
-        become_tty_fg) through the SSH tunnel to the remote machine.
-
-        After the second SSH session is complete, the SSH tunnel is destroyed.
+        The SSH session (using become_tty_fg) is multiplexed over the shared
+        master connection to the remote machine.
         """
+        master = self._master()
+        ret = subprocess.call(master.command(), close_fds=True, preexec_fn=become_tty_fg)
+        check_ssh(ret)
+        return ret
 
-        with self._connect() as host_port:
-            host, port = host_port
-            ssh_cmd = "ssh -i {} {} -p {} {}@{}" \
-                            .format(self.key, SSH_OPTIONS, port, self.remote_user, host)
-
-            ret = subprocess.call(shlex.split(ssh_cmd), close_fds=True, preexec_fn=become_tty_fg)
-            check_ssh(ret)
-            return ret
-
-    # DP TODO: combind scps and cmds together to a user can scp and ssh over the same tunnel
     @contextmanager
     def scps(self):
-        """Create SSH tunnel(s) through bastion machine(s) and return a function
-        that will copy files over SSH.
+        """Return a function that will copy files over SSH, through bastion
+        machine(s).
 
         with SSHConnection().scps() as scp:
             scp(local_file, remote_file, upload=False)
             scp(local_file, remote_file, upload=True)
         """
-        with self._connect() as host_port:
-            host, port = host_port
-            def scp(local_file, remote_file, upload=False):
-                first = local_file if upload else ""
-                second = "" if upload else local_file
-                scp_str = "scp -i {} {} -P {} {} {}@{}:{} {}" \
-                                .format(self.key, SSH_OPTIONS, port, first, self.remote_user, host, remote_file, second)
-                ret = subprocess.call(shlex.split(scp_str))
-                check_ssh(ret)
-                return ret
+        master = self._master()
+        def scp(local_file, remote_file, upload=False):
+            if upload:
+                cmd = master.copy(local_file, master.remote(remote_file))
+            else:
+                cmd = master.copy(master.remote(remote_file), local_file)
+            ret = subprocess.call(cmd)
+            check_ssh(ret)
+            return ret
+
+        yield scp
+
+    def sync(self, sources, destination, upload=True, parallel=SYNC_PARALLEL, delete=False):
+        """Copy files / directories to or from the remote machine, through bastion
+        machine(s).
+
+        rsync is used, so that only the parts of the files that changed are
+        sent, and they are compressed on the fly. The sources are split between
+        multiple rsync processes, which are multiplexed over the shared master
+        connection. If rsync is not installed locally, each source is copied
+        with scp instead.
 
-            yield scp
+        Args:
+            sources (string|list) : File / directory path or list of paths to copy.
+                                    Local paths if uploading, else remote paths
+            destination (string) : Path to copy to. Remote path if uploading, else
+                                   a local path. If multiple sources are given
+                                   it is a directory
+            upload (bool) : If the local files are being uploaded or the remote
+                            files are being downloaded
+            parallel (int) : Number of transfers to run at once
+            delete (bool) : If files in a destination directory that are not in
+                            the source should be deleted (rsync only)
+
+        Raises:
+            SSHError : If a transfer failed
+        """
+        if isinstance(sources, str):
+            sources = [sources]
+        if len(sources) == 0:
+            return
+
+        master = self._master()
+        if upload:
+            destination = master.remote(destination)
+        else:
+            sources = [master.remote(source) for source in sources]
+
+        if shutil.which("rsync"):
+            args = ["--delete"] if delete else []
+            cmds = [master.rsync(sources[i::parallel], destination, *args)
+                    for i in range(min(parallel, len(sources)))]
+        else:
+            cmds = [master.copy(source, destination, "-r", "-C") for source in sources]
+
+        with ThreadPoolExecutor(max_workers=min(parallel, len(cmds))) as pool:
+            rets = list(pool.map(subprocess.call, cmds))
+
+        for ret in rets:
+            check_ssh(ret)
+            if ret != 0:
+                raise SSHError("File transfer exited with error code {}".format(ret))
 
     def scp(self, local_file=None, remote_file=None, upload=None):
-        """Create SSH tunnel(s) through bastion machine(s) and execute a file copy over
-        SSH.
+        """Execute a file copy over SSH, through bastion machine(s).
 
         Args:
             local_file (None|String) : Local file path to upload from or download to.
@@ -336,42 +590,77 @@ class SSHConnection(object):
             upload_ = parse_upload(input("[u]pload / [D]ownload: ").strip())
 
         with self.scps() as cmd:
-            return cmd(local_file, remote_file, upload)
+            return cmd(local_file, remote_file, upload_)
 
     @contextmanager
     def cmds(self):
-        """Create SSH tunnel(s) through bastion machine(s) and return a function
-        that will execute commands over SSH.
+        """Return a function that will execute commands over SSH, through
+        bastion machine(s).
 
-        Create an SSH tunnel from the local machine to bastion that gets
-        forwarded to remote. Launch a second SSH connection through the SSH tunnel
-        to the remote machine and execute a command. After the command is complete
-        the connections are closed.
+        All of the commands are multiplexed over the shared master connection
+        to the remote machine, which is kept open for other commands.
 
         with SSHConnection().cmds() as cmd:
             cmd("command to execute")
             cmd("command to execute")
         """
-        with self._connect() as host_port:
-            host, port = host_port
-            def cmd(command):
-                ssh_cmd_str = "ssh -i {} {} -p {} {}@{} '{}'" \
-                                    .format(self.key, SSH_OPTIONS, port, self.remote_user, host, command)
+        master = self._master()
+        def cmd(command):
+            ret = subprocess.call(master.command(command))
+            check_ssh(ret)
+            return ret
 
-                ret = subprocess.call(shlex.split(ssh_cmd_str))
-                check_ssh(ret)
-                return ret
+        yield cmd
+
+    def run(self, command, timeout=None):
+        """Execute a command over SSH, through bastion machine(s), printing
+        the output line by line.
+
+        Used instead of cmd() when multiple commands are run at once, so that
+        the output can be labeled (see utils.prefixed_output()).
+
+        Args:
+            command (string) : Command to execute on remote_ip
+            timeout (None|int) : Seconds to wait for the command to finish
+
+        Returns:
+            (None|int) : Return code of the command or None if it timed out.
+                         The remote command may continue to run after a timeout
+        """
+        master = self._master()
+        proc = subprocess.Popen(master.command(command),
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+
+        timed_out = threading.Event()
+        def kill():
+            timed_out.set()
+            proc.kill()
+
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer:
+            timer.start()
+        try:
+            for line in proc.stdout:
+                print(line, end="")
+            ret = proc.wait()
+        finally:
+            if timer:
+                timer.cancel()
 
-            yield cmd
+        if timed_out.is_set():
+            return None
+
+        check_ssh(ret)
+        return ret
 
     def cmd(self, command = None):
-        """Create SSH tunnel(s) through bastion machine(s) and execute a command over
-        SSH.
+        """Execute a command over SSH, through bastion machine(s).
 
-        Create an SSH tunnel from the local machine to bastion that gets
-        forwarded to remote. Launch a second SSH connection through the SSH tunnel
-        to the remote machine and execute a command. After the command is complete
-        the connections are closed.
+        The command is multiplexed over the shared master connection to the
+        remote machine, see cmds().
 
         Args:
             command (None|string) : Command to execute on remote_ip. If command is
@@ -430,6 +719,45 @@ class SSHConnection(object):
                         .format(self.local_port, self.remote_ip, self.remote_port))
             input("Waiting to close tunnel...")
 
+def run_all(key, targets, command, bastion=None, concurrency=FLEET_CONCURRENCY, timeout=None):
+    """Execute a command on multiple machines at once, through bastion machine(s).
+
+    All of the connections share the master connection to the bastion. The
+    output of each machine is printed as it is received, prefixed with the
+    machine's IP.
+
+    Args:
+        key (string) : Path to a SSH private key, protected as required by SSH
+        targets (list) : List of targets, in the format accepted by SSHConnection
+        command (string) : Command to execute on each machine
+        bastion : Bastion to connect through, in the format accepted by SSHConnection
+        concurrency (int) : Number of machines to run the command on at once
+        timeout (None|int) : Seconds to wait for the command to finish on each machine
+
+    Returns:
+        (dict) : Dictionary of IP to return code (None if the command timed out)
+    """
+    if len(targets) == 0:
+        return {}
+
+    def run(target):
+        ip = unpack(target)[0]
+        with output.label(ip):
+            try:
+                ret = SSHConnection(key, target, bastion).run(command, timeout)
+                if ret is None:
+                    print("Timed out after {} seconds".format(timeout))
+                return ret
+            except SSHError as ex:
+                print(ex)
+                return 255
+
+    with prefixed_output() as output, \
+         ThreadPoolExecutor(max_workers=min(concurrency, len(targets))) as pool:
+        rets = list(pool.map(run, targets))
+
+    return {unpack(target)[0]: ret for target, ret in zip(targets, rets)}
+
 def vault_tunnel(key, bastion):
     ssh = SSHConnection(key, ("localhost", 3128), bastion, local_port=3128)
     return ssh.tunnel()
@@ -0,0 +1,441 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import aws
+
+
+class TestLookupCache(unittest.TestCase):
+    def make_session(self):
+        session = mock.MagicMock()
+        client = session.client.return_value
+        client.can_paginate.return_value = False
+        client.describe_vpcs.return_value = {'Vpcs': [{'VpcId': 'vpc-1234'}]}
+        return session, client
+
+    def test_lookup_is_cached(self):
+        session, client = self.make_session()
+
+        self.assertEqual('vpc-1234', aws.vpc_id_lookup(session, 'test.boss'))
+        self.assertEqual('vpc-1234', aws.vpc_id_lookup(session, 'test.boss'))
+        self.assertEqual(1, client.describe_vpcs.call_count)
+
+    def test_cache_is_per_session(self):
+        session, client = self.make_session()
+        session2, client2 = self.make_session()
+
+        aws.vpc_id_lookup(session, 'test.boss')
+        aws.vpc_id_lookup(session2, 'test.boss')
+        self.assertEqual(1, client.describe_vpcs.call_count)
+        self.assertEqual(1, client2.describe_vpcs.call_count)
+
+    def test_cache_is_per_argument(self):
+        session, client = self.make_session()
+
+        aws.vpc_id_lookup(session, 'test.boss')
+        aws.vpc_id_lookup(session, 'other.boss')
+        self.assertEqual(2, client.describe_vpcs.call_count)
+
+    def test_missing_result_not_cached(self):
+        session, client = self.make_session()
+        client.describe_vpcs.return_value = {'Vpcs': []}
+
+        self.assertIsNone(aws.vpc_id_lookup(session, 'test.boss'))
+        self.assertIsNone(aws.vpc_id_lookup(session, 'test.boss'))
+        self.assertEqual(2, client.describe_vpcs.call_count)
+
+    def test_invalidate(self):
+        session, client = self.make_session()
+
+        aws.vpc_id_lookup(session, 'test.boss')
+        aws.invalidate_lookups(session, 'vpc_id_lookup')
+        aws.vpc_id_lookup(session, 'test.boss')
+        self.assertEqual(2, client.describe_vpcs.call_count)
+
+    def test_invalidate_other_lookup(self):
+        session, client = self.make_session()
+
+        aws.vpc_id_lookup(session, 'test.boss')
+        aws.invalidate_lookups(session, 'subnet_id_lookup')
+        aws.vpc_id_lookup(session, 'test.boss')
+        self.assertEqual(1, client.describe_vpcs.call_count)
+
+    def test_ttl_expires(self):
+        session, client = self.make_session()
+        aws.lookup_cache(session).ttl = 0
+
+        aws.vpc_id_lookup(session, 'test.boss')
+        with mock.patch.object(aws.time, 'monotonic', return_value=aws.time.monotonic() + 1):
+            aws.vpc_id_lookup(session, 'test.boss')
+        self.assertEqual(2, client.describe_vpcs.call_count)
+
+    def test_stats(self):
+        session, client = self.make_session()
+
+        aws.vpc_id_lookup(session, 'test.boss')
+        aws.vpc_id_lookup(session, 'test.boss')
+        stats = aws.lookup_cache(session).stats['vpc_id_lookup']
+        self.assertEqual(2, stats['calls'])
+        self.assertEqual(1, stats['hits'])
+
+    def test_no_session(self):
+        self.assertIsNone(aws.vpc_id_lookup(None, 'test.boss'))
+
+    def test_result_is_copied(self):
+        session, client = self.make_session()
+        client.describe_security_groups.return_value = {
+            'SecurityGroups': [
+                {'GroupId': 'sg-1234', 'Tags': [{'Key': 'Name', 'Value': 'internal.test.boss'}]}
+            ]
+        }
+
+        sgs = aws.sg_lookup_all(session, 'vpc-1234')
+        sgs['other'] = 'sg-5678'
+
+        sgs = aws.sg_lookup_all(session, 'vpc-1234')
+        self.assertEqual({'internal.test.boss': 'sg-1234'}, sgs)
+        self.assertIsNone(sgs['other'])
+
+    def test_stack_lookups(self):
+        session, client = self.make_session()
+        client.describe_availability_zones.return_value = {'AvailabilityZones': [{'ZoneName': 'us-east-1b'}]}
+
+        aws.vpc_id_lookup(session, 'test.boss')
+        aws.azs_lookup(session)
+        aws.invalidate_lookups(session, *aws.STACK_LOOKUPS)
+        aws.vpc_id_lookup(session, 'test.boss')
+        aws.azs_lookup(session)
+        self.assertEqual(2, client.describe_vpcs.call_count)
+        self.assertEqual(1, client.describe_availability_zones.call_count)
+
+    @mock.patch.dict(os.environ, clear=True)
+    @mock.patch('builtins.input', return_value='1')
+    @mock.patch('sys.stdout')
+    def test_keypair_remembered(self, stdout, input):
+        session, client = self.make_session()
+        client.describe_key_pairs.return_value = {'KeyPairs': [{'KeyName': 'first'}, {'KeyName': 'second'}]}
+        aws.lookup_cache(session).ttl = 0
+
+        self.assertEqual('second', aws.keypair_lookup(session))
+        aws.invalidate_lookups(session)
+        with mock.patch.object(aws.time, 'monotonic', return_value=aws.time.monotonic() + 1):
+            self.assertEqual('second', aws.keypair_lookup(session))
+        self.assertEqual(1, input.call_count)
+
+
+class TestClientPool(unittest.TestCase):
+    def test_client_reused(self):
+        session = mock.MagicMock()
+        session.client.side_effect = lambda *args, **kwargs: mock.MagicMock()
+
+        client = aws.get_client(session, 'ec2')
+        self.assertIs(client, aws.get_client(session, 'ec2'))
+        self.assertEqual(1, session.client.call_count)
+
+    def test_client_per_service_and_region(self):
+        session = mock.MagicMock()
+        session.client.side_effect = lambda *args, **kwargs: mock.MagicMock()
+
+        client = aws.get_client(session, 'ec2')
+        self.assertIsNot(client, aws.get_client(session, 'iam'))
+        self.assertIsNot(client, aws.get_client(session, 'ec2', 'us-west-2'))
+        self.assertEqual(3, session.client.call_count)
+
+    def test_client_per_session(self):
+        session = mock.MagicMock()
+        session2 = mock.MagicMock()
+
+        aws.get_client(session, 'ec2')
+        aws.get_client(session2, 'ec2')
+        self.assertEqual(1, session.client.call_count)
+        self.assertEqual(1, session2.client.call_count)
+
+
+class TestPaginate(unittest.TestCase):
+    def make_client(self, pages):
+        client = mock.MagicMock()
+        client.can_paginate.return_value = True
+        client.get_paginator.return_value.paginate.return_value = iter(pages)
+        return client
+
+    def test_all_pages(self):
+        client = self.make_client([
+            {'Topics': [{'TopicArn': 'a'}, {'TopicArn': 'b'}]},
+            {'Topics': [{'TopicArn': 'c'}]},
+            {},
+        ])
+
+        topics = aws.paginate(client, 'list_topics', 'Topics')
+        self.assertEqual(['a', 'b', 'c'], [t['TopicArn'] for t in topics])
+        client.get_paginator.assert_called_with('list_topics')
+
+    def test_stops_early(self):
+        pages = iter([
+            {'Topics': [{'TopicArn': 'a'}]},
+            {'Topics': [{'TopicArn': 'b'}]},
+        ])
+        client = self.make_client(pages)
+
+        self.assertEqual({'TopicArn': 'a'}, aws.first(aws.paginate(client, 'list_topics', 'Topics')))
+        self.assertEqual({'Topics': [{'TopicArn': 'b'}]}, next(pages))
+
+    def test_not_pageable(self):
+        client = mock.MagicMock()
+        client.can_paginate.return_value = False
+        client.describe_vpcs.return_value = {'Vpcs': [{'VpcId': 'vpc-1234'}]}
+
+        vpcs = list(aws.paginate(client, 'describe_vpcs', 'Vpcs', Filters=[]))
+        self.assertEqual([{'VpcId': 'vpc-1234'}], vpcs)
+        client.describe_vpcs.assert_called_with(Filters=[])
+
+    def test_lookup_across_pages(self):
+        session = mock.MagicMock()
+        client = self.make_client([
+            {'LoadBalancerDescriptions': [{'LoadBalancerName': 'auth-test-boss'}]},
+            {'LoadBalancerDescriptions': [{'LoadBalancerName': 'api-test-boss'}]},
+        ])
+        session.client.return_value = client
+
+        self.assertTrue(aws.lb_lookup(session, 'api.test.boss'))
+
+
+class TestArnIndexes(unittest.TestCase):
+    def make_session(self, **pages):
+        session = mock.MagicMock()
+        client = session.client.return_value
+        client.can_paginate.return_value = True
+        client.get_paginator.side_effect = lambda operation: mock.MagicMock(**{
+            'paginate.return_value': pages[operation]
+        })
+        return session, client
+
+    def test_certificate_index(self):
+        index = aws.CertificateIndex([
+            ('*.thebossdev.io', 'wildcard'),
+            ('*.test.thebossdev.io', 'test-wildcard'),
+            ('auth.test.thebossdev.io', 'auth'),
+            ('*.thebossdev.io', 'duplicate'),
+        ])
+
+        self.assertEqual('auth', index.get('auth.test.thebossdev.io'))
+        self.assertEqual('test-wildcard', index.get('api.test.thebossdev.io'))
+        self.assertEqual('wildcard', index.get('api.thebossdev.io'))
+        self.assertEqual('wildcard', index.get('a.b.thebossdev.io'))
+        self.assertIsNone(index.get('thebossdev.io'))
+        self.assertIsNone(index.get('api.theboss.io'))
+
+    def test_cert_lookup_lists_once(self):
+        session, client = self.make_session(list_certificates=[{
+            'CertificateSummaryList': [
+                {'DomainName': '*.thebossdev.io', 'CertificateArn': 'wildcard'},
+                {'DomainName': 'auth.thebossdev.io', 'CertificateArn': 'auth'},
+            ]
+        }])
+
+        self.assertEqual('auth', aws.cert_arn_lookup(session, 'auth.thebossdev.io'))
+        self.assertEqual('wildcard', aws.cert_arn_lookup(session, 'api.thebossdev.io'))
+        self.assertEqual(1, client.get_paginator.call_count)
+
+    def test_topic_lookup(self):
+        session, client = self.make_session(list_topics=[
+            {'Topics': [{'TopicArn': 'arn:aws:sns:us-east-1:123:dns-test-boss'}]},
+            {'Topics': [{'TopicArn': 'arn:aws:sns:us-east-1:123:MailingList'}]},
+        ])
+
+        class NotFoundException(Exception):
+            pass
+        client.exceptions.NotFoundException = NotFoundException
+        client.get_topic_attributes.side_effect = NotFoundException()
+
+        self.assertEqual('arn:aws:sns:us-east-1:123:MailingList',
+                         aws.sns_topic_lookup(session, 'MailingList'))
+        client.get_topic_attributes.assert_not_called()
+        self.assertIsNone(aws.sns_topic_lookup(session, 'Missing'))
+        self.assertEqual(1, client.get_paginator.call_count)
+
+    def test_topic_lookup_falls_back(self):
+        session, client = self.make_session(list_topics=[
+            {'Topics': [{'TopicArn': 'arn:aws:sns:us-east-1:123:MailingList'}]},
+        ])
+        session.region_name = 'us-east-1'
+        client.list_users.return_value = {'Users': [{'Arn': 'arn:aws:iam::123:user/test'}]}
+
+        self.assertEqual('arn:aws:sns:us-east-1:123:dns-test-boss',
+                         aws.sns_topic_lookup(session, 'dns-test-boss'))
+        client.get_topic_attributes.assert_called_once_with(TopicArn='arn:aws:sns:us-east-1:123:dns-test-boss')
+
+    def test_cert_lookup_relists_missing(self):
+        session, client = self.make_session(list_certificates=[{
+            'CertificateSummaryList': [
+                {'DomainName': 'auth.thebossdev.io', 'CertificateArn': 'auth'},
+            ]
+        }])
+
+        self.assertIsNone(aws.cert_arn_lookup(session, 'api.thebossdev.io'))
+        self.assertEqual(2, client.get_paginator.call_count)
+
+    def test_role_lookup_falls_back(self):
+        session, client = self.make_session(list_roles=[
+            {'Roles': [{'RoleName': 'endpoint', 'Arn': 'arn:endpoint'}]},
+        ])
+        client.get_role.return_value = {'Role': {'Arn': 'arn:new'}}
+
+        self.assertEqual('arn:endpoint', aws.role_arn_lookup(session, 'endpoint'))
+        client.get_role.assert_not_called()
+        self.assertEqual('arn:new', aws.role_arn_lookup(session, 'new'))
+        client.get_role.assert_called_once_with(RoleName='new')
+
+
+class TestInstanceInventory(unittest.TestCase):
+    def make_instance(self, id, name, state='running', az='us-east-1a', **kwargs):
+        instance = {
+            'InstanceId': id,
+            'State': {'Name': state},
+            'Placement': {'AvailabilityZone': az},
+            'Tags': [{'Key': 'Name', 'Value': name}],
+        }
+        instance.update(kwargs)
+        return instance
+
+    def make_session(self, instances):
+        session = mock.MagicMock()
+        client = session.client.return_value
+        client.can_paginate.side_effect = lambda operation: operation == 'describe_instances'
+        client.describe_vpcs.return_value = {'Vpcs': [{'VpcId': 'vpc-1234'}]}
+        paginator = client.get_paginator.return_value
+        paginator.paginate.return_value = [
+            {'Reservations': [{'Instances': instances[:1]}]},
+            {'Reservations': [{'Instances': instances[1:]}]},
+        ]
+        return session, paginator
+
+    def test_indexes(self):
+        inventory = aws.InstanceInventory([
+            self.make_instance('i-2', 'vault.test.boss', az='us-east-1b'),
+            self.make_instance('i-1', 'vault.test.boss'),
+            self.make_instance('i-3', 'auth.test.boss', state='stopped'),
+        ])
+
+        self.assertEqual(['i-1', 'i-2'], [i['InstanceId'] for i in inventory.named('vault.test.boss')])
+        self.assertEqual(['i-1', 'i-3'], [i['InstanceId'] for i in inventory.in_az('us-east-1a')])
+        self.assertEqual([], inventory.named('auth.test.boss', 'running'))
+        self.assertEqual(3, len(inventory))
+
+    def test_lookups_share_snapshot(self):
+        session, paginator = self.make_session([
+            self.make_instance('i-2', 'vault.test.boss', PrivateIpAddress='10.0.0.2'),
+            self.make_instance('i-1', 'vault.test.boss', PrivateIpAddress='10.0.0.1'),
+            self.make_instance('i-3', 'auth.test.boss', PublicIpAddress='1.2.3.4',
+                               PublicDnsName='auth.example.com'),
+        ])
+
+        self.assertEqual(['10.0.0.1', '10.0.0.2'],
+                         aws.machine_lookup_all(session, 'vault.test.boss', public_ip=False))
+        self.assertEqual('10.0.0.2', aws.machine_lookup(session, '1.vault.test.boss', public_ip=False))
+        self.assertEqual('1.2.3.4', aws.machine_lookup(session, 'auth.test.boss'))
+        self.assertEqual('i-3', aws.instanceid_lookup(session, 'auth.test.boss'))
+        self.assertEqual('auth.example.com', aws.instance_public_lookup(session, 'auth.test.boss'))
+
+        self.assertEqual(1, paginator.paginate.call_count)
+        paginator.paginate.assert_called_with(Filters=[{'Name': 'vpc-id', 'Values': ['vpc-1234']}])
+
+        paginator.paginate.return_value = []
+        self.assertIsNone(aws.instanceid_lookup(session, 'missing.test.boss'))
+
+    def test_asg_name_from_tags(self):
+        tags = [{'Key': 'Name', 'Value': 'consul.test.boss'},
+                {'Key': 'aws:autoscaling:groupName', 'Value': 'CoreTestBoss-Consul'}]
+        session, paginator = self.make_session([
+            self.make_instance('i-1', 'consul.test.boss', Tags=tags),
+        ])
+
+        self.assertEqual('CoreTestBoss-Consul', aws.asg_name_lookup(session, 'consul.test.boss'))
+        session.client.return_value.describe_auto_scaling_groups.assert_not_called()
+
+    def test_empty_snapshot_not_cached(self):
+        session, paginator = self.make_session([])
+
+        aws.inventory_lookup(session, 'vpc-1234')
+        aws.inventory_lookup(session, 'vpc-1234')
+        self.assertEqual(2, paginator.paginate.call_count)
+
+    def test_missing_hostname_requested_directly(self):
+        session, paginator = self.make_session([
+            self.make_instance('i-1', 'auth.test.boss', PublicIpAddress='1.2.3.4'),
+        ])
+        launched = self.make_instance('i-2', 'vault.test.boss', PublicIpAddress='5.6.7.8')
+        snapshot = paginator.paginate.return_value
+        paginator.paginate.side_effect = lambda Filters: \
+            snapshot if Filters[0]['Name'] == 'vpc-id' else [{'Reservations': [{'Instances': [launched]}]}]
+
+        self.assertEqual('1.2.3.4', aws.machine_lookup(session, 'auth.test.boss'))
+        self.assertEqual('5.6.7.8', aws.machine_lookup(session, 'vault.test.boss'))
+        paginator.paginate.assert_called_with(Filters=[
+            {'Name': 'tag:Name', 'Values': ['vault.test.boss']},
+            {'Name': 'instance-state-name', 'Values': ['running']},
+        ])
+        self.assertEqual(2, paginator.paginate.call_count)
+
+
+class TestDeleteAll(unittest.TestCase):
+    def make_session(self, pages):
+        session = mock.MagicMock()
+        client = session.client.return_value
+        client.can_paginate.return_value = True
+        client.get_paginator.return_value.paginate.side_effect = \
+            lambda **kwargs: pages(**kwargs)
+        return session, client
+
+    def test_policy_detached(self):
+        def pages(PolicyArn=None, EntityFilter=None, **kwargs):
+            if EntityFilter is None:
+                return [{'Policies': [{'PolicyName': 'test-boss-attached', 'Arn': 'arn:attached', 'AttachmentCount': 3},
+                                      {'PolicyName': 'test-boss-unused', 'Arn': 'arn:unused', 'AttachmentCount': 0},
+                                      {'PolicyName': 'other-boss', 'Arn': 'arn:other', 'AttachmentCount': 0}]}]
+            key = 'Policy{}s'.format(EntityFilter)
+            return [{key: [{EntityFilter + 'Name': EntityFilter.lower() + '1'}]},
+                    {key: [{EntityFilter + 'Name': EntityFilter.lower() + '2'}]}]
+        session, client = self.make_session(pages)
+
+        aws.policy_delete_all(session, 'test.boss')
+
+        client.detach_group_policy.assert_has_calls([mock.call(GroupName='group1', PolicyArn='arn:attached'),
+                                                     mock.call(GroupName='group2', PolicyArn='arn:attached')])
+        client.detach_user_policy.assert_has_calls([mock.call(UserName='user1', PolicyArn='arn:attached'),
+                                                    mock.call(UserName='user2', PolicyArn='arn:attached')])
+        client.detach_role_policy.assert_has_calls([mock.call(RoleName='role1', PolicyArn='arn:attached'),
+                                                    mock.call(RoleName='role2', PolicyArn='arn:attached')])
+        self.assertEqual([mock.call(PolicyArn='arn:attached'), mock.call(PolicyArn='arn:unused')],
+                         client.delete_policy.call_args_list)
+
+    def test_unsubscribe_missing_topic(self):
+        class NotFoundException(Exception):
+            pass
+
+        def pages(**kwargs):
+            raise NotFoundException()
+        session, client = self.make_session(pages)
+        client.exceptions.NotFoundException = NotFoundException
+
+        self.assertIsNone(aws.sns_unsubscribe_all(session, 'dns.test.boss', account='123'))
+        client.unsubscribe.assert_not_called()
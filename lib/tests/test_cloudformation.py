@@ -0,0 +1,210 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+from datetime import datetime
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import cloudformation
+
+
+STACK = 'CoreTestBoss'
+
+def event(id, status, key=STACK, type_=cloudformation.StackWaiter.STACK_TYPE, reason=None):
+    event = {
+        'EventId': id,
+        'Timestamp': datetime(2017, 1, 1),
+        'ResourceStatus': status,
+        'ResourceType': type_,
+        'LogicalResourceId': key,
+    }
+    if reason is not None:
+        event['ResourceStatusReason'] = reason
+    return event
+
+def make_client(*responses):
+    """Create a client that returns the given lists of events (oldest first)
+    from successive describe_stack_events calls"""
+    client = mock.MagicMock()
+    client.can_paginate.return_value = False
+    client.describe_stack_events.side_effect = [
+        {'StackEvents': list(reversed(events))} for events in responses
+    ]
+    return client
+
+
+@mock.patch.object(cloudformation.time, 'sleep')
+@mock.patch('builtins.print')
+class TestStackWaiter(unittest.TestCase):
+    def test_wait_for_create(self, print_, sleep):
+        started = [event('1', 'CREATE_IN_PROGRESS')]
+        resource = started + [event('2', 'CREATE_IN_PROGRESS', 'VPC', 'AWS::EC2::VPC')]
+        done = resource + [event('3', 'CREATE_COMPLETE', 'VPC', 'AWS::EC2::VPC'),
+                           event('4', 'CREATE_COMPLETE')]
+        client = make_client(started, resource, resource, resource, done)
+
+        waiter = cloudformation.StackWaiter(client, STACK)
+        self.assertEqual('CREATE_COMPLETE', waiter.wait('create', 'CREATE_IN_PROGRESS'))
+        self.assertEqual([], waiter.failures)
+
+        # Backs off while there are no new events
+        delays = [c[0][0] for c in sleep.call_args_list]
+        self.assertEqual([2, 2, 4, 8], delays)
+
+    def test_mark_skips_old_events(self, print_, sleep):
+        old = [event('1', 'CREATE_IN_PROGRESS'), event('2', 'CREATE_COMPLETE')]
+        new = old + [event('3', 'UPDATE_IN_PROGRESS'),
+                     event('4', 'UPDATE_FAILED', 'Vault', 'AWS::EC2::Instance', 'Limit exceeded'),
+                     event('5', 'UPDATE_ROLLBACK_IN_PROGRESS')]
+        client = make_client(old, new)
+
+        waiter = cloudformation.StackWaiter(client, STACK)
+        waiter.mark()
+        self.assertEqual('UPDATE_ROLLBACK_IN_PROGRESS', waiter.wait('update', 'UPDATE_IN_PROGRESS'))
+        self.assertEqual([('Vault', 'AWS::EC2::Instance', 'Limit exceeded')], waiter.failures)
+        sleep.assert_not_called()
+
+    def test_backoff(self, print_, sleep):
+        delays = cloudformation.backoff(1, 5)
+        self.assertEqual([1, 2, 4, 5, 5], [next(delays) for i in range(5)])
+
+
+@mock.patch('builtins.print')
+class TestTemplateHash(unittest.TestCase):
+    def make_config(self):
+        config = cloudformation.CloudFormationConfiguration('core', 'test.boss')
+        config.add_vpc()
+        config.add_arg(cloudformation.Arg.String('Key', 'value'))
+        return config
+
+    def make_client(self, template_hash, status='UPDATE_COMPLETE'):
+        client = mock.MagicMock()
+        client.describe_stacks.return_value = {'Stacks': [{
+            'StackStatus': status,
+            'Tags': [{'Key': cloudformation.TEMPLATE_HASH_TAG, 'Value': template_hash}],
+        }]}
+        return client
+
+    def test_hash_changes(self, print_):
+        config = self.make_config()
+        config2 = self.make_config()
+        self.assertEqual(config.template_hash(), config2.template_hash())
+
+        config2.arguments[0]['ParameterValue'] = 'other'
+        self.assertNotEqual(config.template_hash(), config2.template_hash())
+
+    def test_update_skipped(self, print_):
+        config = self.make_config()
+        client = self.make_client(config.template_hash())
+
+        with mock.patch.object(cloudformation.aws, 'get_client', return_value=client):
+            self.assertIsNone(config.update(mock.MagicMock()))
+        client.create_change_set.assert_not_called()
+        client.update_stack.assert_not_called()
+
+    def test_update_not_skipped_after_failure(self, print_):
+        config = self.make_config()
+        client = self.make_client(config.template_hash(), 'UPDATE_ROLLBACK_COMPLETE')
+
+        with mock.patch.dict(os.environ, {'DISABLE_PREVIEW': 'true'}), \
+             mock.patch.object(cloudformation.utils, 'get_commit', return_value='abc'), \
+             mock.patch.object(cloudformation.aws, 'get_client', return_value=client):
+            config.update(mock.MagicMock(), wait=False)
+        client.update_stack.assert_called_once()
+        tags = client.update_stack.call_args[1]['Tags']
+        self.assertIn({'Key': cloudformation.TEMPLATE_HASH_TAG, 'Value': config.template_hash()}, tags)
+
+
+class TestTemplateSource(unittest.TestCase):
+    def make_config(self, size):
+        config = cloudformation.CloudFormationConfiguration('core', 'test.boss')
+        config.add_arg(cloudformation.Arg.String('Key', 'x' * size))
+        config.parameters['Key']['Description'] = 'x' * size
+        return config
+
+    def create(self, config):
+        client = mock.MagicMock()
+        with mock.patch.object(cloudformation.utils, 'get_commit', return_value='abc'), \
+             mock.patch.object(cloudformation.aws, 'get_lambda_s3_bucket', return_value='bucket'), \
+             mock.patch.object(cloudformation.aws, 'get_client', return_value=client), \
+             mock.patch('builtins.print'):
+            config.create(mock.MagicMock(), wait=False)
+        return client
+
+    def test_template_body(self):
+        config = self.make_config(100)
+        client = self.create(config)
+
+        kwargs = client.create_stack.call_args[1]
+        self.assertEqual(config._create_template(), kwargs['TemplateBody'])
+        self.assertNotIn('TemplateURL', kwargs)
+        client.put_object.assert_not_called()
+
+    def test_template_url(self):
+        config = self.make_config(cloudformation.TEMPLATE_BODY_LIMIT)
+        client = self.create(config)
+
+        key = 'cloudformation/CoreTestBoss/{}.template'.format(config.template_hash())
+        kwargs = client.create_stack.call_args[1]
+        self.assertEqual('https://bucket.s3.amazonaws.com/' + key, kwargs['TemplateURL'])
+        self.assertNotIn('TemplateBody', kwargs)
+        client.put_object.assert_called_once_with(Bucket='bucket', Key=key,
+                                                  Body=config._create_template().encode('utf-8'))
+
+    def test_template_too_large(self):
+        config = self.make_config(cloudformation.TEMPLATE_URL_LIMIT)
+        with self.assertRaises(Exception):
+            self.create(config)
+
+
+@mock.patch.object(cloudformation.aws, 'invalidate_lookups')
+@mock.patch('builtins.print')
+class TestDelete(unittest.TestCase):
+    def delete(self, error):
+        client = make_client([event('1', 'CREATE_COMPLETE')])
+        client.describe_stack_events.side_effect = [
+            {'StackEvents': [event('1', 'CREATE_COMPLETE')]},
+            cloudformation.ClientError({'Error': error}, 'DescribeStackEvents'),
+        ]
+        config = cloudformation.CloudFormationConfiguration('core', 'test.boss')
+        with mock.patch.object(cloudformation.aws, 'get_client', return_value=client):
+            return config.delete(mock.MagicMock())
+
+    def test_stack_gone(self, print_, invalidate):
+        error = {'Code': 'ValidationError', 'Message': 'Stack with id CoreTestBoss does not exist'}
+        self.assertTrue(self.delete(error))
+
+    def test_other_errors_raised(self, print_, invalidate):
+        with self.assertRaises(cloudformation.ClientError):
+            self.delete({'Code': 'Throttling', 'Message': 'Rate exceeded'})
+
+class TestResourceSizes(unittest.TestCase):
+    def test_sizes(self):
+        config = cloudformation.CloudFormationConfiguration('core', 'test.boss')
+        config.add_vpc()
+
+        sizes = config.resource_sizes()
+        self.assertEqual(['AWS::EC2::VPC', 'AWS::Route53::HostedZone'], sorted(sizes))
+        self.assertEqual('VPC', sizes['AWS::EC2::VPC'][0][0])
+
+        # Resource sizes plus the template's structure
+        total = sum(size for type_ in sizes.values() for key, size in type_)
+        self.assertLess(total, config.template_size())
@@ -0,0 +1,319 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import sys
+import json
+import unittest
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import constants as const
+
+sys.path.append(os.path.dirname(const.INGEST_LAMBDA))
+import ingest_queue_upload as upload
+
+
+def make_args(**kwargs):
+    args = {
+        'job_id': 1,
+        'upload_queue': 'https://queue.amazonaws.com/123456789012/upload-test',
+        'ingest_queue': 'https://queue.amazonaws.com/123456789012/ingest-test',
+        'project_info': ['1', '2', '3'],
+        'resolution': 0,
+        't_start': 0, 't_stop': 2, 't_tile_size': 1,
+        'x_start': 0, 'x_stop': 1024, 'x_tile_size': 512,
+        'y_start': 0, 'y_stop': 1536, 'y_tile_size': 512,
+        'z_start': 0, 'z_stop': 40, 'z_tile_size': 16,
+        'final_z_stop': 40,
+    }
+    args.update(kwargs)
+    return args
+
+def invoke_response(result, error=False):
+    resp = {'Payload': io.BytesIO(json.dumps(result).encode())}
+    if error:
+        resp['FunctionError'] = 'Unhandled'
+    return resp
+
+class FakeContext(object):
+    function_name = 'IngestUpload-test'
+
+    def __init__(self, remaining=upload.LAMBDA_TIMEOUT):
+        self.remaining = remaining
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining * 1000
+
+class TestCreateMessages(unittest.TestCase):
+    def test_matches_v1_bodies(self):
+        # Expected bodies and order come from the original nested-loop generator
+        args = make_args(job_id=7, upload_queue='upload', ingest_queue='ingest',
+                         t_stop=1, x_stop=512, y_start=512, y_stop=1024,
+                         z_stop=6, z_tile_size=4, final_z_stop=6)
+        expected = [
+            '{"job_id": 7, "upload_queue_arn": "upload", "ingest_queue_arn": "ingest", "chunk_key": "969fd1f805f59a07778df5c641438a89&4&1&2&3&0&0&1&0&0", "tile_key": "c7199e33b864778ca211fb88b3d002cd&1&2&3&0&0&1&0&0"}',
+            '{"job_id": 7, "upload_queue_arn": "upload", "ingest_queue_arn": "ingest", "chunk_key": "969fd1f805f59a07778df5c641438a89&4&1&2&3&0&0&1&0&0", "tile_key": "6d53a1259e930a435ef4d11330d9225a&1&2&3&0&0&1&1&0"}',
+            '{"job_id": 7, "upload_queue_arn": "upload", "ingest_queue_arn": "ingest", "chunk_key": "969fd1f805f59a07778df5c641438a89&4&1&2&3&0&0&1&0&0", "tile_key": "aa403481d10819eb684d99f885576721&1&2&3&0&0&1&2&0"}',
+            '{"job_id": 7, "upload_queue_arn": "upload", "ingest_queue_arn": "ingest", "chunk_key": "969fd1f805f59a07778df5c641438a89&4&1&2&3&0&0&1&0&0", "tile_key": "32e55fc1ef027bccc3f4819d2c7d0704&1&2&3&0&0&1&3&0"}',
+            '{"job_id": 7, "upload_queue_arn": "upload", "ingest_queue_arn": "ingest", "chunk_key": "29c399f1ccadfb4c4f0835fa349d4ed1&2&1&2&3&0&0&1&1&0", "tile_key": "2cb2ba519a32dda73777250c3d2b21d3&1&2&3&0&0&1&4&0"}',
+            '{"job_id": 7, "upload_queue_arn": "upload", "ingest_queue_arn": "ingest", "chunk_key": "29c399f1ccadfb4c4f0835fa349d4ed1&2&1&2&3&0&0&1&1&0", "tile_key": "d9f93a44abaa5df8c2e60c28d4ef6552&1&2&3&0&0&1&5&0"}',
+        ]
+
+        self.assertEqual(expected, list(upload.create_messages(args)))
+
+@mock.patch('sys.stdout', new_callable=io.StringIO)
+@mock.patch.object(upload.boto3, 'client')
+class TestPopulateShards(unittest.TestCase):
+    def test_failed_shard_keeps_progress(self, client, stdout):
+        shards = upload.split_shards(make_args(), 3)
+        done = dict(shards[0], sent=upload.count_messages(shards[0]),
+                    cursor=upload.count_messages(shards[0]), finished=True)
+        partial = dict(shards[1], sent=10, cursor=10, finished=False)
+        client.return_value.invoke.side_effect = [
+            invoke_response(done),
+            invoke_response(partial),
+            invoke_response({'errorMessage': 'timeout'}, error=True),
+        ]
+
+        sent, pending, errors = upload.populate_shards('IngestUpload', shards)
+
+        self.assertEqual(upload.count_messages(shards[0]) + 10, sent)
+        self.assertEqual([], errors)
+        self.assertEqual(2, len(pending))
+        self.assertEqual(10, pending[0]['cursor'])
+        self.assertEqual(shards[2]['z_start'], pending[1]['z_start'])
+        self.assertNotIn('cursor', pending[1])
+        self.assertEqual(1, pending[1]['failures'])
+
+    def test_errors_raised_after_saving(self, client, stdout):
+        args = make_args(shards=2)
+        shards = upload.split_shards(args, 2)
+        client.return_value.invoke.side_effect = [
+            invoke_response(dict(shards[0], sent=5, cursor=10, finished=False)),
+            invoke_response(dict(shards[1], sent=10, cursor=10, finished=False)),
+        ]
+
+        result = upload.handler(args, FakeContext())
+        self.assertFalse(result['finished'])
+        self.assertEqual(15, result['sent'])
+        self.assertEqual(1, len(result['shard_errors']))
+
+        # The next call raises without invoking any shards
+        client.return_value.invoke.reset_mock()
+        with self.assertRaises(upload.FailedToSendMessages):
+            upload.handler(result, FakeContext())
+        client.return_value.invoke.assert_not_called()
+
+    def test_shard_retries_exhausted(self, client, stdout):
+        shards = upload.split_shards(make_args(), 2)
+        shards[1]['failures'] = upload.SHARD_RETRIES + 1
+        shards[1]['error'] = 'Shard failed'
+        args = make_args(pending_shards=shards)
+
+        with self.assertRaises(upload.FailedToSendMessages):
+            upload.handler(args, FakeContext())
+        client.return_value.invoke.assert_not_called()
+
+    def test_shards_stop_before_parent(self, client, stdout):
+        args = make_args(shards=2)
+        shards = upload.split_shards(args, 2)
+        client.return_value.invoke.side_effect = [
+            invoke_response(dict(shards[0], sent=10, cursor=10, finished=False)),
+            invoke_response(dict(shards[1], sent=10, cursor=10, finished=False)),
+        ]
+
+        upload.handler(args, FakeContext())
+
+        # The shards stop sending, and the invoke times out, before this lambda does
+        timeout = client.call_args[1]['config'].read_timeout
+        self.assertLessEqual(timeout, upload.LAMBDA_TIMEOUT - upload.SHARD_MARGIN)
+        for call in client.return_value.invoke.call_args_list:
+            payload = json.loads(call[1]['Payload'].decode())
+            self.assertLessEqual(payload['time_limit'] + upload.RESUME_MARGIN, timeout - upload.SHARD_MARGIN)
+
+    def test_read_timeout_keeps_shard(self, client, stdout):
+        shards = upload.split_shards(make_args(), 2)
+        client.return_value.invoke.side_effect = [
+            invoke_response(dict(shards[0], sent=10, cursor=10, finished=False)),
+            upload.ReadTimeoutError(endpoint_url='https://lambda'),
+        ]
+
+        sent, pending, errors = upload.populate_shards('IngestUpload', shards)
+
+        self.assertEqual(10, sent)
+        self.assertEqual([], errors)
+        self.assertEqual(2, len(pending))
+        self.assertNotIn('cursor', pending[1])
+        self.assertEqual(1, pending[1]['failures'])
+
+    def test_shard_send_error(self, client, stdout):
+        shards = upload.split_shards(make_args(), 2)
+        client.return_value.invoke.side_effect = [
+            invoke_response(dict(shards[0], sent=10, cursor=10, finished=False)),
+            invoke_response(dict(shards[1], sent=20, cursor=10, finished=False,
+                                 send_error='ClientError: Denied')),
+        ]
+
+        sent, pending, errors = upload.populate_shards('IngestUpload', shards)
+
+        self.assertEqual(30, sent)
+        self.assertEqual([10, 10], [shard['cursor'] for shard in pending])
+        self.assertEqual(1, len(errors))
+        self.assertIn('ClientError: Denied', errors[0])
+
+    def test_not_enough_time(self, client, stdout):
+        args = make_args(shards=2)
+        context = FakeContext(upload.RESUME_MARGIN + upload.SHARD_MARGIN)
+
+        result = upload.handler(args, context)
+        self.assertFalse(result['finished'])
+        self.assertEqual(upload.split_shards(args, 2), result['pending_shards'])
+        client.return_value.invoke.assert_not_called()
+
+    def test_shard_time_limit(self, client, stdout):
+        args = make_args(shards=1, time_limit=0)
+
+        result = upload.handler(args, FakeContext())
+        self.assertFalse(result['finished'])
+        self.assertEqual(0, result['cursor'])
+        client.return_value.send_message_batch.assert_not_called()
+
+class TestCursor(unittest.TestCase):
+    def test_round_trip(self):
+        args = make_args()
+        for cursor in range(upload.count_messages(args)):
+            start = upload.decode_cursor(args, cursor)
+            self.assertEqual(cursor, upload.encode_cursor(args, *start))
+        self.assertIsNone(upload.decode_cursor(args, upload.count_messages(args)))
+
+    def test_resume(self):
+        args = make_args()
+        msgs = list(upload.create_messages(args))
+        self.assertEqual(upload.count_messages(args), len(msgs))
+
+        # Resume at chunk boundaries, partway through a chunk, and at the end
+        for cursor in (1, 15, 16, 100, 200, len(msgs) - 1, len(msgs)):
+            self.assertEqual(msgs[cursor:], list(upload.create_messages(args, cursor)))
+
+class TestSplitShards(unittest.TestCase):
+    def test_shards_cover_job(self):
+        for kwargs in ({}, {'t_stop': 5, 'z_stop': 16, 'final_z_stop': 16}):
+            args = make_args(**kwargs)
+            msgs = list(upload.create_messages(args))
+
+            for count in (1, 2, 3, 7):
+                shards = upload.split_shards(args, count)
+                self.assertLessEqual(len(shards), count)
+
+                shard_msgs = [msg for shard in shards for msg in upload.create_messages(shard)]
+                self.assertEqual(sorted(msgs), sorted(shard_msgs))
+                self.assertEqual(len(msgs), sum(upload.count_messages(shard) for shard in shards))
+
+class TestSendBatch(unittest.TestCase):
+    def test_pack_batches(self):
+        msgs = ['a' * 100] * 25 + ['b' * (upload.SQS_MAX_BATCH_BYTES - 50)]
+        batches = list(upload.pack_batches(iter(msgs)))
+
+        self.assertEqual([10, 10, 5, 1], [len(batch) for batch in batches])
+        self.assertEqual(msgs, [entry['MessageBody'] for batch in batches for entry in batch])
+        for batch in batches:
+            self.assertEqual([str(i) for i in range(len(batch))], [entry['Id'] for entry in batch])
+
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    @mock.patch.object(upload.time, 'sleep')
+    def test_retry_failed_entries(self, sleep, stdout):
+        batch = list(upload.pack_batches(['a', 'b', 'c']))[0]
+        client = mock.MagicMock()
+        client.send_message_batch.side_effect = [
+            {'Successful': [{'Id': '0'}], 'Failed': [{'Id': '1'}, {'Id': '2'}]},
+            {'Successful': [{'Id': '2'}], 'Failed': [{'Id': '1'}]},
+            {'Successful': [{'Id': '1'}]},
+        ]
+
+        self.assertEqual(3, upload.send_batch(client, 'queue', batch))
+        retried = [c[1]['Entries'] for c in client.send_message_batch.call_args_list]
+        self.assertEqual([['b', 'c'], ['b']], [[e['MessageBody'] for e in entries] for entries in retried[1:]])
+        self.assertEqual(2, sleep.call_count)
+
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    @mock.patch.object(upload.time, 'sleep')
+    def test_retries_exhausted(self, sleep, stdout):
+        batch = list(upload.pack_batches(['a']))[0]
+        client = mock.MagicMock()
+        client.send_message_batch.return_value = {'Failed': [{'Id': '0'}]}
+
+        with self.assertRaises(upload.FailedToSendMessages):
+            upload.send_batch(client, 'queue', batch)
+        self.assertEqual(upload.SQS_RETRIES + 1, client.send_message_batch.call_count)
+
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    @mock.patch.object(upload.boto3, 'client')
+    def test_failed_batch_keeps_cursor(self, boto3_client, stdout):
+        args = make_args(shards=1)
+        msgs = list(upload.create_messages(args))
+
+        def send_message_batch(QueueUrl, Entries):
+            if Entries[0]['MessageBody'] == msgs[30]:
+                error = {'Code': 'AccessDenied', 'Message': 'Denied'}
+                raise upload.ClientError({'Error': error}, 'SendMessageBatch')
+            return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+        client = boto3_client.return_value
+        client.send_message_batch.side_effect = send_message_batch
+
+        result = upload.handler(args, FakeContext())
+        self.assertFalse(result['finished'])
+        self.assertEqual(30, result['cursor'])
+        self.assertIn('ClientError', result['send_error'])
+
+        # Every message before the cursor was acknowledged, and no more
+        # batches were started after the failure
+        sent = [entry['MessageBody'] for c in client.send_message_batch.call_args_list
+                                     for entry in c[1]['Entries']]
+        self.assertLessEqual(set(msgs[:30]), set(sent))
+        self.assertLess(len(sent), len(msgs))
+
+        # The next call raises without sending anything
+        client.send_message_batch.reset_mock()
+        with self.assertRaises(upload.FailedToSendMessages):
+            upload.handler(result, FakeContext())
+        client.send_message_batch.assert_not_called()
+
+class TestCompactMessages(unittest.TestCase):
+    def test_decode_matches_verbose(self):
+        args = make_args()
+        header = upload.message_header(args)
+        verbose = [json.loads(msg) for msg in upload.create_messages(args)]
+        compact = list(upload.create_messages(dict(args, compact_messages=True)))
+
+        self.assertEqual(verbose, [upload.decode_message(msg, header) for msg in compact])
+        self.assertEqual(verbose, [upload.decode_message(json.dumps(msg)) for msg in verbose])
+        self.assertLess(len(compact[0]), len(json.dumps(verbose[0])))
+
+    def test_decode_errors(self):
+        args = make_args()
+        msg = next(upload.create_messages(dict(args, compact_messages=True)))
+
+        with self.assertRaises(ValueError):
+            upload.decode_message(msg)
+        with self.assertRaises(ValueError):
+            upload.decode_message(msg, upload.message_header(make_args(job_id=2)))
+        with self.assertRaises(ValueError):
+            upload.decode_message(json.dumps({'v': 99}))
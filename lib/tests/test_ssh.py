@@ -0,0 +1,250 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import sys
+import socket
+import threading
+import itertools
+import unittest
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import ssh
+from lib.exceptions import SSHError, SSHTunnelError
+
+
+class FakeMaster(object):
+    """Popen replacement for a ssh master process, that creates the control
+    socket like ssh does once the connection is authenticated"""
+    started = []
+
+    def __init__(self, cmd, **kwargs):
+        self.cmd = cmd
+        self.returncode = None
+        FakeMaster.started.append(self)
+
+        path = [arg for arg in cmd if arg.startswith('ControlPath=')][0]
+        open(path.split('=', 1)[1], 'w').close()
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        self.returncode = -15
+
+    def wait(self):
+        return self.returncode
+
+@mock.patch.dict(os.environ, clear=True)
+@mock.patch('lib.ssh.port_open', new=lambda port: True)
+@mock.patch('lib.ssh.subprocess.call', return_value=0)
+@mock.patch('lib.ssh.subprocess.Popen', side_effect=FakeMaster)
+class TestSSHMaster(unittest.TestCase):
+    def setUp(self):
+        FakeMaster.started = []
+
+    def tearDown(self):
+        ssh.close_masters()
+
+    def test_master_shared(self, popen, call):
+        conn = ssh.SSHConnection('key', '10.0.0.2', '1.2.3.4')
+        other = ssh.SSHConnection('key', '10.0.0.2', '1.2.3.4')
+
+        with conn.cmds() as cmd:
+            cmd('hostname')
+            cmd('uptime')
+        other.cmd('date')
+
+        # One master to the bastion and one to the target through it
+        self.assertEqual(2, len(FakeMaster.started))
+        bastion, target = FakeMaster.started
+        self.assertEqual('ec2-user@1.2.3.4', bastion.cmd[-1])
+        self.assertEqual('ubuntu@10.0.0.2', target.cmd[-1])
+        self.assertTrue(any(arg.startswith('ProxyCommand=') for arg in target.cmd))
+
+        self.assertEqual(['hostname', 'uptime', 'date'], [c[0][0][-1] for c in call.call_args_list])
+
+    def test_forward_shared(self, popen, call):
+        first = ssh.SSHConnection('key', ('localhost', 3128), '1.2.3.4', local_port=3128)
+        second = ssh.SSHConnection('key', ('localhost', 3128), '1.2.3.4', local_port=3128)
+
+        with first.tunnel() as port:
+            with second.tunnel():
+                pass
+            self.assertEqual(3128, port)
+
+        commands = [c[0][0][c[0][0].index('-O') + 1] for c in call.call_args_list]
+        self.assertEqual(['forward', 'cancel'], commands)
+        self.assertEqual(1, len(FakeMaster.started))
+
+    def test_forward_error(self, popen, call):
+        call.return_value = 255
+        conn = ssh.SSHConnection('key', ('10.0.0.2', 8080), '1.2.3.4')
+
+        with self.assertRaises(SSHTunnelError):
+            with conn.tunnel():
+                pass
+
+    def test_master_exits(self, popen, call):
+        def exits(cmd, **kwargs):
+            proc = mock.Mock()
+            proc.poll.return_value = 255
+            return proc
+        popen.side_effect = exits
+
+        with self.assertRaises(SSHError):
+            ssh.SSHConnection('key', '10.0.0.2').cmd('hostname')
+
+    def test_restarted_after_close(self, popen, call):
+        conn = ssh.SSHConnection('key', '10.0.0.2')
+        conn.cmd('hostname')
+        ssh.close_masters()
+        conn.cmd('hostname')
+
+        self.assertEqual(2, len(FakeMaster.started))
+        self.assertEqual(-15, FakeMaster.started[0].returncode)
+
+@mock.patch.dict(os.environ, clear=True)
+@mock.patch('lib.ssh.subprocess.call', return_value=0)
+@mock.patch('lib.ssh.subprocess.Popen', side_effect=FakeMaster)
+class TestForwardProbe(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('localhost', 0))
+        self.port = self.listener.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+        ssh.close_masters()
+
+    def test_ready_when_port_answers(self, popen, call):
+        conn = ssh.SSHConnection('key', ('10.0.0.2', 8080), '1.2.3.4', local_port=self.port)
+        threading.Timer(0.2, self.listener.listen, (1,)).start()
+
+        with conn.tunnel() as port:
+            self.assertEqual(self.port, port)
+            self.assertTrue(ssh.port_open(port))
+
+    @mock.patch('lib.ssh.TUNNEL_TIMEOUT', 0.2)
+    def test_timeout(self, popen, call):
+        conn = ssh.SSHConnection('key', ('10.0.0.2', 8080), '1.2.3.4', local_port=self.port)
+
+        with self.assertRaises(SSHTunnelError):
+            with conn.tunnel():
+                pass
+
+        commands = [c[0][0][c[0][0].index('-O') + 1] for c in call.call_args_list]
+        self.assertEqual(['forward', 'cancel'], commands)
+
+    def test_master_exits(self, popen, call):
+        conn = ssh.SSHConnection('key', ('10.0.0.2', 8080), '1.2.3.4', local_port=self.port)
+        call.side_effect = lambda cmd, **kwargs: FakeMaster.started[-1].terminate() or 0
+
+        with self.assertRaises(SSHTunnelError):
+            with conn.tunnel():
+                pass
+
+class TestProbe(unittest.TestCase):
+    def test_locate_port_is_free(self):
+        with socket.socket() as sock:
+            sock.bind(('localhost', ssh.locate_port()))
+
+    def test_probe_delays_back_off(self):
+        delays = list(itertools.islice(ssh.probe_delays(60), 8))
+        self.assertEqual([0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 2, 2], delays)
+
+class FakeCommand(object):
+    """Popen replacement for a ssh command, that outputs the target's IP
+    and exits with the last octet of the IP"""
+    def __init__(self, cmd, **kwargs):
+        self.ip = cmd[-2].split('@')[1]
+        self.killed = threading.Event()
+        if cmd[-1] == 'sleep':
+            self.stdout = iter(lambda: self.killed.wait() and '', '')
+        else:
+            self.stdout = io.StringIO('running on\n{}\n'.format(self.ip))
+
+    def kill(self):
+        self.killed.set()
+
+    def wait(self):
+        return -9 if self.killed.is_set() else int(self.ip.split('.')[-1])
+
+@mock.patch.dict(os.environ, clear=True)
+@mock.patch('lib.ssh.subprocess.Popen', side_effect=lambda cmd, **kwargs:
+                (FakeMaster if '-M' in cmd else FakeCommand)(cmd, **kwargs))
+class TestRunAll(unittest.TestCase):
+    def setUp(self):
+        FakeMaster.started = []
+
+    def tearDown(self):
+        ssh.close_masters()
+
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_output_labeled(self, stdout, popen):
+        ips = ['10.0.0.{}'.format(i) for i in range(5)]
+        rets = ssh.run_all('key', ips, 'hostname', '1.2.3.4', concurrency=2)
+
+        self.assertEqual({ip: i for i, ip in enumerate(ips)}, rets)
+        for ip in ips:
+            self.assertIn('[{0}] running on\n[{0}] {0}\n'.format(ip), stdout.getvalue())
+
+        # One shared bastion master and one master per machine
+        self.assertEqual(1 + len(ips), len(FakeMaster.started))
+
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_timeout(self, stdout, popen):
+        rets = ssh.run_all('key', ['10.0.0.1'], 'sleep', '1.2.3.4', timeout=0.1)
+
+        self.assertEqual({'10.0.0.1': None}, rets)
+        self.assertIn('[10.0.0.1] Timed out', stdout.getvalue())
+
+@mock.patch.dict(os.environ, clear=True)
+@mock.patch('lib.ssh.subprocess.call', return_value=0)
+@mock.patch('lib.ssh.subprocess.Popen', side_effect=FakeMaster)
+class TestSync(unittest.TestCase):
+    def tearDown(self):
+        ssh.close_masters()
+
+    @mock.patch('lib.ssh.shutil.which', return_value='/usr/bin/rsync')
+    def test_rsync_split(self, which, popen, call):
+        files = ['a', 'b', 'c', 'd', 'e']
+        ssh.SSHConnection('key', '10.0.0.2', '1.2.3.4').sync(files, 'dir', parallel=2)
+
+        cmds = sorted(c[0][0] for c in call.call_args_list)
+        self.assertEqual(2, len(cmds))
+        self.assertEqual(['a', 'c', 'e', 'ubuntu@10.0.0.2:dir'], cmds[0][-4:])
+        self.assertEqual(['rsync', 'b', 'd', 'ubuntu@10.0.0.2:dir'], [cmds[1][0]] + cmds[1][-3:])
+
+    @mock.patch('lib.ssh.shutil.which', return_value=None)
+    def test_scp_download(self, which, popen, call):
+        ssh.SSHConnection('key', '10.0.0.2').sync(['a', 'b'], 'dir', upload=False)
+
+        cmds = sorted(c[0][0] for c in call.call_args_list)
+        self.assertEqual([['ubuntu@10.0.0.2:a', 'dir'], ['ubuntu@10.0.0.2:b', 'dir']],
+                         [cmd[-2:] for cmd in cmds])
+        self.assertEqual('scp', cmds[0][0])
+
+    @mock.patch('lib.ssh.shutil.which', return_value='/usr/bin/rsync')
+    def test_failure(self, which, popen, call):
+        call.return_value = 23
+
+        with self.assertRaises(SSHError):
+            ssh.SSHConnection('key', '10.0.0.2').sync('a', 'b')
@@ -0,0 +1,71 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import sys
+import threading
+import unittest
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import utils
+
+
+class TestPrefixedOutput(unittest.TestCase):
+    def test_lines_are_labeled(self):
+        stream = io.StringIO()
+        output = utils.PrefixedOutput(stream)
+
+        output.write('unlabeled\n')
+        with output.label('core'):
+            output.write('first ')
+            output.write('line\nsecond')
+        output.write('done\n')
+
+        self.assertEqual('unlabeled\n[core] first line\n[core] second\ndone\n', stream.getvalue())
+
+    def test_flush_writes_partial_line(self):
+        stream = io.StringIO()
+        output = utils.PrefixedOutput(stream)
+
+        with output.label('core'):
+            output.write('Update? [N/y] ')
+            output.flush()
+            self.assertEqual('[core] Update? [N/y] ', stream.getvalue())
+
+    def test_threads_do_not_mix(self):
+        stream = io.StringIO()
+        output = utils.PrefixedOutput(stream)
+
+        def write(label):
+            with output.label(label):
+                for i in range(100):
+                    output.write(label)
+                    output.write(str(i) + '\n')
+
+        threads = [threading.Thread(target=write, args=(label,)) for label in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(200, len(lines))
+        for line in lines:
+            label = line[1]
+            self.assertTrue(line.startswith('[{}] {}'.format(label, label)))
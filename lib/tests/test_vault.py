@@ -0,0 +1,262 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import sys
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import vault
+import hvac
+
+
+@mock.patch('lib.vault.hvac.Client')
+class TestVaultClient(unittest.TestCase):
+    def setUp(self):
+        self.private = tempfile.TemporaryDirectory()
+        patch = mock.patch('lib.vault.PRIVATE_DIR', self.private.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.private.cleanup)
+
+        self.vault = vault.Vault('vault.test.boss')
+        self.write_token('token1')
+
+    def write_token(self, token):
+        with open(self.vault.path(vault.VAULT_TOKEN), 'w') as fh:
+            fh.write(token)
+
+    def test_client_reused(self, Client):
+        self.vault.write('secret/a', key='value')
+        self.vault.read('secret/a')
+        self.vault.delete('secret/a')
+
+        Client.assert_called_once_with(url='http://vault.test.boss:8200',
+                                       proxies={'http': 'http://localhost:3128'},
+                                       session=self.vault.session)
+        client = Client.return_value
+        self.assertEqual('token1', client.token)
+        client.is_authenticated.assert_not_called()
+
+    def test_token_reread_when_rejected(self, Client):
+        client = Client.return_value
+        client.read.side_effect = [{'data': {}}, hvac.exceptions.Forbidden(), {'data': {'a': 1}}]
+        client.is_authenticated.return_value = True
+
+        self.vault.read('secret/a')
+        self.write_token('token2')
+        self.assertEqual({'data': {'a': 1}}, self.vault.read('secret/a'))
+
+        self.assertEqual('token2', client.token)
+        self.assertEqual(2, Client.call_count)
+        client.is_authenticated.assert_called_once_with()
+
+    def test_invalid_token(self, Client):
+        client = Client.return_value
+        client.read.side_effect = hvac.exceptions.Forbidden()
+        client.is_authenticated.return_value = False
+
+        with self.assertRaises(Exception):
+            self.vault.read('secret/a')
+        self.assertEqual(1, client.read.call_count)
+
+    def test_memory_token_kept(self, Client):
+        client = Client.return_value
+        client.read.side_effect = [hvac.exceptions.Forbidden(), {'data': {'a': 1}}]
+        client.is_authenticated.return_value = True
+
+        other = vault.Vault('vault.other.boss')
+        other.tokens[vault.VAULT_TOKEN] = 'memory'
+        self.assertEqual({'data': {'a': 1}}, other.read('secret/a'))
+        self.assertEqual('memory', client.token)
+
+        client.read.side_effect = hvac.exceptions.Forbidden()
+        client.is_authenticated.return_value = False
+        with self.assertRaisesRegex(Exception, 'token is not valid'):
+            other.read('secret/a')
+
+class FakeClient(object):
+    """hvac.Client replacement holding a tree of secrets"""
+    def __init__(self, secrets):
+        self.secrets = secrets
+        self.reads = []
+
+    def read(self, path):
+        self.reads.append(path)
+        if path not in self.secrets:
+            return None
+        return {'data': self.secrets[path]}
+
+    def write(self, path, **kwargs):
+        self.secrets[path] = kwargs
+
+    def list(self, path):
+        keys = set()
+        for key in self.secrets:
+            if key.startswith(path):
+                child = key[len(path):]
+                keys.add(child.split('/', 1)[0] + ('/' if '/' in child else ''))
+        return {'data': {'keys': sorted(keys)}} if keys else None
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.secrets = {
+            'secret/a': {'x': 1},
+            'secret/a/b': {'y': 2},
+            'secret/a/b/c': {'z': 3},
+            'secret/d/e': {'w': 4},
+        }
+        self.client = FakeClient(self.secrets)
+        self.vault = vault.Vault('vault.test.boss')
+        self.vault.clients[vault.VAULT_TOKEN] = self.client
+
+    def test_export(self):
+        self.assertEqual(self.secrets, self.vault.export('secret'))
+
+        # Every path is read once, including keys that are also prefixes
+        self.assertEqual(sorted(['secret'] + list(self.secrets)), sorted(self.client.reads))
+
+    @mock.patch('lib.vault.hvac.Client')
+    def test_export_reauthenticates(self, Client):
+        rejected = FakeClient(self.secrets)
+        rejected.list = mock.Mock(side_effect=hvac.exceptions.Forbidden())
+        self.vault.clients[vault.VAULT_TOKEN] = rejected
+        self.vault.tokens[vault.VAULT_TOKEN] = 'token'
+        self.client.is_authenticated = lambda: True
+        Client.return_value = self.client
+
+        self.assertEqual(self.secrets, dict(self.vault.export_iter('secret/', concurrency=2)))
+        self.assertEqual(1, Client.call_count)
+        self.assertEqual('token', self.client.token)
+
+    def test_export_lines(self):
+        fh = io.StringIO()
+        vault.write_export(self.vault.export_iter('secret/', concurrency=2), fh)
+        self.assertEqual(len(self.secrets), len(fh.getvalue().splitlines()))
+
+        fh.seek(0)
+        self.assertEqual(self.secrets, dict(vault.read_export(fh)))
+
+    def test_read_json_object(self):
+        fh = io.StringIO(json.dumps(self.secrets, indent=3))
+        self.assertEqual(self.secrets, dict(vault.read_export(fh)))
+
+        self.assertEqual({}, dict(vault.read_export(io.StringIO('{}'))))
+
+class TestImport(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient({
+            'secret/a': {'x': '1', 'y': '2'},
+            'secret/b': {'z': '3'},
+        })
+        self.client.write = mock.Mock(side_effect=self.client.write)
+        self.vault = vault.Vault('vault.test.boss')
+        self.vault.clients[vault.VAULT_TOKEN] = self.client
+
+        self.exported = {
+            'secret/a': {'x': '1', 'y': '4'},
+            'secret/b': {'z': '3'},
+            'secret/c': {'w': '5'},
+        }
+
+    def test_only_changes_written(self):
+        changes = self.vault.import_(self.exported)
+
+        self.assertEqual(['secret/a', 'secret/c'], sorted(c[0] for c in changes))
+        self.assertEqual(2, self.client.write.call_count)
+        self.assertEqual({'x': '1', 'y': '4'}, self.client.secrets['secret/a'])
+
+    def test_update(self):
+        changes = self.vault.import_({'secret/a': {'y': '2'}, 'secret/b': {'v': '6'}}, update=True)
+
+        self.assertEqual([('secret/b', {'z': '3'}, {'z': '3', 'v': '6'})], changes)
+        self.assertEqual({'z': '3', 'v': '6'}, self.client.secrets['secret/b'])
+
+    def test_dry_run(self):
+        changes = self.vault.import_(dict(self.exported, **{'secret/b': {'v': '6'}}), dry_run=True)
+
+        self.client.write.assert_not_called()
+        self.assertEqual(['secret/a: changed y',
+                          'secret/b: added v; removed z',
+                          'secret/c: new path with keys w'],
+                         vault.format_changes(changes))
+
+@mock.patch('lib.vault.hvac.Client')
+class TestCluster(unittest.TestCase):
+    def setUp(self):
+        self.private = tempfile.TemporaryDirectory()
+        patch = mock.patch('lib.vault.PRIVATE_DIR', self.private.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.private.cleanup)
+
+        self.vaults = [vault.Vault('vault.test.boss', '10.0.0.{}'.format(i)) for i in range(3)]
+        for i in range(3):
+            with open(self.vaults[0].path(vault.VAULT_KEY) + str(i), 'w') as fh:
+                fh.write('key{}'.format(i))
+
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_unseal_all(self, stdout, Client):
+        client = Client.return_value
+        client.is_sealed.return_value = True
+        client.unseal_multi.return_value = {'sealed': False}
+        client.is_initialized.return_value = True
+        client.seal_status = {'sealed': False, 'progress': 0, 't': 3}
+
+        with mock.patch.object(vault.Vault, 'read_keys', autospec=True,
+                               side_effect=vault.Vault.read_keys) as read_keys:
+            statuses = vault.unseal_all(self.vaults)
+
+        read_keys.assert_called_once_with(self.vaults[0])
+        self.assertEqual(3, client.unseal_multi.call_count)
+        self.assertEqual(['key0', 'key1', 'key2'], sorted(client.unseal_multi.call_args[0][0]))
+        self.assertEqual(['10.0.0.0', '10.0.0.1', '10.0.0.2'], [s['host'] for s in statuses])
+        self.assertIn('[10.0.0.1] Vault unsealed', stdout.getvalue())
+
+    @mock.patch('sys.stdout', new_callable=io.StringIO)
+    def test_unseal_all_error(self, stdout, Client):
+        client = Client.return_value
+        client.is_initialized.return_value = True
+        client.seal_status = {'sealed': False, 'progress': 0, 't': 3}
+
+        def unseal(self, keys=None):
+            if self.ip == '10.0.0.1':
+                raise ConnectionError('Connection refused')
+            print("Vault unsealed")
+
+        with mock.patch.object(vault.Vault, 'unseal', autospec=True, side_effect=unseal):
+            statuses = vault.unseal_all(self.vaults)
+
+        self.assertEqual(['10.0.0.0', '10.0.0.1', '10.0.0.2'], [s['host'] for s in statuses])
+        self.assertIn('[10.0.0.1] Could not unseal Vault: Connection refused', stdout.getvalue())
+        self.assertIn('[10.0.0.2] Vault unsealed', stdout.getvalue())
+
+    def test_format_status(self, Client):
+        lines = vault.format_status([
+            {'host': 'a', 'initialized': True, 'sealed': True, 'progress': 1, 'threshold': 3},
+            {'host': 'b', 'initialized': True, 'sealed': False, 'progress': 0, 'threshold': 3},
+            {'host': 'c', 'initialized': False},
+            {'host': 'd', 'error': 'Connection refused'},
+        ])
+
+        self.assertEqual(['a yes yes 1/3', 'b yes no -', 'c no - -', 'd - - Error: Connection refused'],
+                         [' '.join(line.split()) for line in lines[1:]])
@@ -18,9 +18,77 @@ import subprocess
 import shlex
 import getpass
 import string
+import threading
 
 from contextlib import contextmanager
 
+class PrefixedOutput(object):
+    """File like object that labels each line written from a thread.
+
+    Used in place of sys.stdout when multiple threads are printing progress,
+    so that the combined output shows which thread each line belongs to.
+    Output from a thread without a label is not prefixed. Lines are written
+    whole, so output from different threads doesn't mix.
+    """
+    def __init__(self, stream):
+        """PrefixedOutput constructor
+
+        Args:
+            stream (file) : File like object to write the labeled lines to
+        """
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def label(self, label):
+        """Label all output from the current thread while in the context"""
+        self.local.label = label
+        try:
+            yield
+        finally:
+            if getattr(self.local, 'buffer', ''):
+                self.write('\n')
+            self.local.label = None
+
+    def _write(self, lines):
+        label = getattr(self.local, 'label', None)
+        prefix = '' if label is None else '[{}] '.format(label)
+        with self.lock:
+            for line in lines:
+                self.stream.write(prefix + line)
+            self.stream.flush()
+
+    def write(self, data):
+        lines = (getattr(self.local, 'buffer', '') + data).split('\n')
+        self.local.buffer = lines.pop()
+        self._write([line + '\n' for line in lines])
+        return len(data)
+
+    def flush(self):
+        # Write any partial line, so prompts are displayed
+        buffer = getattr(self.local, 'buffer', '')
+        self.local.buffer = ''
+        self._write([buffer] if buffer else [])
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+@contextmanager
+def prefixed_output():
+    """Replace sys.stdout with a PrefixedOutput while in the context
+
+    Returns:
+        (PrefixedOutput) : Object used to label the output from each thread
+    """
+    stdout = sys.stdout
+    sys.stdout = PrefixedOutput(stdout)
+    try:
+        yield sys.stdout
+    finally:
+        sys.stdout.flush()
+        sys.stdout = stdout
+
 @contextmanager
 def open_(filename, mode='r'):
     """Custom version of open that understands stdin/stdout"""
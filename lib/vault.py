@@ -16,6 +16,13 @@ import os
 import glob
 import hvac
 import json
+import requests
+import threading
+from collections import deque
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .utils import prefixed_output
 from pprint import pprint
 import traceback
 
@@ -26,6 +33,158 @@ VAULT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "vaul
 POLICY_DIR = os.path.join(VAULT_DIR, "policies")
 PRIVATE_DIR = os.path.join(VAULT_DIR, "private")
 
+EXPORT_CONCURRENCY = 8 # number of list / read requests export_iter() makes at once
+POOL_SIZE = 16 # number of connections to Vault kept open
+
+def authenticated(method):
+    """Decorator for Vault methods that use the VAULT_TOKEN client
+
+    The cached token is not checked before it is used. If Vault rejects a
+    request, the token is re-read and checked (see Vault.reauthenticate()),
+    and if it is valid the method is called again.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except hvac.exceptions.Forbidden:
+            self.reauthenticate()
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def write_export(exported, fh):
+    """Write exported Vault data as Json lines, one line per Vault path.
+
+    Args:
+        exported (iterable) : Iterable of (Vault path, dict of key / values) tuples,
+                              like the results of Vault.export_iter()
+        fh (file) : File like object to write to
+    """
+    for path, data in exported:
+        fh.write(json.dumps({"path": path, "data": data}, sort_keys=True))
+        fh.write("\n")
+
+def read_export(fh):
+    """Read exported Vault data written by write_export() or written as a single
+    Json object (the results of Vault.export()).
+
+    Args:
+        fh (file) : File like object to read from
+
+    Returns:
+        (generator) : Generator of (Vault path, dict of key / values) tuples
+    """
+    line = fh.readline()
+    try:
+        item = json.loads(line)
+    except ValueError:
+        item = None
+
+    if isinstance(item, dict) and set(item.keys()) == {"path", "data"}:
+        yield item["path"], item["data"]
+        for line in fh:
+            if line.strip():
+                item = json.loads(line)
+                yield item["path"], item["data"]
+    else:
+        # Single Json object
+        exported = json.loads(line + fh.read()) if line.strip() else {}
+        for path, data in exported.items():
+            yield path, data
+
+def cluster_status(vaults):
+    """Get the seal status of multiple Vaults at once.
+
+    Args:
+        vaults (list) : List of Vault objects
+
+    Returns:
+        (list) : List of Vault.seal_status() results, in the same order as vaults
+    """
+    if len(vaults) == 0:
+        return []
+
+    with ThreadPoolExecutor(max_workers=len(vaults)) as pool:
+        return list(pool.map(lambda vault: vault.seal_status(), vaults))
+
+def unseal_all(vaults):
+    """Unseal multiple Vaults at once.
+
+    The unseal keys are read from disk once, using the first Vault's
+    private files, and used for all of the Vaults. A Vault that could not
+    be unsealed doesn't stop the others from being unsealed, the error is
+    printed and is included in its status.
+
+    Args:
+        vaults (list) : List of Vault objects for the same Vault cluster
+
+    Returns:
+        (list) : List of Vault.seal_status() results, after unsealing
+    """
+    if len(vaults) == 0:
+        return []
+
+    keys = vaults[0].read_keys()
+
+    def unseal(vault):
+        with output.label(vault.ip if vault.ip else vault.machine):
+            try:
+                vault.unseal(keys)
+            except Exception as ex:
+                print("Could not unseal Vault: {}".format(ex))
+
+    with prefixed_output() as output, ThreadPoolExecutor(max_workers=len(vaults)) as pool:
+        list(pool.map(unseal, vaults))
+
+    return cluster_status(vaults)
+
+def format_status(statuses):
+    """Format the results of cluster_status() as a table.
+
+    Args:
+        statuses (list) : List of Vault.seal_status() results
+
+    Returns:
+        (list) : List of strings, one for each line of the table
+    """
+    fmt = "{:<30} {:<12} {:<8} {}"
+    lines = [fmt.format("Host", "Initialized", "Sealed", "Unseal Progress")]
+    for status in statuses:
+        if "error" in status:
+            lines.append(fmt.format(status["host"], "-", "-", "Error: " + status["error"]))
+        elif not status["initialized"]:
+            lines.append(fmt.format(status["host"], "no", "-", "-"))
+        else:
+            progress = "{}/{}".format(status["progress"], status["threshold"]) if status["sealed"] else "-"
+            lines.append(fmt.format(status["host"], "yes", "yes" if status["sealed"] else "no", progress))
+    return lines
+
+def format_changes(changes):
+    """Describe the changes made by Vault.import_(), without including any of
+    the values.
+
+    Args:
+        changes (list) : Results of Vault.diff_import() / Vault.import_()
+
+    Returns:
+        (list) : List of strings, one for each changed path
+    """
+    lines = []
+    for path, current, new in sorted(changes, key = lambda change: change[0]):
+        if current is None:
+            lines.append("{}: new path with keys {}".format(path, ", ".join(sorted(new))))
+            continue
+
+        parts = []
+        added = sorted(k for k in new if k not in current)
+        changed = sorted(k for k in new if k in current and new[k] != current[k])
+        removed = sorted(k for k in current if k not in new)
+        for label, keys in (("added", added), ("changed", changed), ("removed", removed)):
+            if len(keys) > 0:
+                parts.append("{} {}".format(label, ", ".join(keys)))
+        lines.append("{}: {}".format(path, "; ".join(parts)))
+    return lines
+
 class Vault(object):
     def __init__(self, machine, ip = None, proxy = True):
         # If the machine is X.vault.vpc.boss remove the X.
@@ -50,6 +209,13 @@ class Vault(object):
         else:
             self.proxy = {} # DP XXX: {} or None???
 
+        # All clients share one requests session, so connections are reused
+        self.session = None
+        self.clients = {} # read_token: hvac.Client
+        self.tokens = {} # read_token: token
+        self.token_files = set() # read_tokens whose token was read from disk
+        self.lock = threading.Lock()
+
     def path(self, filename):
         """Get the complete file path for given machine's private file.
         Args:
@@ -65,21 +231,74 @@ class Vault(object):
 
         return path
 
-    def connect(self, read_token = None):
-        client = hvac.Client(url=self.url, proxies=self.proxy)
+    def token(self, read_token):
+        """Get the token stored in the machine's private file, caching it in memory.
 
-        if read_token is not None:
+        Args:
+            read_token (string) : Name of the machine's private file containing the token
+        Returns:
+            (string) : Vault token
+        """
+        if read_token not in self.tokens:
             token_file = self.path(read_token)
             if not os.path.exists(token_file):
                 raise Exception("Token file '{}' doesn't exist".format(token_file))
 
             with open(token_file, "r") as fh:
-                client.token = fh.read()
-                try:
-                    if not client.is_authenticated():
-                        raise Exception("Vault token is not valid, cannot communicate with the Vault")
-                except:
-                    raise
+                self.tokens[read_token] = fh.read()
+            self.token_files.add(read_token)
+        return self.tokens[read_token]
+
+    def connect(self, read_token = None):
+        """Get a client connected to Vault. Clients are cached, so the same
+        client is returned for the same read_token.
+
+        The token is not checked when the client is created, see authenticated().
+
+        Args:
+            read_token (None|string) : Name of the machine's private file containing
+                                       the token for the client to use
+        Returns:
+            (hvac.Client) : Vault client
+        """
+        with self.lock:
+            if read_token not in self.clients:
+                if self.session is None:
+                    self.session = requests.Session()
+                    self.session.proxies.update(self.proxy)
+                    adapter = requests.adapters.HTTPAdapter(pool_maxsize=POOL_SIZE)
+                    self.session.mount("http://", adapter)
+
+                client = hvac.Client(url=self.url, proxies=self.proxy, session=self.session)
+                if read_token is not None:
+                    client.token = self.token(read_token)
+                self.clients[read_token] = client
+            return self.clients[read_token]
+
+    def reset(self):
+        """Clear the cached clients and the tokens read from disk, so that they
+        are re-read. Tokens set directly in tokens are kept.
+        """
+        with self.lock:
+            self.clients = {}
+            for read_token in self.token_files:
+                del self.tokens[read_token]
+            self.token_files = set()
+
+    def reauthenticate(self):
+        """Get a new VAULT_TOKEN client, after Vault rejected the current token,
+        and check that its token is valid.
+
+        Returns:
+            (hvac.Client) : Vault client
+
+        Raises:
+            Exception : If the token is not valid
+        """
+        self.reset()
+        client = self.connect(VAULT_TOKEN)
+        if not client.is_authenticated():
+            raise Exception("Vault token is not valid, cannot communicate with the Vault")
         return client
 
     def status_check(self):
@@ -130,6 +349,7 @@ class Vault(object):
             key_file = self.path(VAULT_KEY)
             with open(token_file, "w") as fh:
                 fh.write(result["root_token"])
+            self.reset()
             for i in range(secrets):
                 with open(key_file + str(i+1), "w") as fh:
                     fh.write(result["keys"][i])
@@ -146,6 +366,7 @@ class Vault(object):
 
         self.configure()
 
+    @authenticated
     def configure(self):
         """A companion function that will configure a newly initialized Vault
         as needed for BOSS. This includes:
@@ -253,13 +474,32 @@ class Vault(object):
                     client.write("aws/roles/" + name, **keys)
         """
 
-    def unseal(self):
+    def read_keys(self):
+        """Read all of the unseal keys defined by VAULT_KEY.
+
+        Returns:
+            (list) : List of unseal keys
+        """
+        key_file = self.path(VAULT_KEY)
+        keys = []
+        for f in glob.glob(key_file + "*"):
+            with open(f, "r") as fh:
+                keys.append(fh.read())
+        return keys
+
+    def unseal(self, keys = None):
         """Unseal a sealed Vault. Connect using get_client() and if the Vault is
         not sealed read all of the keys defined by VAULT_KEY and unseal.
 
         If there are not enough keys to completely unseal the Vault, print a
         status message about how many more keys are required to finish the
         process.
+
+        Args:
+            keys (None|list) : Unseal keys to use, instead of reading them from disk
+
+        Returns:
+            (int) : Number of keys still needed to unseal the Vault
         """
 
         client = self.connect()
@@ -267,11 +507,8 @@ class Vault(object):
             print("Vault is already unsealed")
             return 0
 
-        key_file = self.path(VAULT_KEY)
-        keys = []
-        for f in glob.glob(key_file + "*"):
-            with open(f, "r") as fh:
-                keys.append(fh.read())
+        if keys is None:
+            keys = self.read_keys()
 
         if len(keys) == 0:
             raise Exception("Could not locate any key files, not unsealing")
@@ -287,6 +524,7 @@ class Vault(object):
             print("Vault unsealed")
             return 0
 
+    @authenticated
     def seal(self):
         """Seal an unsealed Vault. Connect using get_client(True) and if the Vault
         is unsealed, seal it.
@@ -303,6 +541,27 @@ class Vault(object):
         client.seal()
         print("Vault is sealed")
 
+    def seal_status(self):
+        """Get a summary of the initialization and seal status of a Vault.
+
+        Returns:
+            (dict) : Dict with the host, initialized, sealed, progress, and
+                     threshold values of the Vault, or the host and error
+                     if the Vault could not be contacted
+        """
+        host = self.ip if self.ip else self.machine
+        try:
+            client = self.connect()
+            status = {"host": host, "initialized": client.is_initialized()}
+            if status["initialized"]:
+                seal = client.seal_status
+                status["sealed"] = seal["sealed"]
+                status["progress"] = seal["progress"]
+                status["threshold"] = seal["t"]
+            return status
+        except Exception as ex:
+            return {"host": host, "error": str(ex)}
+
     def status(self):
         """Print the status of a Vault. Connect using get_client(True) and print
         the status of the following items (if available):
@@ -356,6 +615,7 @@ class Vault(object):
         print("Auth Backends")
         print(json.dumps(client.list_auth_backends(), indent=True))
 
+    @authenticated
     def provision(self, policy):
         """Create a new Vault access token.
 
@@ -369,6 +629,7 @@ class Vault(object):
         token = client.create_token(policies = [policy])
         return token["auth"]["client_token"]
 
+    @authenticated
     def revoke(self, token):
         """Revoke a Vault access token.
 
@@ -378,6 +639,7 @@ class Vault(object):
         client = self.connect(VAULT_TOKEN)
         client.revoke_token(token)
 
+    @authenticated
     def revoke_secret(self, lease_id):
         """Revoke a Vault lease
 
@@ -387,6 +649,7 @@ class Vault(object):
         client = self.connect(VAULT_TOKEN)
         client.revoke_secret(lease_id)
 
+    @authenticated
     def revoke_secret_prefix(self, prefix):
         """Revoke a Vault secret by prefix
 
@@ -396,6 +659,7 @@ class Vault(object):
         client = self.connect(VAULT_TOKEN)
         client.revoke_secret_prefix(prefix)
 
+    @authenticated
     def write(self, path, **kwargs):
         """A generic method for writing data into Vault.
 
@@ -409,6 +673,7 @@ class Vault(object):
         client = self.connect(VAULT_TOKEN)
         client.write(path, **kwargs)
 
+    @authenticated
     def update(self, path, **kwargs):
         """A generic method for adding/updating data to/in Vault.
 
@@ -428,6 +693,7 @@ class Vault(object):
 
         client.write(path, **existing)
 
+    @authenticated
     def read(self, path):
         """A generic method for reading data from Vault.
 
@@ -437,6 +703,7 @@ class Vault(object):
         client = self.connect(VAULT_TOKEN)
         return client.read(path)
 
+    @authenticated
     def delete(self, path):
         """A generic method for deleting data from Vault.
 
@@ -446,48 +713,137 @@ class Vault(object):
         client = self.connect(VAULT_TOKEN)
         client.delete(path)
 
+    @authenticated
     def export(self, path):
         """A generic method for reading all of the paths and keys from Vault.
 
         Args:
             path (string) : Vault path to dump data from
+
+        Returns:
+            (dict) : Dict of Vault path and dict of key / values stored at the path
+        """
+        return dict(self.export_iter(path))
+
+    def export_iter(self, path, concurrency=EXPORT_CONCURRENCY):
+        """Read all of the paths and keys from Vault, as they are read.
+
+        The tree is walked breadth first, with multiple list / read requests
+        made at once. Each path is read once, even if it is both a key and
+        a prefix of other keys.
+
+        Args:
+            path (string) : Vault path to dump data from
+            concurrency (int) : Number of requests to make at once
+
+        Returns:
+            (generator) : Generator of (Vault path, dict of key / values) tuples
         """
         if path[-1] != '/':
             path += '/'
 
-        rtn = {}
+        client = self.connect(VAULT_TOKEN)
+        reauthenticated = False
+        todo = deque([('read', path[:-1]), ('list', path)])
+        pending = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            while len(todo) > 0 or len(pending) > 0:
+                # Only queue a few requests ahead, so that the rest of the
+                # tree is walked in breadth first order
+                while len(todo) > 0 and len(pending) < concurrency * 2:
+                    request, key = todo.popleft()
+                    future = pool.submit(getattr(client, request), key)
+                    pending[future] = (request, key, client)
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    request, key, used = pending.pop(future)
+                    try:
+                        results = future.result()
+                    except hvac.exceptions.Forbidden:
+                        # Like authenticated(), but only the rejected
+                        # requests are retried, as the others were yielded
+                        if used is client:
+                            if reauthenticated:
+                                raise
+                            client = self.reauthenticate()
+                            reauthenticated = True
+                        todo.appendleft((request, key))
+                        continue
+
+                    if results is None:
+                        continue
+
+                    if request == 'read':
+                        yield key, results['data']
+                    else:
+                        for child in results['data']['keys']:
+                            child = key + child
+                            if child[-1] == '/':
+                                todo.append(('list', child))
+                            else:
+                                todo.append(('read', child))
+
+    @authenticated
+    def diff_import(self, exported, update=False, concurrency=EXPORT_CONCURRENCY):
+        """Compare data to be imported with the data currently in Vault.
+
+        The current data for all of the paths is read at once.
+
+        Args:
+            exported (dict): Dict of Vault path and dict of key / values to store at the path
+            update (bool): If an Update should be done or if a Write should be done
+            concurrency (int) : Number of requests to make at once
 
-        # DP NOTE: not using self.read becuase of the different token needed
+        Returns:
+            (list) : List of (Vault path, current dict of key / values or None,
+                     new dict of key / values) tuples for each path that would change
+        """
         client = self.connect(VAULT_TOKEN)
-        results =  client.read(path[:-1])
-        if results is not None:
-            rtn[path[:-1]] = results['data']
-
-        results = client.list(path)
-        for key in results['data']['keys']:
-            key = path + key
-            if key[-1] == '/':
-                data = self.export(key)
-                rtn.update(data)
-            else:
-                # DP NOTE: This will currently do a duplicate read if
-                #          data is stored at key and in paths under
-                #          key
-                #          To prevent this, check to see if (key + '/') is in keys
-                data = self.read(key)
-                rtn[key] = data['data']
 
-        return rtn
+        def read(path):
+            results = client.read(path)
+            return None if results is None else results['data']
+
+        paths = list(exported)
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            currents = list(pool.map(read, paths))
+
+        changes = []
+        for path, current in zip(paths, currents):
+            new = {}
+            if update and current is not None:
+                new.update(current)
+            new.update(exported[path])
 
-    def import_(self, exported, update=False):
+            if new != current:
+                changes.append((path, current, new))
+        return changes
+
+    @authenticated
+    def import_(self, exported, update=False, dry_run=False, concurrency=EXPORT_CONCURRENCY):
         """A generic method for writing / updating data in multiple paths in Vault.
 
+        Only the paths where the data would change are written, see diff_import().
+
         Args:
             exported (dict): Dict of Vault path and dict of key / values to store at the path
             update (bool): If an Update should be done or if a Write should be done
+            dry_run (bool): If the changes should only be returned and not written
+            concurrency (int) : Number of requests to make at once
+
+        Returns:
+            (list) : List of changes, see diff_import()
         """
-        for path in exported:
-            kv = exported[path]
-            fn = self.update if update else self.write
-            fn(path, **kv)
+        changes = self.diff_import(exported, update, concurrency)
+
+        if not dry_run and len(changes) > 0:
+            client = self.connect(VAULT_TOKEN)
+            def write(change):
+                path, current, new = change
+                client.write(path, **new)
+
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(write, changes))
 
+        return changes
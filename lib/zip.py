@@ -69,6 +69,10 @@ def write_to_zip(path, zippath, append=True, arcname=None):
 
             if '.git' in dirs:
                 dirs.remove('.git')
+            # Keep the zip contents in the same order, so that a re-created
+            # zip only differs where the files changed
+            dirs.sort()
+            files.sort()
             for d in dirs:
                 dirname = os.path.join(root, d)
                 dstname = os.path.join(dst, d)
@@ -1,19 +1,179 @@
 #!/usr/bin/env python3
 
+"""A script to load test the creation of IAM credentials by Vault's AWS backend
+
+Requests the given number of credentials from Vault using multiple workers,
+then validates each credential by calling IAM. The latency percentiles,
+throughput, and error rate of both stages are printed and can be saved as a
+Json report.
+
+Can be run against a BOSS VPC (through the bastion's Vault tunnel) or, with
+--local, against a dev mode Vault and an IAM stand-in (like moto_server).
+For a local run the AWS backend of the dev Vault is configured to use the
+stand-in's endpoint.
+
+    vault server -dev -dev-root-token-id=root
+    moto_server iam -p 5000
+    ./iam_load.py --local --iam-endpoint http://localhost:5000 --load 200 --workers 20
+"""
+
 import argparse
 import os
 import sys
 import json
 import time
-
+import math
+import boto3
+import hvac
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import alter_path
 from lib import aws
-from lib.vault import Vault
+from lib import vault as vault_lib
+from lib.vault import Vault, VAULT_TOKEN
 from lib.ssh import vault_tunnel
 
+ROLE = 'ingest-loadtest'
+
+def percentile(values, pct):
+    """Calculate a percentile using the nearest rank method
+
+    Args:
+        values (list) : Sorted list of values
+        pct (int) : Percentile to calculate
+
+    Returns:
+        (float|None) : Value at the percentile or None if there are no values
+    """
+    if len(values) == 0:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(values)))
+    return values[rank - 1]
+
+def summarize(latencies, errors, seconds):
+    """Summarize the results of run_workers()
+
+    Args:
+        latencies (list) : Seconds each successful call took
+        errors (list) : Error messages of the failed calls
+        seconds (float) : Total seconds all of the calls took
+
+    Returns:
+        (dict) : Dictionary of statistics, latencies are in milliseconds
+    """
+    latencies = sorted(latencies)
+    ms = lambda v: None if v is None else round(v * 1000, 2)
+    count = len(latencies) + len(errors)
+    return {
+        'count': count,
+        'errors': len(errors),
+        'error_rate': len(errors) / count if count else 0,
+        'seconds': round(seconds, 3),
+        'per_second': round(count / seconds, 2) if seconds else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1] if latencies else None),
+        'mean_ms': ms(sum(latencies) / len(latencies) if latencies else None),
+        'error_messages': sorted(set(errors))[:10],
+    }
+
+def run_workers(func, items, workers):
+    """Call the function for each item, with multiple calls running at once
+
+    Args:
+        func (callable) : Function to call with each item
+        items (list) : List of items
+        workers (int) : Number of calls to run at once
+
+    Returns:
+        (tuple) : Tuple of (list of results of the successful calls,
+                            summarize() results)
+    """
+    def call(item):
+        start = time.perf_counter()
+        try:
+            return func(item), time.perf_counter() - start, None
+        except Exception as ex:
+            return None, None, "{}: {}".format(type(ex).__name__, ex)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        calls = list(pool.map(call, items))
+    seconds = time.perf_counter() - start
+
+    results = [result for result, latency, error in calls if error is None]
+    latencies = [latency for result, latency, error in calls if error is None]
+    errors = [error for result, latency, error in calls if error is not None]
+    return results, summarize(latencies, errors, seconds)
+
+def print_summary(name, summary):
+    print("{}: {count} calls, {errors} errors ({error_rate:.1%}), {per_second} calls/sec".format(name, **summary))
+    print("\tlatency ms: p50 {p50_ms}, p95 {p95_ms}, p99 {p99_ms}, max {max_ms}".format(**summary))
+    for error in summary['error_messages']:
+        print("\t" + error)
+
+def load_test(vault, load, workers, settle, iam_endpoint=None):
+    """Request credentials from Vault and validate them
+
+    Args:
+        vault (Vault) : Vault to request credentials from, with the ROLE configured
+        load (int) : Number of credentials to request
+        workers (int) : Number of requests to make at once
+        settle (int) : Seconds to wait for new credentials to become usable
+        iam_endpoint (None|string) : IAM endpoint to validate the credentials against
+
+    Returns:
+        (dict) : Report of the load test
+    """
+    print("Requesting {} credentials with {} workers".format(load, workers))
+    read = lambda i: vault.read('aws/creds/' + ROLE)['data']
+    creds, requests = run_workers(read, range(load), workers)
+    print_summary("Vault", requests)
+
+    # New IAM users can take a few seconds before they can be used
+    print("Waiting {} seconds before validating the credentials".format(settle))
+    time.sleep(settle)
+
+    def validate(cred):
+        client = boto3.client('iam',
+                              aws_access_key_id = cred['access_key'],
+                              aws_secret_access_key = cred['secret_key'],
+                              region_name = 'us-east-1',
+                              endpoint_url = iam_endpoint)
+        client.list_users(MaxItems = 1)
+
+    valid, validation = run_workers(validate, creds, workers)
+    print_summary("IAM", validation)
+
+    return {
+        'load': load,
+        'workers': workers,
+        'vault': requests,
+        'iam': validation,
+    }
+
+def configure_local(vault, iam_endpoint):
+    """Configure the AWS backend of a dev mode Vault to use the IAM stand-in"""
+    client = vault.connect(VAULT_TOKEN)
+    try:
+        client.enable_secret_backend('aws')
+    except hvac.exceptions.InvalidRequest:
+        pass # already enabled
+    vault.write('aws/config/root', access_key = 'testing',
+                                   secret_key = 'testing',
+                                   region = 'us-east-1',
+                                   iam_endpoint = iam_endpoint)
+
+@contextmanager
+def no_tunnel():
+    yield
+
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description = "Script to load test create a large number of IAM credentials using Vault")
+    parser = argparse.ArgumentParser(description = "Script to load test create a large number of IAM credentials using Vault",
+                                     formatter_class = argparse.RawDescriptionHelpFormatter,
+                                     epilog = __doc__.split('\n', 1)[1])
 
     parser.add_argument("--aws-credentials", "-a",
                         metavar = "<file>",
@@ -26,45 +186,91 @@ if __name__ == '__main__':
                         help = "SSH private key to use when connecting to AWS instances (default: SSH_KEY)")
     parser.add_argument("--load", "-l",
                         metavar = "<load>",
+                        type = int,
                         default = 50,
-                        help = "How many credentials to request from Vault")
+                        help = "How many credentials to request from Vault (default: 50)")
+    parser.add_argument("--workers", "-w",
+                        metavar = "<workers>",
+                        type = int,
+                        default = 10,
+                        help = "How many requests to make at once (default: 10)")
+    parser.add_argument("--settle",
+                        metavar = "<seconds>",
+                        type = int,
+                        default = 10,
+                        help = "Seconds to wait before validating the credentials (default: 10)")
+    parser.add_argument("--report", "-r",
+                        metavar = "<file>",
+                        help = "File to save the Json report to")
+    parser.add_argument("--local",
+                        action = "store_true",
+                        help = "Run against a local dev mode Vault and IAM stand-in")
+    parser.add_argument("--vault-url",
+                        metavar = "<url>",
+                        default = os.environ.get("VAULT_ADDR", "http://localhost:8200"),
+                        help = "URL of the local Vault (default: VAULT_ADDR or http://localhost:8200)")
+    parser.add_argument("--vault-token",
+                        metavar = "<token>",
+                        default = os.environ.get("VAULT_TOKEN", "root"),
+                        help = "Token for the local Vault (default: VAULT_TOKEN or root)")
+    parser.add_argument("--iam-endpoint",
+                        metavar = "<url>",
+                        help = "URL of the IAM stand-in, used with --local")
     parser.add_argument("domain",
                         metavar = "domain",
+                        nargs = "?",
+                        default = "local",
                         help = "Domain to target")
 
     args = parser.parse_args()
 
-    if args.aws_credentials is None:
-        parser.print_usage()
-        print("Error: AWS credentials not provided and AWS_CREDENTIALS is not defined")
-        sys.exit(1)
+    if args.local:
+        if args.iam_endpoint is None:
+            parser.print_usage()
+            print("Error: --iam-endpoint is required with --local")
+            sys.exit(1)
 
-    if args.ssh_key is None:
-        parser.print_usage()
-        print("Error: SSH key not provided and SSH_KEY is not defined")
-        sys.exit(1)
+        session = boto3.session.Session(aws_access_key_id = 'testing',
+                                        aws_secret_access_key = 'testing',
+                                        region_name = 'us-east-1')
+        iam = session.resource('iam', endpoint_url = args.iam_endpoint)
+        client = session.client('iam', endpoint_url = args.iam_endpoint)
+        tunnel = no_tunnel()
 
-    session = aws.create_session(args.aws_credentials)
-    bastion = aws.machine_lookup(session, 'bastion.' + args.domain)
-    iam = session.resource('iam')
-    client = session.client('iam')
+        v = Vault(None, proxy = False)
+        v.url = args.vault_url
+        v.tokens[VAULT_TOKEN] = args.vault_token
+    else:
+        if args.aws_credentials is None:
+            parser.print_usage()
+            print("Error: AWS credentials not provided and AWS_CREDENTIALS is not defined")
+            sys.exit(1)
 
-    domain = args.domain.replace('.', '-')
+        if args.ssh_key is None:
+            parser.print_usage()
+            print("Error: SSH key not provided and SSH_KEY is not defined")
+            sys.exit(1)
 
-    print("Opening ssh tunnel")
-    with vault_tunnel(args.ssh_key, bastion):
-        print("\tcomplete")
+        session = aws.create_session(args.aws_credentials)
+        bastion = aws.machine_lookup(session, 'bastion.' + args.domain)
+        iam = session.resource('iam')
+        client = session.client('iam')
+
+        print("Opening ssh tunnel")
+        tunnel = vault_tunnel(args.ssh_key, bastion)
 
         v = Vault('vault.' + args.domain)
 
-        #while True:
-        #    try:
-        #        v.revoke_secret_prefix('aws/creds/ingest-loadtest')
-        #    except Exception as ex:
-        #        print(ex)
-        #
-        #    time.sleep(10)
-        #sys.exit(0)
+    domain = args.domain.replace('.', '-')
+
+    # Keep a connection open for each worker
+    vault_lib.POOL_SIZE = max(vault_lib.POOL_SIZE, args.workers)
+
+    with tunnel:
+        if args.local:
+            print("Configuring local Vault")
+            configure_local(v, args.iam_endpoint)
+            print("\tcomplete")
 
         print("Creating IAM policy")
         policy = iam.create_policy(
@@ -90,36 +296,26 @@ if __name__ == '__main__':
 
         try:
             print("Creating Vault AWS role")
-            v.write('aws/roles/ingest-loadtest', arn = policy.arn)
+            v.write('aws/roles/' + ROLE, arn = policy.arn)
             print("\tcomplete")
 
             try:
                 print("Starting test")
-                creds = []
-                for i in range(int(args.load)):
-                    cred = v.read('aws/creds/ingest-loadtest')['data']
-                    print(cred)
-                    creds.append(cred)
-
-                time.sleep(10)
-
-                for cred in creds:
-                    try:
-                        c = aws.create_session({'aws_access_key': cred['access_key'],
-                                                'aws_secret_key': cred['secret_key']}).client('iam')
-                        c.list_users()
-                    except Exception as ex:
-                        print(ex)
-
+                report = load_test(v, args.load, args.workers, args.settle, args.iam_endpoint)
+                report['domain'] = args.domain
                 print("\tcomplete")
+
+                if args.report:
+                    with open(args.report, 'w') as fh:
+                        json.dump(report, fh, indent=4, sort_keys=True)
             finally:
                 try:
-                    v.revoke_secret_prefix('aws/creds/ingest-loadtest')
+                    v.revoke_secret_prefix('aws/creds/' + ROLE)
                 except Exception as ex:
                     print(ex)
 
                 try:
-                    v.delete('aws/roles/ingest-loadtest')
+                    v.delete('aws/roles/' + ROLE)
                 except Exception as ex:
                     print(ex)
         finally:
@@ -142,4 +338,6 @@ if __name__ == '__main__':
                         print("{}: {}".format(a['UserName'], ex))
 
             policy.delete()
-            
+
+        if report['vault']['errors'] > 0 or report['iam']['errors'] > 0:
+            sys.exit(1)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A script to benchmark populating an ingest upload queue
+
+Runs the IngestUpload lambda against an in-process SQS stand-in for a set
+of volume extents and tile sizes and reports the throughput of the lambda
+and of each stage of creating and sending the messages.
+
+    generate  : Iterating over the chunks and tiles and formatting the messages
+    hash      : md5 hashing of the chunk and tile keys
+    serialize : Packing the messages into send_message_batch entries
+    send      : Sending the batches using the lambda's thread pool
+
+Each case is run in a separate process so that the peak RSS reported is
+for that case alone.
+
+Results can be saved as a baseline. Later runs can be compared against the
+baseline, and the script exits with a non-zero status if any case regressed
+by more than the threshold.
+"""
+
+import argparse
+import sys
+import os
+import io
+import json
+import time
+import resource
+import threading
+import multiprocessing
+from unittest import mock
+from contextlib import redirect_stdout
+
+import alter_path
+from lib import constants as const
+
+sys.path.append(os.path.dirname(const.INGEST_LAMBDA))
+import ingest_queue_upload as upload
+
+# name: ((x, y, z, t) extent, (x, y, z) tile size)
+CASES = {
+    'small':  ((4096, 4096, 64, 1), (512, 512, 16)),
+    'medium': ((16384, 16384, 128, 1), (512, 512, 16)),
+    'large':  ((32768, 32768, 256, 1), (512, 512, 16)),
+    'deep':   ((2048, 2048, 4096, 1), (1024, 1024, 16)),
+    'time':   ((4096, 4096, 64, 16), (512, 512, 16)),
+    'ragged': ((5000, 3000, 100, 1), (512, 512, 16)),
+}
+DEFAULT_CASES = ['small', 'medium', 'deep', 'time', 'ragged']
+
+STAGES = ['generate', 'hash', 'serialize', 'send']
+
+class FakeSQS(object):
+    """In-process stand-in for the Boto3 SQS client, recording the number
+    of messages and bytes sent"""
+
+    def __init__(self, latency=0):
+        """
+        Args:
+            latency (float): Seconds each send_message_batch call takes
+        """
+        self.latency = latency
+        self.messages = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def send_message_batch(self, QueueUrl, Entries):
+        if self.latency:
+            time.sleep(self.latency)
+
+        size = sum(len(e['MessageBody'].encode('utf-8')) for e in Entries)
+        with self.lock:
+            self.messages += len(Entries)
+            self.bytes += size
+
+        return {'Successful': [{'Id': e['Id']} for e in Entries]}
+
+class FakeContext(object):
+    """Lambda context that never runs out of time"""
+    function_name = 'IngestUpload-benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return upload.LAMBDA_TIMEOUT * 1000
+
+def make_args(extent, tile, compact=False):
+    """Create the lambda arguments for an ingest job
+
+    Args:
+        extent (tuple): Tuple of (x, y, z, t) stop values
+        tile (tuple): Tuple of (x, y, z) tile sizes
+        compact (bool): If the compact message format should be used
+
+    Returns:
+        dict: Arguments for the IngestUpload lambda
+    """
+    args = {
+        'job_id': 1,
+        'upload_queue': 'https://queue.amazonaws.com/123456789012/upload-benchmark',
+        'ingest_queue': 'https://queue.amazonaws.com/123456789012/ingest-benchmark',
+        'project_info': ['1', '2', '3'],
+        'resolution': 0,
+        't_tile_size': 1,
+        'shards': 1,
+        'compact_messages': compact,
+    }
+
+    for v, stop in zip('xyzt', extent):
+        args[v + '_start'] = 0
+        args[v + '_stop'] = stop
+    for v, size in zip('xyz', tile):
+        args[v + '_tile_size'] = size
+    args['final_z_stop'] = extent[2]
+
+    return args
+
+def timed(func, *args, **kwargs):
+    """Call the function and return its result and how long it took"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def key_bases(msgs, header):
+    """Get the unhashed chunk and tile keys used to create the messages
+
+    Args:
+        msgs (list): List of message bodies
+        header (dict): Result of message_header() for the job
+
+    Returns:
+        list: List of key strings, each chunk key once and every tile key
+    """
+    bases = []
+    chunks = set()
+    for msg in msgs:
+        msg = upload.decode_message(msg, header)
+        chunk = msg['chunk_key'].split('&', 1)[1]
+        if chunk not in chunks:
+            chunks.add(chunk)
+            bases.append(chunk)
+        bases.append(msg['tile_key'].split('&', 1)[1])
+    return bases
+
+def run_case(extent, tile, latency, repeat, compact):
+    """Benchmark one case
+
+    The lambda is run first, so that the peak RSS is not affected by the
+    message lists used to time the individual stages.
+
+    Args:
+        extent (tuple): Tuple of (x, y, z, t) stop values
+        tile (tuple): Tuple of (x, y, z) tile sizes
+        latency (float): Seconds each send_message_batch call takes
+        repeat (int): Number of times to run each measurement, the fastest is used
+        compact (bool): If the compact message format should be used
+
+    Returns:
+        dict: Dictionary of results
+    """
+    args = make_args(extent, tile, compact)
+    results = {}
+
+    elapsed = []
+    for i in range(repeat):
+        sqs = FakeSQS(latency)
+        with mock.patch.object(upload.boto3, 'client', return_value=sqs), \
+             redirect_stdout(io.StringIO()):
+            result, secs = timed(upload.handler, dict(args), FakeContext())
+        if not result['finished'] or result['sent'] != upload.count_messages(args):
+            raise Exception("Handler did not send all of the messages")
+        elapsed.append(secs)
+
+    results['messages'] = sqs.messages
+    results['bytes'] = sqs.bytes
+    results['seconds'] = min(elapsed)
+    results['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    stages = {}
+    msgs, create = min((timed(list, upload.create_messages(args)) for i in range(repeat)),
+                       key = lambda r: r[1])
+
+    bases = key_bases(msgs, upload.message_header(args))
+    stages['hash'] = min(timed(lambda: [upload.hashlib.md5(b.encode()).hexdigest() for b in bases])[1]
+                         for i in range(repeat))
+    stages['generate'] = max(0, create - stages['hash'])
+
+    stages['serialize'] = min(timed(list, upload.pack_batches(msgs))[1]
+                              for i in range(repeat))
+
+    # send_messages() packs the batches itself
+    send = min(timed(upload.send_messages, FakeSQS(latency), args['upload_queue'], msgs)[1]
+               for i in range(repeat))
+    stages['send'] = max(0, send - stages['serialize'])
+
+    results['stages'] = stages
+    return results
+
+def benchmark(cases, latency, repeat, compact):
+    """Run each case in a new process
+
+    Args:
+        cases (dict): Dictionary of case name to (extent, tile size)
+        latency (float): Seconds each send_message_batch call takes
+        repeat (int): Number of times to run each measurement
+        compact (bool): If the compact message format should be used
+
+    Returns:
+        dict: Dictionary of case name to results
+    """
+    results = {}
+    for name, (extent, tile) in cases.items():
+        print("Running {} {} tiles {}".format(name, extent, tile))
+        with multiprocessing.Pool(1) as pool:
+            results[name] = pool.apply(run_case, (extent, tile, latency, repeat, compact))
+    return results
+
+def report(results):
+    """Print a table of the results"""
+    fmt = "{:<10} {:>10} {:>12} {:>10} {:>10}" + " {:>10}" * len(STAGES)
+    print()
+    print(fmt.format('case', 'messages', 'msgs/sec', 'MB/sec', 'peak MB',
+                     *[s + ' s' for s in STAGES]))
+    for name, result in results.items():
+        print(fmt.format(name,
+                         result['messages'],
+                         int(result['messages'] / result['seconds']),
+                         '{:.1f}'.format(result['bytes'] / result['seconds'] / 2**20),
+                         '{:.1f}'.format(result['peak_rss'] / 2**20),
+                         *['{:.3f}'.format(result['stages'][s]) for s in STAGES]))
+
+def compare(results, baseline, threshold):
+    """Compare the results against a baseline
+
+    Args:
+        results (dict): Dictionary of case name to results
+        baseline (dict): Dictionary of case name to results
+        threshold (float): Fraction that throughput can drop, or peak RSS
+                           can grow, before it is a regression
+
+    Returns:
+        list: List of strings describing each regression
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print("No baseline for {}".format(name))
+            continue
+        base = baseline[name]
+
+        rate = result['messages'] / result['seconds']
+        base_rate = base['messages'] / base['seconds']
+        if rate < base_rate * (1 - threshold):
+            regressions.append("{}: {} msgs/sec, baseline {} msgs/sec".format(name, int(rate), int(base_rate)))
+
+        if result['peak_rss'] > base['peak_rss'] * (1 + threshold):
+            regressions.append("{}: peak RSS {:.1f} MB, baseline {:.1f} MB".format(name,
+                                                                                result['peak_rss'] / 2**20,
+                                                                                base['peak_rss'] / 2**20))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Script to benchmark populating an ingest upload queue",
+                                     epilog = "Cases: " + ", ".join(sorted(CASES)))
+
+    parser.add_argument("--case", "-c",
+                        metavar = "<case>",
+                        action = "append",
+                        choices = sorted(CASES),
+                        help = "Case to run, can be given multiple times (default: {})".format(", ".join(DEFAULT_CASES)))
+    parser.add_argument("--extent",
+                        metavar = "<n>",
+                        nargs = 4,
+                        type = int,
+                        help = "Run a custom case with the given x y z t extent")
+    parser.add_argument("--tile",
+                        metavar = "<n>",
+                        nargs = 3,
+                        type = int,
+                        default = [512, 512, 16],
+                        help = "x y z tile size of the custom case (default: 512 512 16)")
+    parser.add_argument("--latency",
+                        metavar = "<ms>",
+                        type = float,
+                        default = 0,
+                        help = "Milliseconds each send_message_batch call takes (default: 0)")
+    parser.add_argument("--repeat", "-r",
+                        metavar = "<n>",
+                        type = int,
+                        default = 3,
+                        help = "Number of times to run each measurement, the fastest is used (default: 3)")
+    parser.add_argument("--compact",
+                        action = "store_true",
+                        help = "Use the compact message format")
+    parser.add_argument("--save",
+                        metavar = "<file>",
+                        help = "Save the results as a baseline")
+    parser.add_argument("--baseline", "-b",
+                        metavar = "<file>",
+                        type = argparse.FileType('r'),
+                        help = "Baseline to compare the results against")
+    parser.add_argument("--threshold", "-t",
+                        metavar = "<fraction>",
+                        type = float,
+                        default = 0.2,
+                        help = "Allowed regression from the baseline (default: 0.2)")
+
+    args = parser.parse_args()
+
+    if args.extent:
+        cases = {'custom': (tuple(args.extent), tuple(args.tile))}
+    else:
+        cases = {name: CASES[name] for name in (args.case or DEFAULT_CASES)}
+
+    results = benchmark(cases, args.latency / 1000, args.repeat, args.compact)
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(results, fh, indent=4, sort_keys=True)
+
+    if args.baseline:
+        regressions = compare(results, json.load(args.baseline), args.threshold)
+        if len(regressions) > 0:
+            print()
+            print("Regressions:")
+            for regression in regressions:
+                print("    " + regression)
+            sys.exit(1)
+        print("No regressions from the baseline")
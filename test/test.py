@@ -47,18 +47,13 @@ TARGET_MACHINES = [
 def machine_lookup(session, domain, az):
     hostnames = [m + domain for m in TARGET_MACHINES]
 
-    client = session.client('ec2')
-    response = client.describe_instances(Filters=[{"Name":"availability-zone", "Values":[az]},
-                                                  {"Name":"tag:Name", "Values":hostnames},
-                                                  {"Name":"instance-state-name", "Values":["running"]}])
+    inventory = aws.hostname_inventory(session, domain)
 
     ids = []
-
-    items = response['Reservations']
-    if len(items) > 0:
-        for i in items:
-            item = i['Instances'][0]
-            ids.append(item['InstanceId'])
+    for hostname in hostnames:
+        for instance in inventory.named(hostname, 'running'):
+            if instance['Placement']['AvailabilityZone'] == az:
+                ids.append(instance['InstanceId'])
     return ids
 
 def azs_lookup(session):
@@ -82,6 +77,7 @@ def machine_terminate(session, instances):
 
     for instance in instances:
         ec2.Instance(instance).terminate()
+    aws.invalidate_lookups(session, 'inventory_lookup')
 
 def kill_az(session, args):
     azs = azs_lookup(session)